@@ -1,5 +1,497 @@
 import numpy as np
 from pathlib import Path
+from scipy.spatial import cKDTree
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import threading
+import tempfile
+import weakref
+import hashlib
+import pickle
+import json
+import logging
+import os
+import config
+from file_io import touch_cache_file, prune_cache_folder
+
+
+class TemplateStore:
+    """
+    process-wide store of the raw MNI template data, loaded lazily on first access and shared by all projection calls.
+    use get_template_store to obtain the store of a resource folder.
+    """
+    def __init__(self, resource_folder, refN=17, dtype=np.float64):
+        self.resource_folder = resource_folder
+        self.refN = refN
+        self.dtype = np.dtype(dtype)  # dtype of all template arrays (and thus of the projection computations)
+        self._lock = threading.Lock()
+        self._bundle_lock = threading.Lock()
+        self._bundle = None
+        self._anchors = None
+        self._surfaces = {}
+        self._trees = {}
+        self._voxel_grids = {}
+        self._fingerprint = None
+        self.shared = False  # true if arrays are views of a shared template bundle (see attach_template_store)
+        self.views = {}  # derived data (e.g. torch tensors per device) cached by other modules
+
+    @property
+    def bundle(self):
+        """
+        :return: the arrays of the compiled template bundle of the resource folder (memory mapped), or None if not compiled.
+                 a bundle compiled with the dtype of the store is preferred, otherwise the float64 one is used.
+        """
+        if self._bundle is None:
+            with self._bundle_lock:
+                if self._bundle is None:
+                    path = template_bundle_path(self.resource_folder, self.dtype)
+                    if not path.is_file():
+                        path = template_bundle_path(self.resource_folder)
+                    self._bundle = {}
+                    if path.is_file():
+                        try:
+                            self._bundle = load_template_bundle(path)
+                            assert len(self._bundle["anchors"]) == self.refN, "bundle has a different number of brains"
+                        except (OSError, ValueError, KeyError, IndexError, AssertionError) as e:
+                            # the raw .npy data is still usable
+                            logging.warning("ignoring template bundle {} ({}), using .npy files".format(path, e))
+                            self._bundle = {}
+        return self._bundle or None
+
+    @property
+    def anchors(self):
+        """
+        :return: refN x 23 x 3 array of the 10-20 anchors of every reference brain
+        """
+        if self._anchors is None:
+            with self._lock:
+                if self._anchors is None:
+                    anchors = load_raw_anchor_data(self.resource_folder, self.refN, self.dtype).astype(self.dtype, copy=False)
+                    anchors.setflags(write=False)
+                    self._anchors = anchors
+        return self._anchors
+
+    @property
+    def fingerprint(self):
+        """
+        :return: a string identifying the content of the data projections use (anchors, head and reference brain
+                 surfaces) and its dtype, computed once
+        """
+        if self._fingerprint is None:
+            h = hashlib.sha1("{}{}".format(self.refN, self.dtype.str).encode())
+            for x in [self.anchors, self.surface("head")] + [self.surface(i) for i in range(self.refN)]:
+                h.update(str(x.shape).encode())
+                h.update(np.ascontiguousarray(x).tobytes())
+            self._fingerprint = h.hexdigest()
+        return self._fingerprint
+
+    def surface(self, type):
+        """
+        :param type: "brain" = average brain surface, "head" = average head surface,
+                     or number indicating reference brain index (brain surface data)
+        :return: nx3 array of surface points
+        """
+        if type not in self._surfaces:
+            with self._lock:
+                if type not in self._surfaces:
+                    location = str(self._surface_path(type).with_suffix(".npy"))
+                    XYZ = load_raw_MNI_data(location, type, self.resource_folder, self.dtype).astype(self.dtype, copy=False)
+                    XYZ.setflags(write=False)
+                    self._surfaces[type] = XYZ
+        return self._surfaces[type]
+
+    def tree(self, type):
+        """
+        returns a kd-tree over a surface for fast nearest neighbour queries.
+        the tree is built once and persisted next to the template data (".kdtree" file).
+        :param type: see surface
+        :return: a scipy.spatial.cKDTree
+        """
+        if type not in self._trees:
+            XYZ = self.surface(type)
+            with self._lock:
+                if type not in self._trees:
+                    if self.shared:
+                        # build on top of the shared surface instead of loading a private copy of the data
+                        self._trees[type] = cKDTree(XYZ, copy_data=False)
+                        return self._trees[type]
+                    tree_path = self._surface_path(type).with_suffix(".kdtree")
+                    tree = None
+                    if tree_path.is_file():
+                        try:
+                            with open(tree_path, "rb") as f:
+                                tree = pickle.load(f)
+                        except Exception:  # stale or incompatible (e.g. scipy version), rebuild
+                            tree = None
+                        if tree is not None and (tree.n != XYZ.shape[0] or not np.array_equal(tree.data, XYZ)):
+                            tree = None
+                    if tree is None:
+                        tree = cKDTree(XYZ)
+                        try:
+                            with open(tree_path, "wb") as f:
+                                pickle.dump(tree, f, protocol=pickle.HIGHEST_PROTOCOL)
+                        except OSError:
+                            logging.warning("could not persist kd-tree to: {}".format(tree_path))
+                    self._trees[type] = tree
+        return self._trees[type]
+
+    def voxel_grid(self, type="head", voxel_size=1.0, band=10.0):
+        """
+        returns a voxel lookup table over a surface for constant time approximate nearest surface queries.
+        the table is built once (slow) and persisted next to the template data (".voxels" files), later it is memory mapped.
+        :param type: see surface
+        :param voxel_size: edge length of a voxel (mm)
+        :param band: only voxels closer than this to the surface (mm) are filled
+        :return: a VoxelGrid
+        """
+        key = (type, voxel_size, band)
+        if key not in self._voxel_grids:
+            tree = self.tree(type)
+            XYZ = self.surface(type)
+            with self._lock:
+                if key not in self._voxel_grids:
+                    path = self._surface_path(type)
+                    name = "{}_{:g}mm_{:g}mm".format(path.name, voxel_size, band)
+                    grid_path, means_path = path.with_name(name + ".voxels.npy"), path.with_name(name + ".voxel_means.npy")
+                    meta_path = path.with_name(name + ".voxels.json")
+                    fingerprint = surface_fingerprint(XYZ)
+                    try:
+                        with open(meta_path, "r") as f:
+                            meta = json.load(f)
+                        # built from another surface (or dtype), rebuild
+                        if meta["surface"] != fingerprint or meta["dtype"] != XYZ.dtype.str:
+                            raise ValueError("stale voxel grid")
+                        origin = meta["origin"]
+                        grid, means = np.load(grid_path, mmap_mode="r"), np.load(means_path, mmap_mode="r")
+                    except (OSError, ValueError, KeyError):
+                        logging.info("building {} voxel grid (this might take a while, done only once)".format(type))
+                        grid, means, origin = build_voxel_grid(XYZ, tree, voxel_size, band)
+                        try:
+                            np.save(grid_path, grid)
+                            np.save(means_path, means)
+                            with open(meta_path, "w") as f:
+                                json.dump({"origin": [float(x) for x in origin], "voxel_size": voxel_size, "band": band,
+                                           "surface": fingerprint, "dtype": XYZ.dtype.str}, f)
+                        except OSError:
+                            logging.warning("could not persist voxel grid to: {}".format(grid_path))
+                    self._voxel_grids[key] = VoxelGrid(grid, means, origin, voxel_size)
+        return self._voxel_grids[key]
+
+    def attach(self, anchors, surfaces):
+        """
+        makes the store use externally owned (e.g. shared memory) arrays instead of loading them from disk
+        :param anchors: refN x 23 x 3 array (see anchors)
+        :param surfaces: dictionary of surface type to nx3 array (see surface)
+        """
+        with self._lock:
+            self._anchors = anchors
+            self._surfaces = dict(surfaces)
+            self._trees = {}
+            self.views = {}
+            self._fingerprint = None
+            self.shared = True
+
+    def _surface_path(self, type):
+        if type == "brain":
+            file_name = "xyzallBEM"
+        elif type == "head":
+            file_name = "xyzallHEM"
+        else:
+            file_name = "xyzall{}".format(type + 1)
+        return Path(self.resource_folder, "MNI_templates", file_name)
+
+
+def surface_fingerprint(XYZ):
+    """
+    :param XYZ: nx3 surface points
+    :return: a string identifying the content (and dtype) of a surface
+    """
+    h = hashlib.sha1("{}{}".format(XYZ.shape, XYZ.dtype.str).encode())
+    h.update(np.ascontiguousarray(XYZ).tobytes())
+    return h.hexdigest()
+
+
+class VoxelGrid:
+    """
+    precomputed nearest surface lookup table: every voxel of a regular grid over the (padded) bounding box of
+    a surface stores the mean of the 3 surface points closest to its center. only voxels close to the surface
+    are filled, lookups of other locations report they were not found.
+    """
+    def __init__(self, grid, means, origin, voxel_size):
+        """
+        :param grid: 3d int32 array of indices into means (-1 for voxels that are not filled)
+        :param means: mx3 array of the mean of the 3 closest surface points per filled voxel
+        :param origin: location of the center of voxel (0, 0, 0)
+        :param voxel_size: edge length of a voxel (mm)
+        """
+        self.grid = grid
+        self.means = means
+        self.origin = np.asarray(origin)
+        self.voxel_size = voxel_size
+
+    def lookup(self, P):
+        """
+        :param P: nx3 locations
+        :return: nx3 approximate mean of the 3 closest surface points, and a boolean mask of found locations
+        """
+        voxels = np.floor((P - self.origin) / self.voxel_size + 0.5).astype(np.int64)  # voxel with closest center
+        inside = np.all((voxels >= 0) & (voxels < self.grid.shape), axis=1)
+        ids = np.full(len(P), -1, dtype=np.int64)
+        ids[inside] = self.grid[tuple(voxels[inside].T)]
+        found = ids >= 0
+        closest = np.zeros((len(P), 3), dtype=self.means.dtype)
+        closest[found] = self.means[ids[found]]
+        return closest, found
+
+
+def build_voxel_grid(XYZ, tree, voxel_size=1.0, band=10.0, chunk_size=2 ** 20):
+    """
+    computes a VoxelGrid over a surface (slow, done once per surface, see TemplateStore.voxel_grid)
+    :param XYZ: nx3 surface points
+    :param tree: kd-tree over XYZ
+    :param voxel_size: edge length of a voxel (mm)
+    :param band: only voxels with centers closer than this to the surface (mm) are filled
+    :param chunk_size: number of voxels queried at once
+    :return: the grid, means and origin (see VoxelGrid)
+    """
+    origin = np.floor(np.min(XYZ, axis=0)) - band
+    shape = tuple((np.ceil((np.max(XYZ, axis=0) + band - origin) / voxel_size) + 1).astype(np.int64))
+    grid = np.full(shape, -1, dtype=np.int32)
+    flat_grid = grid.reshape(-1)
+    means = []
+    n_means = 0
+    for start in range(0, flat_grid.shape[0], chunk_size):
+        ids = np.arange(start, min(start + chunk_size, flat_grid.shape[0]))
+        centers = origin + np.stack(np.unravel_index(ids, shape), axis=-1) * voxel_size
+        distances, _ = tree.query(centers, k=1, distance_upper_bound=band)
+        in_band = np.isfinite(distances)
+        _, IDtop = tree.query(centers[in_band], k=3)
+        means.append(np.mean(XYZ[IDtop], axis=1).astype(np.float32))
+        flat_grid[ids[in_band]] = np.arange(n_means, n_means + np.count_nonzero(in_band))
+        n_means += np.count_nonzero(in_band)
+    return grid, np.concatenate(means), origin
+
+
+_template_stores = {}
+_template_stores_lock = threading.Lock()
+
+
+def get_template_store(resource_folder="resource", dtype=None):
+    """
+    returns the (process-wide) template store of a resource folder, creating it if needed
+    :param resource_folder: relative path to the folder with the raw template data
+    :param dtype: dtype of the template arrays, None uses config.mni_dtype
+    :return: a TemplateStore
+    """
+    folder = os.path.normpath(os.path.abspath(str(resource_folder)))
+    dtype = np.dtype(config.mni_dtype if dtype is None else dtype)
+    key = (folder, dtype.name)
+    with _template_stores_lock:
+        if key not in _template_stores:
+            _template_stores[key] = TemplateStore(folder, dtype=dtype)
+        return _template_stores[key]
+
+
+_affine_cache = OrderedDict()
+_affine_cache_lock = threading.Lock()
+AFFINE_CACHE_SIZE = 256
+
+
+def affine_cache_key(our_anchors_xyz, selected_indices, resource_folder="resource"):
+    """
+    hashes anchors and the selected anchor indices into a key for the affine transforms cache
+    :param our_anchors_xyz: our anchors (np array)
+    :param selected_indices: our selected anchors out of the 23 10-20 points
+    :param resource_folder: relative path to the folder with the raw template data
+    :return: a string key
+    """
+    our_anchors_xyz = np.ascontiguousarray(our_anchors_xyz)
+    h = hashlib.sha1(our_anchors_xyz.tobytes())
+    h.update("{}{}".format(our_anchors_xyz.dtype, our_anchors_xyz.shape).encode())
+    h.update(np.asarray(selected_indices, dtype=np.int64).tobytes())
+    store = get_template_store(resource_folder)
+    h.update("{}{}".format(store.resource_folder, store.dtype).encode())
+    return h.hexdigest()
+
+
+def get_cached_affine_transforms(key, compute):
+    """
+    returns the affine transforms stack of a key, computing (and caching) it if it is not in the cache (LRU)
+    :param key: the key of the transforms (see affine_cache_key)
+    :param compute: function with no arguments that computes the transforms
+    :return: the transforms
+    """
+    with _affine_cache_lock:
+        if key in _affine_cache:
+            _affine_cache.move_to_end(key)
+            return _affine_cache[key]
+    transforms = compute()
+    with _affine_cache_lock:
+        _affine_cache[key] = transforms
+        if len(_affine_cache) > AFFINE_CACHE_SIZE:
+            _affine_cache.popitem(last=False)
+    return transforms
+
+
+_projection_cache = OrderedDict()
+_projection_cache_lock = threading.Lock()
+PROJECTION_CACHE_SIZE = 64
+PROJECTION_CACHE_QUANTUM = 1e-3  # inputs are quantized before hashing (given in cm, so 0.01mm)
+PROJECTION_VERSION = 1  # increase when the projection algorithm changes its output (invalidates persisted projections)
+_projection_outputs = ("otherH", "otherC", "otherHSD", "otherCSD", "transforms")
+
+
+def projection_cache_key(origin_xyz, others_xyz, selected_indices, resource_folder="resource", **options):
+    """
+    hashes the (quantized) projection inputs, the template data (content and version), the projection algorithm version
+    and the projection options into a key
+    :param origin_xyz: our anchors (np array)
+    :param others_xyz: our sensors (np array)
+    :param selected_indices: our selected anchors out of the 23 10-20 points
+    :param resource_folder: relative path to the folder with the raw template data
+    :param options: any other argument that changes the projection result (e.g. surfaces, output_errors)
+    :return: a string key
+    """
+    h = hashlib.sha1()
+    for xyz in (origin_xyz, others_xyz):
+        xyz = np.asarray(xyz)
+        h.update(np.round(xyz / PROJECTION_CACHE_QUANTUM).astype(np.int64).tobytes())
+        h.update(str(xyz.shape).encode())
+    h.update(np.asarray(selected_indices, dtype=np.int64).tobytes())
+    store = get_template_store(resource_folder)
+    h.update("{}{}{}{}{}{}".format(store.resource_folder, store.dtype, store.fingerprint, TEMPLATE_BUNDLE_VERSION,
+                                   PROJECTION_VERSION, sorted(options.items())).encode())
+    return h.hexdigest()
+
+
+def projection_cache_folder():
+    """
+    :return: the folder of the on disk projection cache tier, or None if it is disabled (see config.mni_projection_cache_folder)
+    """
+    if config.mni_projection_cache_folder is None:
+        return None
+    return Path(Path(__file__).parent, config.mni_projection_cache_folder)
+
+
+def get_cached_projection(key, compute):
+    """
+    returns the projection outputs of a key from the in memory LRU tier, then the on disk tier,
+    otherwise computes them and stores them in both tiers. every call returns its own copy of the outputs.
+    the on disk tier is bounded by config.mni_projection_cache_folder_bytes (least recently used files are removed).
+    :param key: the key of the projection (see projection_cache_key)
+    :param compute: function with no arguments that computes the projection outputs (see project)
+    :return: the projection outputs
+    """
+    if not config.mni_projection_cache:
+        return compute()
+    outputs = None
+    with _projection_cache_lock:
+        if key in _projection_cache:
+            _projection_cache.move_to_end(key)
+            outputs = _projection_cache[key]
+    folder = projection_cache_folder()
+    path = None if folder is None else Path(folder, key + ".npz")
+    if outputs is None and path is not None and path.is_file():
+        try:
+            with np.load(path) as data:
+                outputs = tuple(data[name] if name in data.files else None for name in _projection_outputs)
+            touch_cache_file(path)
+        except (OSError, ValueError):
+            logging.warning("ignoring corrupt cached projection: {}".format(path))
+    if outputs is None:
+        outputs = compute()
+        if path is not None:
+            try:
+                folder.mkdir(parents=True, exist_ok=True)
+                tmp_path = Path(folder, "{}.{}.{}.tmp.npz".format(key, os.getpid(), threading.get_ident()))
+                np.savez(tmp_path, **{name: x for name, x in zip(_projection_outputs, outputs) if x is not None})
+                os.replace(tmp_path, path)
+                prune_cache_folder(folder, "*.npz", config.mni_projection_cache_folder_bytes, keep=path)
+            except OSError:
+                logging.warning("could not persist projection to: {}".format(path))
+    with _projection_cache_lock:
+        _projection_cache[key] = outputs
+        _projection_cache.move_to_end(key)
+        if len(_projection_cache) > PROJECTION_CACHE_SIZE:
+            _projection_cache.popitem(last=False)
+    return tuple(None if x is None else np.array(x) for x in outputs)
+
+
+def clear_projection_cache(disk=False):
+    """
+    empties the in memory projection cache tier
+    :param disk: if true, removes the on disk tier files as well
+    """
+    with _projection_cache_lock:
+        _projection_cache.clear()
+    folder = projection_cache_folder()
+    if disk and folder is not None and folder.is_dir():
+        for path in folder.glob("*.npz"):
+            path.unlink()
+
+
+class SharedTemplateBundle:
+    """
+    all arrays of a template store packed once (by the parent process) into a single read-only memory mapped file,
+    preferably on a ram backed file system. worker processes attach to it without copying (see attach_template_store),
+    so memory does not grow with the number of workers.
+    usage: with SharedTemplateBundle("resource") as bundle, bundle.process_pool(8) as pool: ...
+    """
+    def __init__(self, resource_folder="resource"):
+        store = get_template_store(resource_folder)
+        arrays = [("anchors", store.anchors), ("head", store.surface("head")), ("brain", store.surface("brain"))]
+        arrays += [(i, store.surface(i)) for i in range(store.refN)]
+        index, offset = {}, 0
+        for key, array in arrays:
+            index[key] = (offset, array.shape, array.dtype.str)
+            offset += -(-array.nbytes // 64) * 64  # keep arrays aligned
+        folder = "/dev/shm" if os.path.isdir("/dev/shm") else None
+        fd, self.path = tempfile.mkstemp(prefix="mni_templates_", suffix=".bin", dir=folder)
+        os.close(fd)
+        buffer = np.memmap(self.path, dtype=np.uint8, mode="w+", shape=(offset,))
+        for key, array in arrays:
+            start, shape, dtype = index[key]
+            np.ndarray(shape, dtype=dtype, buffer=buffer, offset=start)[:] = array
+        buffer.flush()
+        del buffer
+        self.handle = {"path": self.path, "resource_folder": store.resource_folder, "refN": store.refN,
+                       "dtype": store.dtype.name, "index": index}
+        self._finalizer = weakref.finalize(self, os.remove, self.path)
+
+    def process_pool(self, workers=None):
+        """
+        :param workers: number of worker processes (default: number of cores)
+        :return: a process pool whose workers are attached to this bundle
+        """
+        return ProcessPoolExecutor(max_workers=workers, initializer=attach_template_store, initargs=(self.handle,))
+
+    def close(self):
+        """
+        removes the bundle file (attached processes keep their mapping until they exit)
+        """
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def attach_template_store(handle):
+    """
+    attaches the template store of this process to a shared template bundle, can be used as a pool initializer
+    :param handle: the handle of a SharedTemplateBundle
+    :return: the attached TemplateStore
+    """
+    buffer = np.memmap(handle["path"], dtype=np.uint8, mode="r")
+    arrays = {key: np.ndarray(shape, dtype=dtype, buffer=buffer, offset=start)
+              for key, (start, shape, dtype) in handle["index"].items()}
+    anchors = arrays.pop("anchors")
+    store = get_template_store(handle["resource_folder"], handle["dtype"])
+    assert store.refN == handle["refN"]
+    store.attach(anchors, arrays)
+    return store
 
 
 def find_affine_transforms(our_anchors_xyz, our_sensors_xyz, selected_indices, refN, pointN, resource_folder="resource"):
@@ -12,112 +504,157 @@ def find_affine_transforms(our_anchors_xyz, our_sensors_xyz, selected_indices, r
     :return: numpy array of size refN x number_of_sensors x 3
     represents for each refernce brain all our sensors locations in its frame of reference
     """
-    # todo: refactor this function to be more readable
-
     # ==================== AffineEstimation4 ======================
     size = len(selected_indices)
     assert size >= 4
+    DMS = get_template_store(resource_folder).anchors
     # find affine transformation with ideal brain (not used anywhere..)
-    listOri = np.c_[our_anchors_xyz, np.ones(size)]
-    # ------------ Transformation to reference brains --------------
-    # find affine transformation with every brain in the 17 templates
-    refBList = np.empty((refN, 2), dtype=object)
-    # load 17 brain templates from disk
-    DMS = []
-    resource_folder = str(resource_folder)
-    for i in range(1, refN+1):
-        path_wo_ext = resource_folder + "/MNI_templates/DMNI{:0>4d}".format(i)
-        if Path(path_wo_ext+".npy").is_file():
-            DMS.append(np.load(path_wo_ext+".npy", allow_pickle=True))
-        else:
-            csv_path = Path(path_wo_ext+".csv")
-            DM = np.genfromtxt(csv_path, delimiter=',')
-            np.save(path_wo_ext, DM)
-            DMS.append(DM)
-    # find affine transformation between our anchors and all brains
-    for i in range(1, refN+1):
-        DM = DMS[i-1][selected_indices, :]
-        refDist = np.c_[DM, np.ones(size)]
-        WW = np.linalg.lstsq(listOri, refDist, rcond=None)[0]
-        refBList[i-1, 0] = np.matmul(listOri, WW)
-        refBList[i-1, 1] = WW
+    listOri = np.c_[our_anchors_xyz, np.ones(size)].astype(DMS.dtype, copy=False)
+
+    def compute_transforms():
+        # ------------ Transformation to reference brains --------------
+        # find affine transformation with every brain in the 17 templates
+        WWs = np.empty((refN, 4, 4), dtype=DMS.dtype)
+        for i in range(refN):
+            DM = DMS[i][selected_indices, :]
+            refDist = np.c_[DM, np.ones(size, dtype=DM.dtype)]
+            WWs[i] = np.linalg.lstsq(listOri, refDist, rcond=None)[0]
+        WWs.setflags(write=False)
+        return WWs
+    # transforms only depend on the anchors, so they are cached and reused by later projections with the same anchors
+    key = ("numpy", refN, affine_cache_key(our_anchors_xyz, selected_indices, resource_folder))
+    affine_transforms = get_cached_affine_transforms(key, compute_transforms)
     # ---------- Transforming given head surface points stored in others to the ideal brain and each ref brain -----
-    DDDD = np.c_[our_sensors_xyz, np.ones(pointN)]
-    othersRefList = np.empty((refN, pointN, DDDD.shape[1]), dtype=np.float)
-    originRegList = np.empty((refN, our_anchors_xyz.shape[0], DDDD.shape[1]), dtype=np.float)
-    for i in range(refN):
-        WR = refBList[i, 1]
-        othersRef = np.matmul(DDDD, WR)
-        othersRefList[i] = othersRef
-        originRegList[i] = refBList[i, 0]
-    affine_transforms = np.stack([x for x in refBList[:, 1]])
+    DDDD = np.c_[our_sensors_xyz, np.ones(pointN)].astype(DMS.dtype, copy=False)
+    othersRefList = np.matmul(DDDD, affine_transforms)
+    originRegList = np.matmul(listOri, affine_transforms)
     return affine_transforms, othersRefList[:, :, :3], originRegList[:, :, :3]
 
 
-def find_closest_on_surface_naive(othersRefList, XYZ, pointN, calc_sd_and_var=False):
+def find_affine_transforms_batch(our_anchors_xyz, selected_indices, resource_folder="resource"):
+    """
+    finds the affine transforms between a batch of anchor sets and anchors from all reference template brains
+    (same as find_affine_transforms, but all least squares problems are solved at once)
+    :param our_anchors_xyz: b x n x 3 our anchors
+    :param selected_indices: our selected anchors out of the 23 10-20 points
+    :param resource_folder: relative path to the folder with the raw template data
+    :return: b x refN x 4 x 4 affine transforms (right multiplication of homogeneous row vectors)
+    """
+    size = len(selected_indices)
+    assert size >= 4
+    DMS = get_template_store(resource_folder).anchors[:, selected_indices, :]
+    listOri = np.concatenate((our_anchors_xyz, np.ones(our_anchors_xyz.shape[:2] + (1,))), axis=-1).astype(DMS.dtype, copy=False)
+    refDist = np.concatenate((DMS, np.ones(DMS.shape[:2] + (1,), dtype=DMS.dtype)), axis=-1)
+    # least squares solution of listOri @ W = refDist for every (batch, ref brain) pair
+    return np.einsum("bij,rjk->brik", np.linalg.pinv(listOri), refDist)
+
+
+def projection_variance(othersRefList, other):
+    """
+    variance of the transformed sensor locations around their projection, over all reference brains
+    :param othersRefList: the refN x pointN x 3 transformed sensor locations (into ref brains)
+    :param other: pointN x 3 projected sensor locations
+    :return: pointN x 4 variance per axis, last channel is the variance across all axes (sum of squares)
+    """
+    N = othersRefList.shape[0]
+    dispEach = othersRefList - other
+    XYZSS = np.einsum("rpi,rpi->pi", dispEach, dispEach)
+    RSS = np.sum(XYZSS, axis=1, keepdims=True)
+    return np.concatenate((XYZSS, RSS), axis=1) / (N - 1)
+
+
+def find_closest_on_surface_naive(othersRefList, XYZ, pointN, calc_sd_and_var=False, tree=None, voxel_grid=None):
     """
     finds closest point on cortical surface for every (transformed) sensor location
     by averaging over 3 closest points on cortical surface
     :param othersRefList: the refN x pointN x 3 transformed sensor locations (into ref brains)
     :param XYZ the raw measurements from template reference brains
     :param pointN: number of sensors
+    :param tree: optional kd-tree over XYZ (see TemplateStore.tree), if given all sensors are queried in one batch
+    :param voxel_grid: optional VoxelGrid over XYZ (see TemplateStore.voxel_grid), if given sensors are looked up
+                       approximately in constant time (sensors outside of the grid fall back to the exact search)
     :return:
     other - location on cortical surface per sensor
     otherVar - variance of each otherH sensor
     otherSD - root of variance of each otherH sensor
     """
-    other = np.ones((pointN, 3))
-    otherVar = np.ones((pointN, 4))
-    otherSD = np.ones((pointN, 4))
+    other = np.ones((pointN, 3), dtype=XYZ.dtype)
+    otherVar = np.ones((pointN, 4), dtype=XYZ.dtype)
+    otherSD = np.ones((pointN, 4), dtype=XYZ.dtype)
     top = 3
-    for i in range(pointN):
+    exact = np.ones(pointN, dtype=bool)  # sensors that still need an exact search
+    if voxel_grid is not None:
+        approximate, found = voxel_grid.lookup(np.mean(othersRefList, axis=0))
+        other[found] = approximate[found]
+        exact = ~found
+    if tree is not None and np.any(exact):
+        _, IDtop = tree.query(np.mean(othersRefList[:, exact], axis=0), k=top)
+        other[exact] = np.mean(XYZ[IDtop], axis=1)
+        exact[:] = False
+    for i in np.flatnonzero(exact):
         AA = np.mean(othersRefList[:, i], axis=0)
         # ----- Back projection -----
         PP = np.broadcast_to(AA, XYZ.shape)
         D = np.linalg.norm(XYZ - PP, axis=1)
         IDtop = np.argpartition(D, top)[:top]  # sort by lowest norm
         XYZtop = XYZ[IDtop, :]
-        closest = np.mean(XYZtop, axis=0)
+        other[i, :] = np.mean(XYZtop, axis=0)
         # -------- End of back projection ----------
+    # ---- Variance calculation ----
+    if calc_sd_and_var:
+        otherVar = projection_variance(othersRefList, other)
+        otherSD = np.sqrt(otherVar)
+    return other, otherVar, otherSD
 
-        other[i, :] = closest
-
-        # ---- Variance calculation ----
-        if calc_sd_and_var:
-            AAA = othersRefList[:, i]
-            AV = closest
-            N = AAA.shape[0]
-            subMat = np.ones(AAA.shape)
-            for j in range(N):
-                subMat[j, :] = AV
 
-            dispEach = AAA - subMat
-            dispEachSq = dispEach * dispEach
-            XYZSS = np.sum(dispEachSq, axis=0)
-            RSS = np.sum(XYZSS)
+def get_reference_brain_workers(workers, refN):
+    """
+    :param workers: number of threads, None uses config.mni_projection_workers, 0 uses all cores
+    :param refN: number of reference brains
+    :return: number of reference brains map_reference_brains processes at once
+    """
+    if workers is None:
+        workers = config.mni_projection_workers
+    if workers == 0:
+        workers = os.cpu_count()
+    return max(1, min(workers, refN))
 
-            XYZVar = XYZSS / (N - 1)
-            RSSVar = RSS / (N - 1)
 
-            VV = np.append(XYZVar, RSSVar)
-            otherVar[i, :] = VV
-            otherSD[i, :] = np.sqrt(VV)
-    return other, otherVar, otherSD
+def map_reference_brains(func, refN, workers=None):
+    """
+    applies a function to every reference brain index. reference brains are independent,
+    so with more than one worker they are processed by a thread pool (numpy / scipy release the GIL)
+    :param func: function of a reference brain index
+    :param refN: number of reference brains
+    :param workers: number of threads, None uses config.mni_projection_workers, 0 uses all cores
+    :return: list of outputs of func, ordered by reference brain index
+    """
+    workers = get_reference_brain_workers(workers, refN)
+    if workers <= 1:
+        return [func(i) for i in range(refN)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(func, range(refN)))
 
 
-def find_closest_on_surface_full(othersRefList, refN, pointN, resource_folder):
+def find_closest_on_surface_full(othersRefList, refN, pointN, resource_folder, use_kdtree=True, workers=None):
     """
     full implementation of cortical projection using the balloon inflation algorithm described in
     https://doi.org/10.1016/j.neuroimage.2005.01.018
     :param othersRefList: the refN x pointN x 3 transformed sensor locations (into ref brains)
     :param refN: number of reference brains
     :param pointN: number of sensors
+    :param use_kdtree: if true, uses the kd-tree of every ref brain and inflates rods of all sensors at once
+    :param workers: number of threads projecting onto the ref brains in parallel (see map_reference_brains)
     :return:
     """
-    otherRefCList = np.empty((refN, pointN, 3), dtype=np.float)
-    for i in range(refN):
-        my_str = resource_folder+"/MNI_templates/xyzall{}.npy".format(str(i + 1))
-        XYZ = load_raw_MNI_data(my_str, i, resource_folder=resource_folder)
+    store = get_template_store(resource_folder)
+    otherRefCList = np.empty((refN, pointN, 3), dtype=store.dtype)
+
+    def project_onto_ref(i):
+        XYZ = store.surface(i)
+        if use_kdtree:
+            otherRefCList[i] = balloon_inflation(othersRefList[i, :, :3], XYZ, store.tree(i))
+            return
         projectionListC = np.ones((pointN, 3))
         for j in range(pointN):
             P = othersRefList[i, j, :3]
@@ -156,42 +693,142 @@ def find_closest_on_surface_full(othersRefList, refN, pointN, resource_folder):
             CP = np.mean(Vic, axis=0)
             projectionListC[j, :] = CP
         otherRefCList[i] = projectionListC
+    map_reference_brains(project_onto_ref, refN, workers)
     return otherRefCList
 
 
-def load_raw_MNI_data(location, type, resource_folder):
+def load_raw_anchor_data(resource_folder, refN=17, dtype=None):
     """
-    loads raw MNi data from disk
-    :param location: where is the data located
+    loads the 10-20 anchors of all reference brains from disk (compiled bundle if it exists, otherwise .npy files)
+    :param resource_folder: relative path to the folder with the raw template data
+    :param refN: number of reference brains
+    :param dtype: prefer the bundle compiled with this dtype (see TemplateStore.bundle)
+    :return: refN x 23 x 3 numpy array
+    """
+    bundle = get_template_store(resource_folder, dtype).bundle
+    if bundle is not None:
+        return bundle["anchors"]
+    DMS = []
+    for i in range(1, refN+1):
+        path = Path(resource_folder, "MNI_templates", "DMNI{:0>4d}.npy".format(i))
+        if not path.is_file():
+            raise FileNotFoundError("missing template data: {}, compile templates using: python MNI.py --compile".format(path))
+        DMS.append(np.load(path, allow_pickle=True))
+    return np.stack(DMS)
+
+
+def load_raw_MNI_data(location, type, resource_folder, dtype=None):
+    """
+    loads raw MNi data from disk (compiled bundle if it exists, otherwise .npy file)
+    :param location: where is the data located (.npy file)
     :param type: what does the data represent
      "brain" = average brain surface,
      "head" = average head surface,
       or number indicating reference brain index (brain surface data))
+    :param dtype: prefer the bundle compiled with this dtype (see TemplateStore.bundle)
     :return:
     """
+    bundle = get_template_store(resource_folder, dtype).bundle
+    if bundle is not None:
+        return bundle[type]
+    if not Path(location).is_file():
+        raise FileNotFoundError("missing template data: {}, compile templates using: python MNI.py --compile".format(location))
+    return np.load(location, allow_pickle=True)
+
+
+def parse_raw_MNI_data(type, resource_folder, refN=17):
+    """
+    parses raw MNI data from the original csv files (slow, only used when compiling templates)
+    :param type: see load_raw_MNI_data, or "anchors" for the 10-20 anchors of all reference brains
+    :param resource_folder: relative path to the folder with the raw template data
+    :param refN: number of reference brains (only used for anchors)
+    :return: nx3 numpy array (refN x 23 x 3 for anchors)
+    """
+    folder = Path(resource_folder, "MNI_templates")
+    if type == "anchors":
+        return np.stack([np.genfromtxt(Path(folder, "DMNI{:0>4d}.csv".format(i)), delimiter=',')
+                         for i in range(1, refN + 1)])
     if type == "brain":
         shortcut = "BEM"
     elif type == "head":
         shortcut = "HEM"
     else:
         shortcut = "M0" + str(type + 1)
-    my_str = location
-    if Path(my_str).is_file():
-        XYZ = np.load(my_str, allow_pickle=True)
-    else:
-        resource_folder = str(resource_folder)
-        xallbemPath = Path(resource_folder+"/MNI_templates/xall"+shortcut+".csv")
-        yallbemPath = Path(resource_folder+"/MNI_templates/yall"+shortcut+".csv")
-        zallbemPath = Path(resource_folder+"/MNI_templates/zall"+shortcut+".csv")
-        xallBEM = np.genfromtxt(xallbemPath, delimiter=',')
-        yallBEM = np.genfromtxt(yallbemPath, delimiter=',')
-        zallBEM = np.genfromtxt(zallbemPath, delimiter=',')
-        XYZ = np.column_stack((xallBEM, yallBEM, zallBEM))
-        np.save(location, XYZ)
-    return XYZ
+    return np.column_stack([np.genfromtxt(Path(folder, axis + "all" + shortcut + ".csv"), delimiter=',')
+                            for axis in ["x", "y", "z"]])
+
+
+TEMPLATE_BUNDLE_VERSION = 1
+_bundle_magic = b"STORMMNI"
+
+
+def template_bundle_path(resource_folder="resource", dtype=np.float64):
+    """
+    :param resource_folder: relative path to the folder with the raw template data
+    :param dtype: the dtype of the bundle arrays
+    :return: path of the compiled template bundle
+    """
+    return Path(resource_folder, "MNI_templates", "templates_{}.bundle".format(np.dtype(dtype).name))
+
+
+def compile_template_bundle(resource_folder="resource", dtype=np.float64, refN=17):
+    """
+    compiles all raw template data into a single versioned and checksummed file that is memory mapped at runtime.
+    file layout: magic, header length (uint64), json header (version, dtype, sha256 of payload, array index), payload.
+    :param resource_folder: relative path to the folder with the raw template data
+    :param dtype: the dtype of the bundle arrays (np.float64 or np.float32)
+    :param refN: number of reference brains
+    :return: path of the compiled bundle
+    """
+    keys = ["anchors", "head", "brain"] + list(range(refN))
+    arrays = [np.ascontiguousarray(parse_raw_MNI_data(key, resource_folder, refN), dtype=dtype) for key in keys]
+    index, offset = [], 0
+    for key, array in zip(keys, arrays):
+        index.append({"key": key, "offset": offset, "shape": array.shape})
+        offset += -(-array.nbytes // 64) * 64  # keep arrays aligned
+    payload = bytearray(offset)
+    for entry, array in zip(index, arrays):
+        payload[entry["offset"]:entry["offset"] + array.nbytes] = array.tobytes()
+    header = {"version": TEMPLATE_BUNDLE_VERSION,
+              "dtype": np.dtype(dtype).str,
+              "refN": refN,
+              "sha256": hashlib.sha256(payload).hexdigest(),
+              "index": index}
+    header = json.dumps(header).encode()
+    header += b" " * (-(len(_bundle_magic) + 8 + len(header)) % 64)  # payload starts aligned
+    path = template_bundle_path(resource_folder, dtype)
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(_bundle_magic)
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        f.write(payload)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_template_bundle(path, verify=True):
+    """
+    memory maps a compiled template bundle (see compile_template_bundle)
+    :param path: path of the bundle
+    :param verify: whether to verify the checksum of the payload
+    :return: dictionary of type (see load_raw_MNI_data, and "anchors") to read-only array
+    """
+    with open(path, "rb") as f:
+        magic = f.read(len(_bundle_magic))
+        header_length = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = json.loads(f.read(header_length).decode())
+    if magic != _bundle_magic or header["version"] != TEMPLATE_BUNDLE_VERSION:
+        raise ValueError("incompatible template bundle: {}, recompile it using: python MNI.py --compile".format(path))
+    payload = np.memmap(path, dtype=np.uint8, mode="r", offset=len(_bundle_magic) + 8 + header_length)
+    if verify and hashlib.sha256(payload).hexdigest() != header["sha256"]:
+        raise ValueError("corrupted template bundle: {}, recompile it using: python MNI.py --compile".format(path))
+    return {entry["key"]: np.ndarray(entry["shape"], dtype=header["dtype"], buffer=payload, offset=entry["offset"])
+            for entry in header["index"]}
 
 
-def project(origin_xyz, others_xyz, selected_indices, output_errors=False, resource_folder="resource"):
+def project(origin_xyz, others_xyz, selected_indices, output_errors=False, resource_folder="resource",
+            surfaces=("head", "cortex"), workers=None, approximate_head=False, memoize=True):
     """
     projects others_xyz to MNI coordiantes given anchors in origin_xyz
     :param origin_xyz: anchors given as nx3 np array (n >= 4)
@@ -206,15 +843,35 @@ def project(origin_xyz, others_xyz, selected_indices, output_errors=False, resou
                               "t6", "o1", "o2"]
     :param output_errors: whether to output error in estimation as well.
     :param resource_folder: relative path to the folder with the raw template data
+    :param surfaces: which surfaces to project onto, any of "head", "cortex".
+                     outputs of surfaces not requested are None (cortex projection is the expensive one).
+    :param workers: number of threads used for the cortical projection (see map_reference_brains)
+    :param approximate_head: if true, the head projection uses the voxel lookup table (see TemplateStore.voxel_grid)
+    :param memoize: if false, the projection cache is bypassed (e.g. for one-off bulk projections)
     :return: otherH - others transformed to MNI of ideal head (head surface)
              otherC - others transformed to MNI of ideal head  (cortical surface)
              otherHSD - transformation standard deviation per axis, point manner (for otherH).
                         Last channel is SD across all axes (root sum of squares).
              otherCSD - transformation standard deviation per axis, point manner (for otherC).
                         Last channel is SD across all axes (root sum of squares).
+             transforms - refN x 4 x 4 affine transforms into every reference brain
+    note: results are memoized (see get_cached_projection)
     """
+    assert set(surfaces) <= {"head", "cortex"}, "unknown surfaces: {}".format(set(surfaces) - {"head", "cortex"})
+    if not memoize:
+        return _project(origin_xyz, others_xyz, selected_indices, output_errors, resource_folder, surfaces, workers,
+                        approximate_head)
+    key = projection_cache_key(origin_xyz, others_xyz, selected_indices, resource_folder, batch=False,
+                               output_errors=bool(output_errors), surfaces=tuple(sorted(surfaces)),
+                               approximate_head=bool(approximate_head))
+    return get_cached_projection(key, lambda: _project(origin_xyz, others_xyz, selected_indices, output_errors,
+                                                       resource_folder, surfaces, workers, approximate_head))
+
+
+def _project(origin_xyz, others_xyz, selected_indices, output_errors, resource_folder, surfaces, workers, approximate_head):
     resource_folder = str(resource_folder)
-    refN = 17  # number of reference brains
+    store = get_template_store(resource_folder)
+    refN = store.refN  # number of reference brains
     pointN = others_xyz.shape[0]  # number of sensors to project
     # get sensors transformed into reference brains coordinate systems
     transforms, others_transformed_to_ref, _ = find_affine_transforms(origin_xyz,
@@ -223,15 +880,22 @@ def project(origin_xyz, others_xyz, selected_indices, output_errors=False, resou
                                                                       refN,
                                                                       pointN,
                                                                       resource_folder)
-    # load head surface raw data
-    XYZ = load_raw_MNI_data(resource_folder+"/MNI_templates/xyzallHEM.npy", "head", resource_folder=resource_folder)
-    # get closest location of sensors on average head surface
-    otherH, otherHVar, otherHSD = find_closest_on_surface_naive(others_transformed_to_ref, XYZ, pointN, output_errors)
-    # get location of sensors projected onto reference cortical surface by inflating a rod
-    others_projected_to_ref = find_closest_on_surface_full(others_transformed_to_ref, refN, pointN, resource_folder=resource_folder)
-    XYZ = load_raw_MNI_data(resource_folder+"/MNI_templates/xyzallBEM.npy", "brain", resource_folder=resource_folder)
-    # get closest points of projected sensors on average cortical surface
-    otherC, otherCVar, otherCSD = find_closest_on_surface_naive(others_projected_to_ref, XYZ, pointN, output_errors)
+    otherH, otherHSD, otherC, otherCSD = None, None, None, None
+    if "head" in surfaces:
+        # load head surface raw data
+        XYZ = store.surface("head")
+        # get closest location of sensors on average head surface
+        voxel_grid = store.voxel_grid("head") if approximate_head else None
+        otherH, otherHVar, otherHSD = find_closest_on_surface_naive(others_transformed_to_ref, XYZ, pointN, output_errors,
+                                                                    tree=store.tree("head"), voxel_grid=voxel_grid)
+    if "cortex" in surfaces:
+        # get location of sensors projected onto reference cortical surface by inflating a rod
+        others_projected_to_ref = find_closest_on_surface_full(others_transformed_to_ref, refN, pointN, resource_folder=resource_folder,
+                                                               workers=workers)
+        XYZ = store.surface("brain")
+        # get closest points of projected sensors on average cortical surface
+        otherC, otherCVar, otherCSD = find_closest_on_surface_naive(others_projected_to_ref, XYZ, pointN, output_errors,
+                                                                    tree=store.tree("brain"))
     # test, _, _ = find_closest_on_surface_naive(others_transformed_to_ref, XYZ, pointN)
     # SSwsH = otherHVar * (refN - 1)
     # SSwsC = otherCVar * (refN - 1)
@@ -245,45 +909,98 @@ def project(origin_xyz, others_xyz, selected_indices, output_errors=False, resou
     return otherH, otherC, otherHSD, otherCSD, transforms
 
 
-def vectorized_loop(XYZ, othersRefList, i, pointN):
-    projectionListC = np.ones((pointN, 3))
-    P = np.expand_dims(othersRefList[i, :, :3], axis=1)
-    PP = np.broadcast_to(P, (pointN, XYZ.shape[0], 3))
-    D = np.linalg.norm(XYZ - PP, axis=2)
+def project_batch(origin_xyz, others_xyz, selected_indices, output_errors=False, resource_folder="resource",
+                  surfaces=("head", "cortex"), workers=None, approximate_head=False, memoize=True):
+    """
+    projects a batch of sensor clouds to MNI coordinates (see project). all affine fits are solved at once,
+    and the sensors of all clouds are projected onto the surfaces together.
+    :param origin_xyz: anchors given as bxnx3 np array (n >= 4)
+    :param others_xyz: optodes to project given as bxmx3 np array
+    :param selected_indices: which indices to select from origin_xyz as anchors (same for all clouds, see project)
+    :param output_errors: whether to output error in estimation as well.
+    :param resource_folder: relative path to the folder with the raw template data
+    :param surfaces: which surfaces to project onto, any of "head", "cortex" (see project)
+    :param workers: number of threads used for the cortical projection (see map_reference_brains)
+    :param approximate_head: if true, the head projection uses the voxel lookup table (see TemplateStore.voxel_grid)
+    :param memoize: if false, the projection cache is bypassed (e.g. for one-off bulk projections)
+    :return: otherH, otherC - b x m x 3 sensors projected onto the head / cortical surface
+             otherHSD, otherCSD - b x m x 4 transformation standard deviation (see project)
+             transforms - b x refN x 4 x 4 affine transforms into every reference brain
+    note: results are memoized (see get_cached_projection)
+    """
+    assert set(surfaces) <= {"head", "cortex"}, "unknown surfaces: {}".format(set(surfaces) - {"head", "cortex"})
+    if not memoize:
+        return _project_batch(origin_xyz, others_xyz, selected_indices, output_errors, resource_folder, surfaces, workers,
+                              approximate_head)
+    key = projection_cache_key(origin_xyz, others_xyz, selected_indices, resource_folder, batch=True,
+                               output_errors=bool(output_errors), surfaces=tuple(sorted(surfaces)),
+                               approximate_head=bool(approximate_head))
+    return get_cached_projection(key, lambda: _project_batch(origin_xyz, others_xyz, selected_indices, output_errors,
+                                                             resource_folder, surfaces, workers, approximate_head))
+
+
+def _project_batch(origin_xyz, others_xyz, selected_indices, output_errors, resource_folder, surfaces, workers,
+                   approximate_head):
+    resource_folder = str(resource_folder)
+    store = get_template_store(resource_folder)
+    refN = store.refN
+    batch_size, pointN = others_xyz.shape[:2]
+    transforms = find_affine_transforms_batch(origin_xyz, selected_indices, resource_folder)
+    others_hom = np.concatenate((others_xyz, np.ones((batch_size, pointN, 1))), axis=-1).astype(transforms.dtype, copy=False)
+    others_transformed_to_ref = np.einsum("bpi,brik->rbpk", others_hom, transforms)[..., :3]
+    # all clouds are flattened into one long list of sensors
+    others_transformed_to_ref = others_transformed_to_ref.reshape(refN, batch_size * pointN, 3)
+    otherH, otherHSD, otherC, otherCSD = None, None, None, None
+    if "head" in surfaces:
+        voxel_grid = store.voxel_grid("head") if approximate_head else None
+        otherH, _, otherHSD = find_closest_on_surface_naive(others_transformed_to_ref, store.surface("head"),
+                                                            batch_size * pointN, output_errors, tree=store.tree("head"),
+                                                            voxel_grid=voxel_grid)
+        otherH, otherHSD = otherH.reshape(batch_size, pointN, 3), otherHSD.reshape(batch_size, pointN, 4)
+    if "cortex" in surfaces:
+        others_projected_to_ref = find_closest_on_surface_full(others_transformed_to_ref, refN, batch_size * pointN,
+                                                               resource_folder=resource_folder, workers=workers)
+        otherC, _, otherCSD = find_closest_on_surface_naive(others_projected_to_ref, store.surface("brain"),
+                                                            batch_size * pointN, output_errors, tree=store.tree("brain"))
+        otherC, otherCSD = otherC.reshape(batch_size, pointN, 3), otherCSD.reshape(batch_size, pointN, 4)
+    return otherH, otherC, otherHSD, otherCSD, transforms
+
+
+def balloon_inflation(P, XYZ, tree):
+    """
+    vectorized balloon inflation (see find_closest_on_surface_full) of all sensors onto a single reference brain
+    :param P: pointN x 3 transformed sensor locations (into the ref brain)
+    :param XYZ: the cortical surface of the ref brain
+    :param tree: kd-tree over XYZ
+    :return: pointN x 3 locations of the sensors projected onto the cortical surface
+    """
     top = round(XYZ.shape[0] * 0.05)  # select 5% of data (original paper selects 1000 points)
-    IDtop = np.argpartition(D, top, axis=1)[:, :top]  # sort by lowest norm
+    Nclose = 200
+    _, IDtop = tree.query(P, k=top)  # sorted by distance from P
     XYZtop = XYZ[IDtop, :]
+    PNear = np.mean(XYZtop[:, :Nclose], axis=1)  # select mean of closest 200 points
+    # cross product the line P-PNear with the point and normalize gives exactly distance from line
+    line = np.expand_dims(PNear - P, axis=1)
+    distance_from_line = np.linalg.norm(np.cross(line, XYZtop - P[:, None, :]) / np.linalg.norm(line, axis=2, keepdims=True), axis=2)
+    # inflate the rod 1mm at a time until it contains a point, i.e. smallest integer radius >= closest distance
+    rodR = np.maximum(1, np.ceil(np.min(distance_from_line, axis=1)))
+    in_rod = distance_from_line <= rodR[:, None]
+    # Find brain surface points on the vicinity of P (l 862), XYZtop is already sorted by distance from P
+    NVic = 3
+    Vic = in_rod & (np.cumsum(in_rod, axis=1) <= NVic)
+    return np.sum(XYZtop * Vic[:, :, None], axis=1) / np.sum(Vic, axis=1, keepdims=True)
 
-    Nclose = 200
-    IDclose = np.argpartition(D, Nclose, axis=1)[:, :Nclose]  # sort by lowest norm
-    XYZclose = XYZ[IDclose, :]
-    PNear = np.mean(XYZclose, axis=1)  # select mean of closest 200 points
-    # Line between P and PNear
-    p1 = P
-    p2 = np.expand_dims(PNear, axis=1)
-    p3 = XYZtop
-    # cross product the line with the point and normalize gives exactly distance from line
-    distance_from_line = np.linalg.norm(np.cross(p2 - p1, p3 - p1) / np.linalg.norm(p2 - p1, axis=2, keepdims=True), axis=2)
-    condition = True
-    rod_radius = 0
-    while rod_radius < 100 and condition:
-        rod_radius += 1
-        test_rod_rad = np.where(distance_from_line <= rod_radius)
-        diff = np.setdiff1d(np.arange(pointN), np.unique(test_rod_rad[0]))
-        condition = len(diff) != 0
-        # assert len(diff) == 0, "no point were found on cortex with a rod radius of <= 1 mm for sensor index {}".format(diff)
-    for j in range(pointN):
-        indices = np.where(test_rod_rad[0] == 0)[0]
-        rod = XYZtop[j, test_rod_rad[1][indices]]
-        # Find brain surface points on the vicinity of P (l 862)
-        PPB = np.broadcast_to(P[j], rod.shape)
-        VicD = np.linalg.norm(rod - PPB, axis=1)
-        NVic = 3
-        if rod.shape[0] < NVic:
-            NVic = rod.shape[0]
-        IVicD = np.argsort(VicD)
-        NIVicD = IVicD[0:NVic]
-        Vic = rod[NIVicD, :]
-        CP = np.mean(Vic, axis=0)
-        projectionListC[j, :] = CP
-    return projectionListC
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='MNI template data utilities.')
+    parser.add_argument("--compile", action="store_true", help="compile the raw (csv) template data into a single bundle")
+    parser.add_argument("--dtype", choices=["float64", "float32"], default="float64", help="dtype of the compiled bundle")
+    parser.add_argument("--voxel_grid", action="store_true", help="build the head surface voxel lookup table")
+    parser.add_argument("--resource_folder", default="resource", help="folder with the raw template data")
+    args = parser.parse_args()
+    if args.compile:
+        print("compiled: {}".format(compile_template_bundle(args.resource_folder, np.dtype(args.dtype))))
+    if args.voxel_grid:
+        get_template_store(args.resource_folder).voxel_grid("head")
+        print("voxel grid is ready")
@@ -0,0 +1,278 @@
+import numpy as np
+import argparse
+import logging
+import time
+import os
+from pathlib import Path
+import file_io
+import config
+import geometry
+import MNI
+
+
+def timeit(func, repeats=5):
+    """
+    measures wall time of a function call
+    :param func: function with no arguments to time
+    :param repeats: number of calls to time (first call is discarded as warmup)
+    :return: the output of the last call and the median time in ms
+    """
+    output = func()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        output = func()
+        timings.append(time.perf_counter() - start)
+    return output, 1000 * np.median(timings)
+
+
+def get_example_projection_input(resource_folder="resource"):
+    """
+    loads the example model and prepares it for MNI projection
+    :param resource_folder: relative path to the folder with the raw template data
+    :return: anchors, sensors and selected indices of anchors (see MNI.project)
+    """
+    names, data, _, _ = file_io.read_template_file(Path(Path(__file__).parent.parent, "example_models", "example_model.txt"))
+    names, data = names[0], data[0]
+    data = geometry.to_standard_coordinate_system(names, data)
+    unsorted_origin_xyz = data[:names.index(0), :]
+    unsorted_origin_names = np.array(names[:names.index(0)])
+    others_xyz = data[names.index(0):, :]
+    target_origin_names = np.array(["nz", "iz", "rpa", "lpa",
+                                    "fp1", "fp2", "fz", "f3",
+                                    "f4", "f7", "f8", "cz",
+                                    "c3", "c4", "t3", "t4",
+                                    "pz", "p3", "p4", "t5",
+                                    "t6", "o1", "o2"])
+    selected_indices, sorting_indices = np.where(target_origin_names[:, None] == unsorted_origin_names[None, :])
+    return unsorted_origin_xyz[sorting_indices], others_xyz, selected_indices
+
+
+def get_example_sensors_in_ref(resource_folder="resource", sensors=100):
+    """
+    creates sensors from the example model (tiled with small noise) and transforms them into every reference brain
+    :param resource_folder: relative path to the folder with the raw template data
+    :param sensors: number of sensors
+    :return: refN x sensors x 3 transformed sensor locations
+    """
+    store = MNI.get_template_store(resource_folder)
+    origin_xyz, others_xyz, selected_indices = get_example_projection_input(resource_folder)
+    reps = int(np.ceil(sensors / len(others_xyz)))
+    others_xyz = np.tile(others_xyz, (reps, 1))[:sensors]
+    others_xyz = others_xyz + np.random.default_rng(0).normal(scale=0.1, size=others_xyz.shape)
+    _, others_transformed_to_ref, _ = MNI.find_affine_transforms(origin_xyz, others_xyz, selected_indices,
+                                                                 store.refN, sensors, resource_folder)
+    return others_transformed_to_ref
+
+
+def benchmark_surface_lookup(resource_folder="resource", sensors=100):
+    """
+    compares the brute force nearest surface lookup with the kd-tree one (head and cortex)
+    :param resource_folder: relative path to the folder with the raw template data
+    :param sensors: number of sensors to project (example model sensors are tiled with small noise)
+    """
+    store = MNI.get_template_store(resource_folder)
+    others_transformed_to_ref = get_example_sensors_in_ref(resource_folder, sensors)
+    for surface in ["head", "brain"]:
+        XYZ = store.surface(surface)
+        store.tree(surface)  # build or load the tree outside of the timing
+        naive, naive_time = timeit(lambda: MNI.find_closest_on_surface_naive(others_transformed_to_ref, XYZ, sensors)[0])
+        kd, kd_time = timeit(lambda: MNI.find_closest_on_surface_naive(others_transformed_to_ref, XYZ, sensors,
+                                                                       tree=store.tree(surface))[0])
+        logging.info("{} surface ({} points), {} sensors: brute force {:.2f}ms, kd-tree {:.2f}ms (x{:.1f}), "
+                     "identical: {}".format(surface, len(XYZ), sensors, naive_time, kd_time,
+                                            naive_time / kd_time, np.array_equal(naive, kd)))
+
+
+def benchmark_balloon_inflation(resource_folder="resource", sensors=100):
+    """
+    compares the per sensor balloon inflation loop with the vectorized kd-tree one (all reference brains)
+    :param resource_folder: relative path to the folder with the raw template data
+    :param sensors: number of sensors to project (example model sensors are tiled with small noise)
+    """
+    store = MNI.get_template_store(resource_folder)
+    others_transformed_to_ref = get_example_sensors_in_ref(resource_folder, sensors)
+    loop, loop_time = timeit(lambda: MNI.find_closest_on_surface_full(others_transformed_to_ref, store.refN, sensors,
+                                                                      resource_folder, use_kdtree=False), repeats=1)
+    kd, kd_time = timeit(lambda: MNI.find_closest_on_surface_full(others_transformed_to_ref, store.refN, sensors,
+                                                                  resource_folder, use_kdtree=True), repeats=3)
+    logging.info("balloon inflation, {} sensors: loop {:.2f}ms, kd-tree {:.2f}ms (x{:.1f}), max deviation: {:.2e}mm".format(
+        sensors, loop_time, kd_time, loop_time / kd_time, np.max(np.abs(loop - kd))))
+
+
+def benchmark_workers(resource_folder="resource", sensors=100, max_workers=None):
+    """
+    measures the cortical projection latency as a function of the number of threads projecting onto the reference brains
+    :param resource_folder: relative path to the folder with the raw template data
+    :param sensors: number of sensors to project (example model sensors are tiled with small noise)
+    :param max_workers: largest number of threads to measure (default: number of cores)
+    """
+    store = MNI.get_template_store(resource_folder)
+    others_transformed_to_ref = get_example_sensors_in_ref(resource_folder, sensors)
+    max_workers = max_workers or os.cpu_count()
+    serial, serial_time = timeit(lambda: MNI.find_closest_on_surface_full(others_transformed_to_ref, store.refN, sensors,
+                                                                          resource_folder, workers=1), repeats=3)
+    logging.info("cortical projection, {} sensors, 1 worker: {:.2f}ms".format(sensors, serial_time))
+    workers = 2
+    while workers <= max_workers:
+        parallel, parallel_time = timeit(lambda: MNI.find_closest_on_surface_full(others_transformed_to_ref, store.refN, sensors,
+                                                                                  resource_folder, workers=workers), repeats=3)
+        logging.info("cortical projection, {} sensors, {} workers: {:.2f}ms (x{:.1f}), identical: {}".format(
+            sensors, workers, parallel_time, serial_time / parallel_time, np.array_equal(serial, parallel)))
+        workers *= 2
+
+
+def benchmark_project_batch(resource_folder="resource", clouds=32):
+    """
+    compares projecting clouds one by one with projecting them as a batch (head surface)
+    :param resource_folder: relative path to the folder with the raw template data
+    :param clouds: number of clouds to project (example model with small noise)
+    """
+    origin_xyz, others_xyz, selected_indices = get_example_projection_input(resource_folder)
+    rng = np.random.default_rng(0)
+    origins_xyz = origin_xyz + rng.normal(scale=1, size=(clouds,) + origin_xyz.shape)
+    batch_others_xyz = others_xyz + rng.normal(scale=1, size=(clouds,) + others_xyz.shape)
+    loop, loop_time = timeit(lambda: np.stack([MNI.project(origins_xyz[i], batch_others_xyz[i], selected_indices,
+                                                           resource_folder=resource_folder, surfaces=("head",))[0]
+                                               for i in range(clouds)]))
+    batch, batch_time = timeit(lambda: MNI.project_batch(origins_xyz, batch_others_xyz, selected_indices,
+                                                         resource_folder=resource_folder, surfaces=("head",))[0])
+    logging.info("head projection, {} clouds: loop {:.2f}ms, batch {:.2f}ms (x{:.1f}), max deviation: {:.2e}mm".format(
+        clouds, loop_time, batch_time, loop_time / batch_time, np.max(np.abs(loop - batch))))
+
+
+def benchmark_voxel_grid(resource_folder="resource", sensors=100):
+    """
+    validation report of the approximate (voxel lookup table) head projection against the exact one:
+    deviation on the bundled projection test data (mni_projection_test.npz) and on noisy sensors, and timings
+    :param resource_folder: relative path to the folder with the raw template data
+    :param sensors: number of noisy sensors to project (example model sensors are tiled with small noise)
+    """
+    store = MNI.get_template_store(resource_folder)
+    voxel_grid = store.voxel_grid("head")
+    origin_xyz, others_xyz, selected_indices = get_example_projection_input(resource_folder)
+    expected = np.load(Path(resource_folder, "mni_projection_test.npz"))["name1"]
+    approximate = MNI.project(origin_xyz, others_xyz, selected_indices, resource_folder=resource_folder,
+                              surfaces=("head",), approximate_head=True)[0]
+    deviation = np.linalg.norm(approximate - expected, axis=1)
+    logging.info("mni_projection_test.npz ({} sensors): max deviation {:.3f}mm, mean deviation {:.3f}mm".format(
+        len(deviation), np.max(deviation), np.mean(deviation)))
+    others_transformed_to_ref = get_example_sensors_in_ref(resource_folder, sensors)
+    XYZ, tree = store.surface("head"), store.tree("head")
+    exact, exact_time = timeit(lambda: MNI.find_closest_on_surface_naive(others_transformed_to_ref, XYZ, sensors, tree=tree)[0])
+    approximate, approximate_time = timeit(lambda: MNI.find_closest_on_surface_naive(others_transformed_to_ref, XYZ, sensors,
+                                                                                     tree=tree, voxel_grid=voxel_grid)[0])
+    _, found = voxel_grid.lookup(np.mean(others_transformed_to_ref, axis=0))
+    deviation = np.linalg.norm(approximate - exact, axis=1)
+    logging.info("{} noisy sensors: max deviation {:.3f}mm, mean deviation {:.3f}mm, {} fell back to exact search".format(
+        sensors, np.max(deviation), np.mean(deviation), np.count_nonzero(~found)))
+    logging.info("head lookup, {} sensors: kd-tree {:.3f}ms, voxel grid {:.3f}ms (x{:.1f})".format(
+        sensors, exact_time, approximate_time, exact_time / approximate_time))
+
+
+def benchmark_differentiable_projection(resource_folder="resource", clouds=32):
+    """
+    measures the forward and backward pass latency of the differentiable (projection loss) MNI projection
+    with kd-tree and torch.cdist candidates
+    :param resource_folder: relative path to the folder with the raw template data
+    :param clouds: batch size (example model with small noise)
+    """
+    import torch
+    import torch_src.MNI_torch as MNI_torch
+    origin_xyz, others_xyz, selected_indices = get_example_projection_input(resource_folder)
+    rng = np.random.default_rng(0)
+    origin_xyz = torch.from_numpy(origin_xyz).float()
+    batch_others_xyz = torch.from_numpy(others_xyz + rng.normal(scale=1, size=(clouds,) + others_xyz.shape)).float()
+
+    def forward_backward(use_kdtree):
+        sensors = batch_others_xyz.clone().requires_grad_()
+        projected = MNI_torch.torch_project(origin_xyz, sensors, selected_indices, resource_folder, use_kdtree=use_kdtree)
+        projected.sum().backward()
+        return projected.detach()
+    kd, kd_time = timeit(lambda: forward_backward(True), repeats=3)
+    cdist, cdist_time = timeit(lambda: forward_backward(False), repeats=1)
+    logging.info("differentiable projection, {} clouds (forward + backward): kd-tree {:.2f}ms, cdist {:.2f}ms, "
+                 "max deviation: {:.2e}mm".format(clouds, kd_time, cdist_time, torch.max(torch.abs(kd - cdist)).item()))
+
+
+def clean_model_loop(names, data, threshold=0.3):
+    """
+    reference (pairwise loop) version of geometry.clean_model
+    """
+    indices = set()
+    anchors = data[:names.index(0)]
+    unfiltered_pc = data[names.index(0):]
+    for i in range(len(unfiltered_pc)):
+        for j in range(i+1, len(unfiltered_pc)):
+            if np.linalg.norm(unfiltered_pc[i] - unfiltered_pc[j]) <= threshold:
+                indices.add(j)
+    selected_indices = [x for x in range(len(unfiltered_pc)) if x not in indices]
+    data = np.vstack((anchors, unfiltered_pc[selected_indices]))
+    names = names[:names.index(0)] + [x for x in range(len(selected_indices))]
+    return names, data
+
+
+def get_synthetic_dense_model(points=10000, duplicates=0.2, seed=0):
+    """
+    creates a dense synthetic digitized model: evenly spread points on a 10cm head hemisphere (~3mm apart),
+    some of them digitized twice
+    :param points: number of unnamed points
+    :param duplicates: fraction of points that are near duplicates (less than 1mm away) of another point
+    :param seed: random seed
+    :return: names, data (nx3)
+    """
+    rng = np.random.default_rng(seed)
+    unique = int(points * (1 - duplicates))
+    # fibonacci lattice on the upper hemisphere
+    z = 1 - (np.arange(unique) + 0.5) / unique
+    theta = np.pi * (1 + 5 ** 0.5) * np.arange(unique)
+    pc = 10 * np.stack((np.sqrt(1 - z ** 2) * np.cos(theta), np.sqrt(1 - z ** 2) * np.sin(theta), z), axis=1)
+    doubles = pc[rng.integers(unique, size=points - unique)] + rng.uniform(-0.05, 0.05, size=(points - unique, 3))
+    pc = np.vstack((pc, doubles))[rng.permutation(points)]
+    anchors = np.array([[0, 10, 0], [-10, 0, 0], [10, 0, 0], [0, 0, 10.]])
+    return ["nz", "lpa", "rpa", "cz"] + list(range(points)), np.vstack((anchors, pc))
+
+
+def benchmark_clean_model(points=10000, reference_points=2000, threshold=0.1):
+    """
+    measures the kd-tree deduplication of a dense point cloud against the pairwise loop
+    :param points: number of points in the synthetic cloud
+    :param reference_points: number of points the (quadratic) pairwise loop is measured and compared on
+    :param threshold: duplicate distance threshold (cm)
+    """
+    names, data = get_synthetic_dense_model(points)
+    (clean_names, clean_data), kd_time = timeit(lambda: geometry.clean_model(names, data, threshold))
+    logging.info("clean model, {} points: kd-tree {:.2f}ms, {} points kept".format(points, kd_time, len(clean_names) - 4))
+    names, data = names[:reference_points + 4], data[:reference_points + 4]
+    (loop_names, loop_data), loop_time = timeit(lambda: clean_model_loop(names, data, threshold), repeats=1)
+    (kd_names, kd_data), kd_time = timeit(lambda: geometry.clean_model(names, data, threshold))
+    assert kd_names == loop_names and np.array_equal(kd_data, loop_data)
+    logging.info("clean model, {} points: loop {:.2f}ms, kd-tree {:.2f}ms (x{:.1f}), identical output".format(
+        reference_points, loop_time, kd_time, loop_time / kd_time))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks for the MNI projection pipeline.')
+    parser.add_argument("benchmark", choices=["surface_lookup", "balloon_inflation", "project_batch", "workers", "voxel_grid", "differentiable_projection", "clean_model"], help="which benchmark to run")
+    parser.add_argument("--sensors", type=int, default=100, help="number of sensors to project")
+    parser.add_argument("--max_workers", type=int, help="largest number of threads to measure")
+    parser.add_argument("--points", type=int, default=10000, help="number of points in the cloud to clean")
+    parser.add_argument("--clouds", type=int, default=32, help="number of point clouds to project")
+    parser.add_argument("--resource_folder", default="resource", help="folder with the raw template data")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    config.mni_projection_cache = False  # measure the projections themselves, not the memoized results
+    if args.benchmark == "surface_lookup":
+        benchmark_surface_lookup(args.resource_folder, args.sensors)
+    elif args.benchmark == "balloon_inflation":
+        benchmark_balloon_inflation(args.resource_folder, args.sensors)
+    elif args.benchmark == "project_batch":
+        benchmark_project_batch(args.resource_folder, args.clouds)
+    elif args.benchmark == "workers":
+        benchmark_workers(args.resource_folder, args.sensors, args.max_workers)
+    elif args.benchmark == "voxel_grid":
+        benchmark_voxel_grid(args.resource_folder, args.sensors)
+    elif args.benchmark == "differentiable_projection":
+        benchmark_differentiable_projection(args.resource_folder, args.clouds)
+    elif args.benchmark == "clean_model":
+        benchmark_clean_model(args.points)
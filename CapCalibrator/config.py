@@ -11,3 +11,12 @@ all_possible_anchor_names = ["nz", "iz", "rpa", "lpa",
                              "pz", "p3", "p4", "t5",
                              "t6", "o1", "o2","lefteye",
                              "righteye", "nosetip"]  # "left_triangle", "right_triangle", "middle_triangle" - these are on cap, and thus are not anchors
+
+mni_projection_workers = 1  # threads used to project onto the reference brains in parallel (0 = all cores)
+mni_dtype = "float64"  # dtype of the MNI templates and projection computations ("float32" halves memory bandwidth)
+mni_projection_cache = True  # memoize MNI projections (in memory LRU and on disk)
+mni_projection_cache_folder = "cache/mni_projections"  # on disk projection cache (relative to CapCalibrator), None disables it
+mni_projection_cache_folder_bytes = 2 ** 30  # size bound of the on disk projection cache, least recently used files are removed (None = unbounded)
+template_file_cache = True  # memoize parsed template / digitizer files by content (in memory and on disk)
+template_file_cache_folder = "cache/templates"  # on disk parsed file cache (relative to CapCalibrator), None disables it
+template_file_cache_folder_bytes = 2 ** 27  # size bound of the on disk parsed file cache, least recently used files are removed (None = unbounded)
@@ -1,5 +1,6 @@
 import numpy as np
 import geometry
+import MNI
 from file_io import read_template_file, read_digitizer_multi_noptodes_experiment_file
 import re
 import logging
@@ -12,49 +13,57 @@ import torch
 import draw
 import cv2
 import gsoup
+import time
+import multiprocessing
+import logging.handlers
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
-def do_network_robustness_test(sticker_locations, args):
+def get_network_robustness(sticker_locations, network, device, noise_mag_list, trials=10, batch_size=32):
+    """
+    measures how much network predictions change when uniform noise is added to the annotation. all perturbed copies
+    (noise levels x trials x batch) are preprocessed and predicted together.
+    :param sticker_locations: b x 10 x 14 original locations as marked by the user / AI in the GUI
+    :param network: the network
+    :param device: the device to run on
+    :param noise_mag_list: noise ranges (pixels), noise is sampled uniformly in [-range / 2, range / 2]
+    :param trials: number of noisy copies per noise range
+    :param batch_size: number of samples forwarded at once (see predict.predict_parameters)
+    :return: levels x 3 euler angle error (norm over the batch, mean over trials, degrees)
+    """
+    noise_mag = np.array(noise_mag_list, dtype=float).reshape(-1, 1, 1, 1, 1)
+    perturbed = np.repeat(np.repeat(sticker_locations[None, None], len(noise_mag), axis=0), trials, axis=1)
+    perturbed += (np.random.random_sample(perturbed.shape) * noise_mag) - noise_mag / 2
+    perturbed[:, :, sticker_locations == 0] = 0  # missing stickers stay missing
+    samples = np.concatenate((sticker_locations[None], perturbed.reshape((-1,) + sticker_locations.shape)))
+    predict.preprocess_sticker_locations(samples)
+    y_predict = predict.predict_parameters(samples, network, device, batch_size)
+    rot, _ = predict.parameters_to_rigid_transform(y_predict.reshape(-1, y_predict.shape[-1]), network.opt.scale_faces)
+    euler = R.from_matrix(rot).as_euler('xyz', degrees=True).reshape(y_predict.shape[:-1] + (3,))
+    orig_euler, euler = euler[0], euler[1:].reshape(perturbed.shape[:3] + (3,))
+    return np.mean(np.linalg.norm(orig_euler - euler, axis=2), axis=1)
+
+
+def do_network_robustness_test(sticker_locations, args, noise_mag_list=(1, 2, 3, 4, 5, 6, 7, 8, 9, 10), trials=10):
     """
     reports results of network robustness to various noises introduced to annotation
     :param sticker_locations: the original locations as marked by the user / AI in the GUI
     :param args: args
+    :param noise_mag_list: noise ranges (pixels) to test
+    :param trials: number of noisy copies per noise range
     :return:
     """
     robustness_file = Path("cache/robustness.npy")
-    noise_mag_list = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
     if robustness_file.is_file():
         t_r_rmse = np.load(robustness_file)
     else:
-        orig_r_matrix, orig_s_matrix = predict.predict_rigid_transform(np.copy(sticker_locations), None, args)
-        orig_euler = [R.from_matrix(x).as_euler('xyz', degrees=True) for x in orig_r_matrix]
-        t_r_rmse = []
-        t_s_rmse = []
-        b_shape = sticker_locations.shape[0]
-        t_shape = sticker_locations.shape[1]
-        for j in range(len(noise_mag_list)):
-            r_rmse = []
-            s_rmse = []
-            for i in range(10):
-                sticker_locations_copy = np.copy(sticker_locations)
-                another_view = np.reshape(sticker_locations_copy, (b_shape, t_shape, sticker_locations_copy.shape[-1] // 2, 2))
-                zero_locs = np.where(another_view == np.array([0, 0]))
-                noise_mag = noise_mag_list[j]
-                noise_shift = noise_mag / 2
-                noise = (np.random.random_sample(sticker_locations_copy.shape) * noise_mag) - noise_shift
-                sticker_locations_copy += noise
-                another_view[zero_locs] = 0
-                r_matrix, s_matrix = predict.predict_rigid_transform(sticker_locations_copy, None, args)
-                euler = [R.from_matrix(x).as_euler('xyz', degrees=True) for x in r_matrix]
-                r_rmse.append(np.linalg.norm(np.array(orig_euler) - np.array(euler), axis=0))
-                s_rmse.append(np.linalg.norm(np.array(orig_s_matrix) - np.array(s_matrix)))
-            t_r_rmse.append(np.mean(r_rmse, axis=0))
-            t_s_rmse.append(np.mean(s_rmse))
-        t_r_rmse = np.array(t_r_rmse)
+        network = predict.load_storm_net(args.storm_net, args.device)
+        t_r_rmse = get_network_robustness(sticker_locations, network, args.device, noise_mag_list, trials)
         np.save(robustness_file, t_r_rmse)
     draw.plot_robustness(np.array(noise_mag_list), t_r_rmse)
 
 
-def do_opt2dig_experiment(digi_ses1, digi_ses2, grid_search, rots, scales, video_names):
+def do_opt2dig_experiment(digi_ses1, digi_ses2, grid_search, rots, scales, video_names,
+                          index_path="cache/session1_opt_MNI.index.npz"):
     """
     reports results given grid search on parameter space and digitizer sessions
     (and rots / scales usedto achieve optimum)
@@ -64,13 +73,12 @@ def do_opt2dig_experiment(digi_ses1, digi_ses2, grid_search, rots, scales, video
     :param rots: the rots used for grid_search
     :param scales: the scales used grid_search
     :param video_names: names of videos for printing
+    :param index_path: path of the nearest neighbour index over grid_search (built once, see geometry.ProjectionBankIndex)
     :return:
     """
     subject_names = [x.split("_")[0] for x in video_names[::3]]
     # net_rots_ses1 = [x for x in net_rots[::3]]
     # net_rots_ses2 = [x for x in net_rots[1::3]]
-    errors_ses1 = []
-    errors_ses2 = []
     real_errors_ses1 = []
     real_errors_ses2 = []
     cross_error_12 = []
@@ -78,16 +86,14 @@ def do_opt2dig_experiment(digi_ses1, digi_ses2, grid_search, rots, scales, video
     # ses1 = opt_ses1.copy()
     # ses2 = opt_ses1.copy()
     # output_scales = []
-    for i in range(len(digi_ses1[1])):
-        inter_method_rmse1 = geometry.batch_get_rmse(digi_ses1[1][i], grid_search)
-        inter_method_rmse2 = geometry.batch_get_rmse(digi_ses2[1][i], grid_search)
-        # inter_method_rmse1 = [geometry.get_rmse(x, digi_ses1[1][i]) for x in opt_ses1[1]]
-        # inter_method_rmse2 = [geometry.get_rmse(x, digi_ses2[1][i]) for x in opt_ses2[1]]
-        errors_ses1.append(inter_method_rmse1)
-        errors_ses2.append(inter_method_rmse2)
-    for i, (error1, error2) in enumerate(zip(errors_ses1, errors_ses2)):
-        min_error_index1 = np.argmin(error1).astype(np.int)
-        min_error1 = error1[min_error_index1]
+    # closest grid search candidate of every subject in both sessions, in one batched index query
+    subjects = len(digi_ses1[1])
+    index = geometry.get_projection_bank_index(grid_search, index_path)
+    min_error_indices, min_errors = index.query(grid_search, np.concatenate((np.asarray(digi_ses1[1]),
+                                                                             np.asarray(digi_ses2[1]))))
+    for i in range(subjects):
+        min_error_index1 = min_error_indices[i]
+        min_error1 = min_errors[i]
         logging.info("session: {}, subject: {}, min error: {}, rot: {}, scale: {}".format(1,
                                                                                           subject_names[i],
                                                                                           min_error1,
@@ -98,8 +104,8 @@ def do_opt2dig_experiment(digi_ses1, digi_ses2, grid_search, rots, scales, video
         real_errors_ses1.append([min_error_index1, min_error1])
         # ses1[1][i] = opt_ses1[1][min_error_index]
         # output_scales.append(scales[min_error_index])
-        min_error_index2 = np.argmin(error2).astype(np.int)
-        min_error2 = error2[min_error_index2]
+        min_error_index2 = min_error_indices[subjects + i]
+        min_error2 = min_errors[subjects + i]
         logging.info("session: {}, subject: {}, min error: {}, rot: {}, scale: {}".format(2,
                                                                                           subject_names[i],
                                                                                           min_error2,
@@ -147,7 +153,6 @@ def do_parameter_grid_search_experiment(opt):
     :return:
     """
     random_grid_space_size = 500000
-    splits = 5
     names, data, format, _ = read_template_file(opt.template)
     names = names[0]
     data = data[0]
@@ -156,103 +161,323 @@ def do_parameter_grid_search_experiment(opt):
     others_names = output_others_names #+ names[names.index(0):]
     origin_names = ["lpa", "rpa", "nz", "cz"]
     full_names = origin_names + others_names
-    cached_result_ses1 = "cache/session1_opt_MNI"
-    recreate_files = False
-    for i in range(splits):
-        name1 = cached_result_ses1 + str(i)
-        if not Path(name1 + ".npy").is_file():
-            recreate_files = True
-    ses1_list = []
-    if recreate_files:
-        # perform random grid search
-        sessions = []
-        np.random.seed(42)
-        if Path("cache/rots").is_file() and Path("cache/scales").is_file():
-            rots = np.load("cache/rots.npy", allow_pickle=True)
-            scales = np.load("cache/scales.npy", allow_pickle=True)
-        else:
-            rx = np.random.rand(random_grid_space_size) * 14 - 7
-            ry = np.random.rand(random_grid_space_size) * 14 - 7
-            rz = np.random.rand(random_grid_space_size) * 14 - 7
-            sx = np.random.rand(random_grid_space_size) * 0.6 + 0.7
-            sy = np.random.rand(random_grid_space_size) * 0.6 + 0.7
-            sz = np.random.rand(random_grid_space_size) * 0.6 + 0.7
-            scales = np.array([sx, sy, sz]).T
-            rots = np.array([rx, ry, rz]).T
-            # save grid search parameters
-            np.save("cache/rots", rots)
-            np.save("cache/scales", scales)
-        from scipy.spatial.transform import Rotation as R
-        rot_grid_search = [R.from_euler('xyz', rots[i], degrees=True).as_matrix() for i in range(len(rots))]
-        scale_grid_search = [np.diag(scales[i]) for i in range(len(scales))]
-        origin_selector = tuple([names.index(x) for x in origin_names])
-        others_selector = tuple([names.index(x) for x in others_names])
-        origin = data[origin_selector, :]
-        others = data[others_selector, :]
-        # apply rotation and scale (batched version)
-        transformed_others = (np.array(rot_grid_search) @ (np.array(scale_grid_search) @ others.T)).transpose(0, 2, 1)
-        # for rot, scale in zip(rot_grid_search, scale_grid_search):
-        #
-        #     others = (rot @ (scale @ others.T)).T  # apply transform before MNI projection
-        #     sessions.append([full_names, np.vstack((origin, others))])
-        for split in range(splits):
-            min_range = (random_grid_space_size // splits)*(split)
-            max_range = (random_grid_space_size // splits)*(split+1)
-            # project to MNI every split
-            # all_sensors = np.array([sessions[i][1] for i in range(min_range, max_range)])
-            anchors = origin  # same anchors for all experiments...
-            sensors = transformed_others[min_range:max_range, :, :]
-            sorted_anchors, indices = geometry.sort_anchors(np.array(origin_names), anchors)
-            device = opt.device
-            origin_xyz_torch = torch.from_numpy(sorted_anchors).float().to(device)
-            sensors_xyz_torch = torch.from_numpy(sensors).float().to(device)
-            selected_indices_torch = torch.from_numpy(indices).to(device)
-            torch_mni, _, _ = MNI_torch.torch_project_non_differentiable(origin_xyz_torch,
-                                                                         sensors_xyz_torch,
-                                                                         selected_indices_torch,
-                                                                         output_errors=False)
-
-            # vid_projected_ses1 = geometry.project_sensors_to_MNI(sessions[0][min_range:max_range], origin_names)
-            # vid_ss_data_ses1 = np.array([x[1] for x in vid_projected_ses1], dtype=np.object)
-            np_mni = torch_mni.cpu().numpy()
-            np.save(cached_result_ses1+str(split), np_mni)
-            ses1_list.append(np_mni)
-    else:
+    cached_result_ses1 = "cache/session1_opt_MNI.npy"
+    # perform random grid search
+    np.random.seed(42)
+    if Path("cache/rots.npy").is_file() and Path("cache/scales.npy").is_file():
         rots = np.load("cache/rots.npy", allow_pickle=True)
         scales = np.load("cache/scales.npy", allow_pickle=True)
-        for i in range(splits):
-            name1 = cached_result_ses1 + str(i)
-            ses1_list.append(np.load(name1 + ".npy", allow_pickle=True))
-    vid_ss_data_ses1 = np.vstack(ses1_list).astype(np.float)
+    else:
+        rx = np.random.rand(random_grid_space_size) * 14 - 7
+        ry = np.random.rand(random_grid_space_size) * 14 - 7
+        rz = np.random.rand(random_grid_space_size) * 14 - 7
+        sx = np.random.rand(random_grid_space_size) * 0.6 + 0.7
+        sy = np.random.rand(random_grid_space_size) * 0.6 + 0.7
+        sz = np.random.rand(random_grid_space_size) * 0.6 + 0.7
+        scales = np.array([sx, sy, sz]).T
+        rots = np.array([rx, ry, rz]).T
+        # save grid search parameters
+        np.save("cache/rots", rots)
+        np.save("cache/scales", scales)
+    rot_grid_search = R.from_euler('xyz', rots, degrees=True).as_matrix()
+    origin_selector = tuple([names.index(x) for x in origin_names])
+    others_selector = tuple([names.index(x) for x in others_names])
+    origin = data[origin_selector, :]
+    others = data[others_selector, :]
+    # apply rotation and scale (batched version)
+    transformed_others = (rot_grid_search @ (scales[:, :, None] * others.T)).transpose(0, 2, 1)
+    anchors = origin  # same anchors for all experiments...
+    sorted_anchors, indices = geometry.sort_anchors(np.array(origin_names), anchors)
+    device = opt.device
+    origin_xyz_torch = torch.from_numpy(sorted_anchors).float().to(device)
+    selected_indices_torch = torch.from_numpy(indices).to(device)
+    # project to MNI in chunks that fit in memory, resumes from the cached result if it was interrupted
+    torch_mni = MNI_torch.torch_project_non_differentiable_chunked(origin_xyz_torch,
+                                                                   transformed_others,
+                                                                   selected_indices_torch,
+                                                                   cached_result_ses1)
+    vid_ss_data_ses1 = np.asarray(torch_mni).astype(np.float64)
     # output_selector = tuple([full_names.index(x) for x in output_others_names])
     return output_others_names, vid_ss_data_ses1, rots, scales
 
 
+def do_streaming_grid_search_experiment(opt, digi_ses1, digi_ses2, video_names, coarse_to_fine=True):
+    """
+    same as do_parameter_grid_search_experiment followed by do_opt2dig_experiment, but the grid search is streamed:
+    candidates are projected in chunks and immediately compared to all digitizer sessions, keeping only the best ones
+    (see geometry.grid_search_rigid_transforms)
+    :param opt: command line options
+    :param digi_ses1: digitizer session1
+    :param digi_ses2: digitizer session2
+    :param video_names: names of videos for printing
+    :param coarse_to_fine: if true, a small random search is refined around the best candidates of every subject,
+                           otherwise all 500000 random candidates are projected
+    :return: parameters sxkx6 (rx, ry, rz, sx, sy, sz), errors sxk and projected sensors sxkxmx3 of the best candidates
+             per session and subject (session1 subjects first, then session2 subjects)
+    """
+    names, data, format, _ = read_template_file(opt.template)
+    names = names[0]
+    data = data[0]
+    data = geometry.to_standard_coordinate_system(names, data)
+    others_names = ["fp1", "fp2", "fpz", "o1", "o2", "oz", "f7", "f8"]
+    origin_names = ["lpa", "rpa", "nz", "cz"]
+    origin = data[tuple([names.index(x) for x in origin_names]), :]
+    others = data[tuple([names.index(x) for x in others_names]), :]
+    sorted_anchors, indices = geometry.sort_anchors(np.array(origin_names), origin)
+
+    def project(parameters):
+        rot_grid_search = R.from_euler('xyz', parameters[:, :3], degrees=True).as_matrix()
+        transformed_others = (rot_grid_search @ (parameters[:, 3:, None] * others.T)).transpose(0, 2, 1)
+        _, otherC, _, _, _ = MNI.project_batch(np.repeat(sorted_anchors[None], len(parameters), axis=0),
+                                               transformed_others, indices, output_errors=False,
+                                               surfaces=("cortex",), memoize=False)
+        return otherC
+    subjects = len(digi_ses1[1])
+    targets = np.concatenate((np.asarray(digi_ses1[1]), np.asarray(digi_ses2[1])))
+    if coarse_to_fine:
+        parameters, errors, projected = geometry.grid_search_rigid_transforms(project, targets, candidates=5000,
+                                                                              refine_levels=10)
+    else:
+        parameters, errors, projected = geometry.grid_search_rigid_transforms(project, targets, candidates=500000)
+    subject_names = [x.split("_")[0] for x in video_names[::3]]
+    cross_errors = {"1->2": [], "2->1": []}
+    for i in range(subjects):
+        for session, j, cross_session, other in ((1, i, "1->2", digi_ses2), (2, subjects + i, "2->1", digi_ses1)):
+            logging.info("session: {}, subject: {}, min error: {}, rot: {}, scale: {}".format(session,
+                                                                                              subject_names[i],
+                                                                                              errors[j, 0],
+                                                                                              parameters[j, 0, :3],
+                                                                                              parameters[j, 0, 3:]))
+            cross_error = geometry.get_rmse(projected[j, 0], other[1][i])
+            logging.info("session: {}, subject: {}, min error: {}, rot: {}, scale: {}".format(cross_session,
+                                                                                              subject_names[i],
+                                                                                              cross_error,
+                                                                                              parameters[j, 0, :3],
+                                                                                              parameters[j, 0, 3:]))
+            cross_errors[cross_session].append(cross_error)
+    logging.info("ses1 optimal inter-validation error: {}".format(np.mean(errors[:subjects, 0])))
+    logging.info("ses2 optimal inter-validation error: {}".format(np.mean(errors[subjects:, 0])))
+    logging.info("ses2 optimal error with ses1 parameters: {}".format(np.mean(cross_errors["1->2"])))
+    logging.info("ses1 optimal error with ses2 parameters: {}".format(np.mean(cross_errors["2->1"])))
+    return parameters, errors, projected
+
+
+class ExperimentNode:
+    """
+    a single step of an experiment graph: function(*inputs, **kwargs) produces outputs
+    """
+    def __init__(self, name, function, inputs=(), outputs=(), kwargs=None, main_process=False):
+        """
+        :param name: unique name of the node
+        :param function: a module level function (it is pickled to a worker process)
+        :param inputs: names of artifacts passed positionally to function
+        :param outputs: names of artifacts the return value is unpacked into (a single name gets the whole value)
+        :param kwargs: constant keyword arguments
+        :param main_process: if true, node runs in the calling process (interactive viewers and plots must not be
+                             opened from worker processes)
+        """
+        self.name = name
+        self.function = function
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.kwargs = kwargs if kwargs is not None else {}
+        self.main_process = main_process
+
+
+def _run_experiment_node(function, inputs, kwargs):
+    """
+    runs a node and times it
+    :return: the return value of the node and its start and end time (seconds since epoch)
+    """
+    start = time.time()
+    result = function(*inputs, **kwargs)
+    return result, start, time.time()
+
+
+def _init_experiment_worker(log_queue, log_level):
+    """
+    spawned workers start with an unconfigured root logger, forward their records to the parent instead
+    :param log_queue: queue read by the parent (see _ParentLogHandler)
+    :param log_level: the effective level of the parent root logger
+    """
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(log_level)
+
+
+class _ParentLogHandler(logging.Handler):
+    """
+    hands records received from workers to the parent loggers (and so to whatever handlers main.py configured)
+    """
+    def emit(self, record):
+        logger = logging.getLogger(record.name)
+        if logger.isEnabledFor(record.levelno):
+            logger.handle(record)
+
+
+def _store_experiment_outputs(node, result, artifacts):
+    if len(node.outputs) == 1:
+        artifacts[node.outputs[0]] = result
+    elif len(node.outputs) > 1:
+        assert len(result) == len(node.outputs), "node {} returned {} values, expected {}".format(
+            node.name, len(result), len(node.outputs))
+        artifacts.update(zip(node.outputs, result))
+
+
+def get_critical_path(nodes, timings):
+    """
+    finds the chain of dependent nodes with the longest total run time
+    :param nodes: list of ExperimentNode (in any order)
+    :param timings: dict of node name -> (start, end)
+    :return: list of node names along the critical path, and its length in seconds
+    """
+    producer = {output: node.name for node in nodes for output in node.outputs}
+    parents = {node.name: {producer[x] for x in node.inputs if x in producer} for node in nodes}
+    length, previous = {}, {}
+    for name in sorted(timings, key=lambda x: timings[x][1]):  # a node always ends after its parents
+        parent = max(parents[name], key=lambda x: length[x], default=None)
+        length[name] = timings[name][1] - timings[name][0] + (length[parent] if parent else 0)
+        previous[name] = parent
+    name = max(length, key=length.get, default=None)
+    path = []
+    while name:
+        path.append(name)
+        name = previous[name]
+    return path[::-1], sum(timings[x][1] - timings[x][0] for x in path)
+
+
+def log_experiment_timings(nodes, timings, wall_time):
+    """
+    logs a per node timing summary of an experiment graph run
+    :param nodes: list of ExperimentNode
+    :param timings: dict of node name -> (start, end)
+    :param wall_time: total time the graph took to run (seconds)
+    """
+    origin = min((x[0] for x in timings.values()), default=0)
+    logging.info("{:<32}{:>10}{:>10}{:>10}".format("experiment", "start", "end", "seconds"))
+    for name, (start, end) in sorted(timings.items(), key=lambda x: x[1][0]):
+        logging.info("{:<32}{:>10.1f}{:>10.1f}{:>10.1f}".format(name, start - origin, end - origin, end - start))
+    path, path_length = get_critical_path(nodes, timings)
+    total = sum(end - start for start, end in timings.values())
+    logging.info("wall time: {:.1f}s, sum of node times: {:.1f}s, critical path: {:.1f}s ({})".format(
+        wall_time, total, path_length, " -> ".join(path)))
+
+
+def run_experiment_graph(nodes, artifacts, workers=None):
+    """
+    runs a graph of experiments, independent nodes run concurrently in a process pool.
+    nodes are scheduled as soon as all their inputs are available.
+    :param nodes: list of ExperimentNode
+    :param artifacts: dict of initial artifacts (name -> value), must be picklable
+    :param workers: number of worker processes (default: number of cores)
+    :return: dict of all artifacts (initial and produced), dict of node name -> (start, end) times
+    """
+    artifacts = dict(artifacts)
+    producer = {}
+    for node in nodes:
+        for output in node.outputs:
+            assert output not in producer and output not in artifacts, "artifact {} is produced twice".format(output)
+            producer[output] = node.name
+    for node in nodes:
+        for x in node.inputs:
+            assert x in producer or x in artifacts, "node {} requires unknown artifact {}".format(node.name, x)
+    assert len({node.name for node in nodes}) == len(nodes), "node names must be unique"
+    pending = list(nodes)
+    running = {}
+    timings = {}
+    graph_start = time.time()
+    # spawn: workers must not inherit an initialized cuda context
+    context = multiprocessing.get_context("spawn")
+    log_queue = context.Queue()
+    log_listener = logging.handlers.QueueListener(log_queue, _ParentLogHandler())
+    log_listener.start()
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_experiment_worker,
+                                   initargs=(log_queue, logging.getLogger().getEffectiveLevel()))
+    try:
+        while pending or running:
+            ready = [node for node in pending if all(x in artifacts for x in node.inputs)]
+            for node in ready:
+                pending.remove(node)
+                if not node.main_process:
+                    logging.info("starting experiment {}".format(node.name))
+                    inputs = [artifacts[x] for x in node.inputs]
+                    running[executor.submit(_run_experiment_node, node.function, inputs, node.kwargs)] = node
+            main_ready = [node for node in ready if node.main_process]
+            for node in main_ready:  # workers are already busy with everything else that is ready
+                logging.info("starting experiment {}".format(node.name))
+                result, start, end = _run_experiment_node(node.function, [artifacts[x] for x in node.inputs], node.kwargs)
+                _store_experiment_outputs(node, result, artifacts)
+                timings[node.name] = (start, end)
+            if main_ready:
+                continue
+            assert running, "experiment graph has a cycle: {}".format([node.name for node in pending])
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                node = running.pop(future)
+                result, start, end = future.result()
+                _store_experiment_outputs(node, result, artifacts)
+                timings[node.name] = (start, end)
+                logging.info("experiment {} done ({:.1f}s)".format(node.name, end - start))
+    finally:
+        executor.shutdown()
+        log_listener.stop()
+    log_experiment_timings(nodes, timings, time.time() - graph_start)
+    return artifacts, timings
+
+
+def get_experiment_graph():
+    """
+    :return: the experiments reported in manuscript as a list of ExperimentNode
+    """
+    return [
+        # ExperimentNode("network_robustness", do_network_robustness_test, ["sticker_locations", "args"],
+        #                main_process=True),  # shows a plot
+        ExperimentNode("predict", predict.predict_rigid_transform, ["sticker_locations", "preloaded_model", "args"],
+                       ["r_matrix", "s_matrix"]),
+        # ExperimentNode("parameter_grid_search", do_parameter_grid_search_experiment, ["args"],
+        #                ["grid_search_sensor_names", "grid_search_xyz", "grid_search_rots", "grid_search_scales"]),
+        # ExperimentNode("MNI_sensitivity", do_MNI_sensitivity_experiment, ["template"]),
+        # ExperimentNode("digi_error", do_digi_error_experiment),
+        ExperimentNode("dig2dig", do_dig2dig_experiment, ["template", "ground_truth"],
+                       ["dig_ses1", "dig_ses2", "all_digi_sessions", "digi_r_matrix"],
+                       {"save_results": True, "load_results": False}),
+        # ExperimentNode("opt2dig", do_opt2dig_experiment,
+        #                ["dig_ses1", "dig_ses2", "grid_search_xyz", "grid_search_rots", "grid_search_scales", "video_names"]),
+        # ExperimentNode("streaming_grid_search", do_streaming_grid_search_experiment,
+        #                ["args", "dig_ses1", "dig_ses2", "video_names"]),
+        # ExperimentNode("vid2vid_project_afterMNI", do_vid2vid_project_afterMNI_experiment,
+        #                ["template", "video_names", "r_matrix", "s_matrix"], ["vid_ses1", "vid_ses2"]),
+        ExperimentNode("vid2vid", do_vid2vid_experiment, ["args", "video_names", "r_matrix", "s_matrix"],
+                       ["vid_ses1", "vid_ses2"], {"save_results": True, "load_results": False}),
+        ExperimentNode("vid2dig", do_vid2dig_experiment, ["dig_ses1", "dig_ses2", "vid_ses1", "vid_ses2"],
+                       ["dig_intra", "vid_intra", "inter", "per_landmark"]),
+        ExperimentNode("shift_2024", do_shift_experiment_2024, ["r_matrix", "digi_r_matrix", "args"]),
+        ExperimentNode("shift", do_shift_experiment, ["r_matrix", "all_digi_sessions", "args"]),
+        ExperimentNode("brain_error_visualization", do_brain_error_visualization_experiment,
+                       ["vid_ses1", "per_landmark"], main_process=True),  # opens a viewer
+        ExperimentNode("histogram", do_histogram_experiment, ["dig_ses1", "dig_ses2", "vid_ses1", "vid_ses2"],
+                       main_process=True),  # shows a plot
+        ExperimentNode("skull_size", do_skull_size_experiment, ["dig_intra", "vid_intra", "inter", "args"],
+                       main_process=True),  # shows a plot
+        # ExperimentNode("old", do_old_experiment, ["r_matrix", "s_matrix", "video_names", "args"],
+        #                main_process=True),  # shows plots
+    ]
+
+
 def reproduce_experiments(video_names, sticker_locations, args):
     """
-    reproduces original experiments reported in manuscript, results are printed to log or plotted where applicable
-    :param r_matrix: see caller
-    :param s_matrix: see caller
+    reproduces original experiments reported in manuscript, results are printed to log or plotted where applicable.
+    experiments that do not depend on each other run concurrently (see get_experiment_graph).
     :param video_names: see caller
+    :param sticker_locations: see caller
     :param args: see caller
     :return: -
     """
-    # do_network_robustness_test(sticker_locations, args)
-    r_matrix, s_matrix = predict.predict_rigid_transform(sticker_locations, None, args)
-    # grid_search_sensor_names, grid_search_xyz, grid_search_rots, grid_search_scales = do_parameter_grid_search_experiment(args)
-    # do_MNI_sensitivity_experiment(args.template)
-    # do_digi_error_experiment()
-    dig_ses1, dig_ses2, all_digi_sessions, digi_r_matrix = do_dig2dig_experiment(args.template, args.ground_truth, save_results=True, load_results=False)
-    # do_opt2dig_experiment(dig_ses1, dig_ses2, grid_search_xyz, grid_search_rots, grid_search_scales, video_names)
-    # vid_ses1, vid_ses2 = do_vid2vid_project_afterMNI_experiment(args.template, video_names, r_matrix, s_matrix)
-    vid_ses1, vid_ses2 = do_vid2vid_experiment(args, video_names, r_matrix, s_matrix, save_results=True, load_results=False)
-    dig_intra, vid_intra, inter, per_landmark = do_vid2dig_experiment(dig_ses1, dig_ses2, vid_ses1, vid_ses2)
-    do_shift_experiment_2024(r_matrix, digi_r_matrix, args)
-    do_shift_experiment(r_matrix, all_digi_sessions, args)
-    do_brain_error_visualization_experiment(vid_ses1, per_landmark)
-    do_histogram_experiment(dig_ses1, dig_ses2, vid_ses1, vid_ses2)
-    do_skull_size_experiment(dig_intra, vid_intra, inter, args)
-    # do_old_experiment(r_matrix, s_matrix, video_names, args)
+    artifacts = {"video_names": video_names, "sticker_locations": sticker_locations, "preloaded_model": None,
+                 "args": args, "template": args.template, "ground_truth": args.ground_truth}
+    run_experiment_graph(get_experiment_graph(), artifacts, workers=getattr(args, "workers", None))
 
 
 def do_brain_error_visualization_experiment(vid_ses1, per_patient_landmarks):
@@ -263,7 +488,7 @@ def do_brain_error_visualization_experiment(vid_ses1, per_patient_landmarks):
     landmark-per-patient inter-method error (vid session1 and digitizer sessions)
     :return:
     """
-    XYZ = MNI_torch.load_raw_MNI_data("resource" + "/MNI_templates/xyzallBEM.npy", "brain", resource_folder="resource")
+    XYZ = MNI.get_template_store("resource").surface("brain")
     import pptk
     v = pptk.viewer(XYZ)
     v.color_map('hot', scale=[0, 1])
@@ -911,10 +1136,10 @@ def get_digi2digi_results(path_to_template, experiment_folder_path, rot_as_matri
         logging.info(exp_file.name)
         file_names, file_data, file_format, skull = read_template_file(exp_file)
         skull_sizes = []
+        sessions = []
         for i, session in enumerate(zip(file_names, file_data)):
             if not session[0]:
-                optode_estimations.setdefault(exp_file.stem, []).append(None)
-                rot_estimations.setdefault(exp_file.stem, []).append(None)
+                sessions.append(None)
                 continue
             names = session[0]
             data = session[1][:, 0, :] - session[1][:, 1, :]  # subtract second sensor
@@ -935,10 +1160,24 @@ def get_digi2digi_results(path_to_template, experiment_folder_path, rot_as_matri
                                    names.index('righteye'),
                                    names.index('nz'),
                                    names.index('nosetip')), :]
-            # align faces as intermediate step
-            ret_R, ret_t = geometry.rigid_transform_3d_nparray(template_face_data, file_face_data)
-            aligned_template_mask = (ret_R @ template_mask_data.T).T + ret_t
-
+            sessions.append([names, data, file_mask_data, file_face_data])
+        valid_sessions = [x for x in sessions if x is not None]
+        if valid_sessions:
+            # align faces as intermediate step (all sessions of this file at once)
+            face_R, face_t = geometry.batch_rigid_transform_3d(template_face_data,
+                                                               np.array([x[3] for x in valid_sessions]))
+            aligned_template_masks = np.einsum("bij,nj->bni", face_R, template_mask_data) + face_t[:, None, :]
+            # find mask transforms
+            mask_R, _ = geometry.batch_rigid_transform_3d(aligned_template_masks,
+                                                          np.array([x[2] for x in valid_sessions]))
+        valid_index = 0
+        for i, session in enumerate(sessions):
+            if session is None:
+                optode_estimations.setdefault(exp_file.stem, []).append(None)
+                rot_estimations.setdefault(exp_file.stem, []).append(None)
+                continue
+            names, data, file_mask_data, _ = session
+            ret_R, ret_t = face_R[valid_index], face_t[valid_index]
             if spiral_output_type == "orig":
                 subject_secific_origin = data[(names.index('lpa'),
                                                names.index('rpa'),
@@ -955,8 +1194,8 @@ def get_digi2digi_results(path_to_template, experiment_folder_path, rot_as_matri
                     subject_secific_spiral = (ret_R @ template_spiral_data.T).T + ret_t
                     spiral_output.append([subject_secific_origin, subject_secific_spiral])
 
-            # find mask transform
-            ret_R, ret_t = geometry.rigid_transform_3d_nparray(aligned_template_mask, file_mask_data)
+            ret_R = mask_R[valid_index]
+            valid_index += 1
             # vis_estimation = (ret_R @ template_mask_data.T).T + ret_t
             # draw.visualize_2_pc(points_blue=vis_estimation,
             #                     points_red=file_mask_data,
@@ -6,7 +6,13 @@ import logging
 import shutil
 from pathlib import Path
 import re
+import os
+import copy
+import hashlib
+import warnings
+from collections import OrderedDict
 from tkinter import filedialog
+import config
 
 
 def select_from_filesystem(isdir, exists, initial_dir, title):
@@ -50,19 +56,170 @@ def pairwise(iterable):
     return zip(a, a)
 
 
+TEMPLATE_FILE_CACHE_SIZE = 256  # number of parsed files kept in memory
+TEMPLATE_PARSER_VERSION = 1  # increase when parse_template_file / parse_digitizer_* / split_fields change their output
+_template_file_cache = OrderedDict()
+_telaviv_names = ['lpa', 'nz', 'nosetip', 'lefteye', 'righteye', 'rpa',
+                  'f8', 'fp2', 'fpz', 'fp1', 'f7', 'cz', 'o1', 'oz', 'o2']
+_telaviv2_names = ['lpa', 'nz', 'nosetip', 'lefteye', 'righteye', 'rpa',
+                   'f8', 'fp2', 'middle_triangle', 'fp1', 'f7', 'cz', 'o1', 'oz', 'o2']
+
+
+def touch_cache_file(path):
+    """
+    marks a file of an on disk cache tier as recently used (see prune_cache_folder)
+    :param path: the path of the cached file
+    """
+    try:
+        os.utime(str(path), None)
+    except OSError:
+        pass
+
+
+def prune_cache_folder(folder, pattern, max_bytes, keep=None):
+    """
+    removes the least recently used files (oldest modification time) of an on disk cache tier until it fits in max_bytes
+    :param folder: the folder of the tier
+    :param pattern: glob pattern of the cached files
+    :param max_bytes: size bound of the tier, None keeps everything
+    :param keep: a path that is never removed (e.g. the file just written)
+    :return: number of removed files
+    """
+    if max_bytes is None or folder is None or not folder.is_dir():
+        return 0
+    entries = []
+    for path in folder.glob(pattern):
+        try:
+            stat = path.stat()
+        except OSError:  # removed concurrently
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(x[1] for x in entries)
+    removed = 0
+    for _, size, path in sorted(entries, key=lambda x: x[0]):
+        if total <= max_bytes:
+            break
+        if keep is not None and path == Path(keep):
+            continue
+        try:
+            path.unlink()
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    return removed
+
+
+def template_file_cache_folder():
+    """
+    :return: the folder of the on disk parsed file cache tier, or None if it is disabled (see config.template_file_cache_folder)
+    """
+    if config.template_file_cache_folder is None:
+        return None
+    return Path(Path(__file__).parent, config.template_file_cache_folder)
+
+
+def get_cached_parse(file_path, parse, *options):
+    """
+    parses a file once per content: results are memoized in memory and on disk, keyed on a fingerprint of the file
+    content, the parser (and TEMPLATE_PARSER_VERSION) and its options. every call returns its own copy of the result.
+    the on disk tier is bounded by config.template_file_cache_folder_bytes (least recently used files are removed).
+    :param file_path: the path of the file to parse
+    :param parse: function that parses the file contents (a string) with options
+    :param options: extra arguments of parse (must have a stable repr)
+    :return: the parsed result
+    """
+    with open(str(file_path), "rb") as f:
+        contents = f.read()
+    if not config.template_file_cache:
+        return parse(contents.decode(), *options)
+    fingerprint = hashlib.sha1(contents)
+    fingerprint.update(repr((parse.__name__, TEMPLATE_PARSER_VERSION, options)).encode())
+    key = fingerprint.hexdigest()
+    result = _template_file_cache.get(key)
+    folder = template_file_cache_folder()
+    path = None if folder is None else Path(folder, key + ".pickle")
+    if result is None and path is not None and path.is_file():
+        try:
+            result = load_from_pickle(path)
+            touch_cache_file(path)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            logging.warning("ignoring corrupt cached file: {}".format(path))
+    if result is None:
+        result = parse(contents.decode(), *options)
+        if path is not None:
+            try:
+                folder.mkdir(parents=True, exist_ok=True)
+                tmp_path = Path(folder, "{}.{}.tmp".format(key, os.getpid()))
+                dump_to_pickle(tmp_path, result)
+                os.replace(tmp_path, path)
+                prune_cache_folder(folder, "*.pickle", config.template_file_cache_folder_bytes, keep=path)
+            except OSError:
+                logging.warning("could not persist parsed file to: {}".format(path))
+    _template_file_cache[key] = result
+    _template_file_cache.move_to_end(key)
+    if len(_template_file_cache) > TEMPLATE_FILE_CACHE_SIZE:
+        _template_file_cache.popitem(last=False)
+    return copy.deepcopy(result)
+
+
+def clear_template_file_cache(disk=False):
+    """
+    empties the in memory parsed file cache tier
+    :param disk: if true, removes the on disk tier files as well
+    """
+    _template_file_cache.clear()
+    folder = template_file_cache_folder()
+    if disk and folder is not None and folder.is_dir():
+        for path in folder.glob("*.pickle"):
+            path.unlink()
+
+
+def split_fields(lines, first, count=3):
+    """
+    converts lines of space and / or comma delimited numeric fields into a float array with one bulk read,
+    missing ("?") fields become nan
+    :param lines: list of strings
+    :param first: index of the first field to keep
+    :param count: number of fields to keep
+    :return: len(lines) x count float array
+    """
+    if not lines:
+        return np.zeros((0, count))
+    columns = len(lines[0].replace(",", " ").split())
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)  # raised when a line is not numeric, handled below
+        values = np.fromstring("\n".join(lines).replace(",", " ").replace("?", "nan"), sep=" ")
+    if columns >= first + count and values.size == columns * len(lines):
+        return values.reshape(len(lines), columns)[:, first:first + count]
+    # ragged lines or non numeric names, split line by line
+    padding = ["nan"] * (first + count)
+    fields = [(line.replace(",", " ").replace("?", "nan").split() + padding)[first:first + count] for line in lines]
+    return np.array(fields, dtype=float).reshape(-1, count)
+
+
 def read_template_file(template_path, input_file_format=None):
     """
     reads a template file in telaviv format ("sensor x y z rx ry rz") or in princeton format ("name x y z")
     multiple sessions in same file are assumed to be delimited by a line "*" (and first session starts with it)
     note1: assumes certain order of capturing in telaviv format (since no names are given)
     note2: in tel-aviv format, two scalars in the beginning of the file are assumed to be skull sizes of subject.
+    note3: parsed files are memoized by content (see get_cached_parse), so re-reading a file is cheap.
     :param template_path: the path to template file
     :param input_file_format: force reading file using a specific format (if this is None tries to infer format by content)
     :return: positions is a list of np array per session, names is a list of lists of names per session.
              note: if two sensors exists, they are stacked in a nx2x3 array, else nx3 for positions.
     """
-    file_handle = open(str(template_path))
-    file_contents = file_handle.read()
+    return get_cached_parse(template_path, parse_template_file, input_file_format)
+
+
+def parse_template_file(file_contents, input_file_format=None):
+    """
+    parses the contents of a template file, coordinates of every session are converted in bulk (see read_template_file)
+    :param file_contents: the contents of the template file
+    :param input_file_format: force reading file using a specific format (if this is None tries to infer format by content)
+    :return: names, data, file_format, skulls (see read_template_file)
+    """
     contents_split = file_contents.splitlines()
     non_empty_lines = [line for line in contents_split if line]
     delimiters = [i for i, x in enumerate(non_empty_lines) if x == "*"]
@@ -75,18 +232,11 @@ def read_template_file(template_path, input_file_format=None):
         cond = len(non_empty_lines[delimiters[0]+1].split()) <= 4
         sessions = [non_empty_lines[delimiters[i]+1:delimiters[i+1]] for i in range(len(delimiters)-1)]
         sessions += [non_empty_lines[delimiters[-1]+1:]]
-        # sessions = [non_empty_lines[delimiters[0]+1:delimiters[1]],
-        #             non_empty_lines[delimiters[1]+1:delimiters[2]],
-        #             non_empty_lines[delimiters[2]+1:]]
-        skulls = []
-        for x in non_empty_lines[0:delimiters[0]]:
-            skull = re.findall(r"[-+]?\d*\.\d+|\d+", x)
-            if skull:
-                skull = float(skull[0])
-                skulls.append(skull)
+        # the first number of every header line is a skull size
+        header = "\n".join(non_empty_lines[0:delimiters[0]])
+        skulls = re.findall(r"^.*?([-+]?\d*\.\d+|\d+)", header, flags=re.MULTILINE)
         if skulls:
-            skulls = np.array(skulls)
-            skulls = np.mean(skulls)
+            skulls = np.mean(np.array(skulls, dtype=float))
         else:
             skulls = None
         names = [list() for _ in range(len(sessions))]
@@ -104,62 +254,34 @@ def read_template_file(template_path, input_file_format=None):
             file_format = "telaviv"
     data = []
     if file_format == "telaviv":
-        labeled_names = ['lpa', 'nz', 'nosetip', 'lefteye', 'righteye', 'rpa',
-                         'f8', 'fp2', 'fpz', 'fp1', 'f7', 'cz', 'o1', 'oz', 'o2']
         for j, session in enumerate(sessions):
-            sensor1_data = []
-            sensor2_data = []
-            for i, (sens1, sens2) in enumerate(pairwise(session)):
-                if i < len(labeled_names):
-                    name = labeled_names[i]
-                else:
-                    name = i-len(labeled_names)
-                data1 = [x for x in sens1.replace(" ", ",").split(",") if x]
-                if data1[1] == "?":
-                    continue
-                names[j].append(name)
-                x, y, z = float(data1[1]), float(data1[2]), float(data1[3])
-                sensor1_data.append(np.array([x, y, z]))
-                data2 = [x for x in sens2.replace(" ", ",").split(",") if x]
-                x, y, z = float(data2[1]), float(data2[2]), float(data2[3])
-                sensor2_data.append(np.array([x, y, z]))
-            data.append(np.stack((sensor1_data, sensor2_data), axis=1))
+            # lines come in pairs (sensor1, sensor2), the name is given by the index of the pair
+            fields = split_fields(session[:len(session) // 2 * 2], 1)
+            sensor1_data, sensor2_data = fields[0::2], fields[1::2]
+            valid = ~np.isnan(sensor1_data[:, 0])
+            names[j] = [_telaviv_names[i] if i < len(_telaviv_names) else i - len(_telaviv_names)
+                        for i in np.flatnonzero(valid).tolist()]
+            data.append(np.stack((sensor1_data[valid], sensor2_data[valid]), axis=1))
     elif file_format == "telaviv2":
-        labeled_names = ['lpa', 'nz', 'nosetip', 'lefteye', 'righteye', 'rpa',
-                         'f8', 'fp2', 'middle_triangle', 'fp1', 'f7', 'cz', 'o1', 'oz', 'o2']
         for j, session in enumerate(sessions):
-            sensor1_data = []
-            sensor2_data = []
-            for i, sens1 in enumerate(session):
-                if i < len(labeled_names):
-                    name = labeled_names[i]
-                else:
-                    name = i-len(labeled_names)
-                s = re.sub(r"\s+", ',', sens1)
-                data1 = [x for x in s.split(",") if x]
-                if data1[0] == "?":
-                    continue
-                names[j].append(name)
-                x, y, z = float(data1[0]), float(data1[1]), float(data1[2])
-                sensor1_data.append(np.array([x, y, z]))
-                sensor2_data.append(np.array([0, 0, 0]))
-            data.append(np.stack((sensor1_data, sensor2_data), axis=1))
+            sensor1_data = split_fields(session, 0)
+            valid = ~np.isnan(sensor1_data[:, 0])
+            names[j] = [_telaviv2_names[i] if i < len(_telaviv2_names) else i - len(_telaviv2_names)
+                        for i in np.flatnonzero(valid).tolist()]
+            sensor1_data = sensor1_data[valid]
+            data.append(np.stack((sensor1_data, np.zeros_like(sensor1_data)), axis=1))
     else:  # princeton
-        for line in non_empty_lines:
-            try:
-                name, x, y, z = line.split()
-            except ValueError:
-                name, x, y, z = line.split(",")
-            x = float(x)
-            y = float(y)
-            z = float(z)
-            data.append(np.array([x, y, z]))
+        fields = [line.replace(",", " ").split() for line in non_empty_lines]
+        if any(len(x) != 4 for x in fields):
+            raise ValueError("princeton format lines must be 'name x y z'")
+        fields = np.array(fields, dtype=str).reshape(-1, 4)
+        for name in fields[:, 0]:
             try:
                 name = int(name)
             except ValueError as verr:
                 name = name.lower()
             names[0].append(name)
-        data = [np.array(data)]
+        data = [fields[:, 1:].astype(float)]
     return names, data, file_format, skulls
 
 
@@ -402,24 +524,28 @@ def move(src, dst):
 
 
 def read_digitizer_multi_noptodes_experiment_file(exp_file_loc):
-    path = Path(exp_file_loc)
-    file_handle = open(str(path))
-    file_contents = file_handle.read()
+    """
+    reads a digitizer experiment file with sessions of "sensor x y z ..." line pairs delimited by "*" lines
+    (parsed files are memoized by content, see get_cached_parse)
+    :param exp_file_loc: the path to the experiment file
+    :return: a list of nx3 arrays per session, the absolute difference between the two sensors
+    """
+    return get_cached_parse(Path(exp_file_loc), parse_digitizer_multi_noptodes_experiment_file)
+
+
+def parse_digitizer_multi_noptodes_experiment_file(file_contents):
+    """
+    parses the contents of a digitizer experiment file (see read_digitizer_multi_noptodes_experiment_file)
+    :param file_contents: the contents of the experiment file
+    :return: a list of nx3 arrays per session
+    """
     contents_split = file_contents.splitlines()
     non_empty_lines = [line for line in contents_split if line]
     delimiters = [i for i, x in enumerate(non_empty_lines) if x == "*"]
     data = []
     for i in range(len(delimiters)-1):
         session = non_empty_lines[delimiters[i]+1:delimiters[i+1]]
-        sensor1_data = []
-        sensor2_data = []
-        for sens1, sens2 in pairwise(session):
-            data1 = sens1.split()
-            x, y, z = float(data1[1]), float(data1[2]), float(data1[3])
-            sensor1_data.append(np.array([x, y, z]))
-            data2 = sens2.split()
-            x, y, z = float(data2[1]), float(data2[2]), float(data2[3])
-            sensor2_data.append(np.array([x, y, z]))
-        sensor_data = np.abs(np.array(sensor1_data) - np.array(sensor2_data))
+        fields = split_fields(session[:len(session) // 2 * 2], 1)
+        sensor_data = np.abs(fields[0::2] - fields[1::2])
         data.append(sensor_data)
     return data
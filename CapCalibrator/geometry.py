@@ -1,11 +1,14 @@
 import numpy as np
 from scipy.spatial.transform import Rotation as R
+from scipy.spatial import cKDTree
 import math
 from file_io import read_template_file
 import logging
 import MNI
 import config
 import copy
+import hashlib
+from pathlib import Path
 import gsoup
 
 
@@ -241,6 +244,45 @@ def rigid_transform_3d_nparray(A, B):
     return R, t
 
 
+def batch_find_affine_transformation(A, B, to_44=False):
+    """
+    batched version of find_affine_transformation, all least squares problems are solved at once
+    :param A: bxnx3 source point clouds (n >= 4)
+    :param B: bxnx3 target point clouds
+    :param to_44: if true, returns bx4x4 matrices
+    :return: bx3x4 affine transformations (W @ [a, 1] ~= b)
+    """
+    A, B = np.asarray(A), np.asarray(B)
+    assert A.shape[-2] >= 4
+    new_A = np.concatenate((A, np.ones(A.shape[:-1] + (1,))), axis=-1)
+    # every row of W is an independent least squares problem sharing the same nx4 matrix
+    W = np.swapaxes(np.linalg.pinv(new_A) @ B, -1, -2)
+    if to_44:
+        bottom = np.broadcast_to(np.array([0, 0, 0, 1.]), W.shape[:-2] + (1, 4))
+        W = np.concatenate((W, bottom), axis=-2)
+    return W
+
+
+def batch_rigid_transform_3d(A, B):
+    """
+    batched version of rigid_transform_3d_nparray, all svds are computed at once (reflections are corrected)
+    :param A: bxnx3 source point clouds (or nx3, shared by all pairs)
+    :param B: bxnx3 target point clouds
+    :return: bx3x3 rotation matrices and bx3 translations to apply to A such that it matches B
+    """
+    A, B = np.asarray(A), np.asarray(B)
+    centroid_A = np.mean(A, axis=-2, keepdims=True)
+    centroid_B = np.mean(B, axis=-2, keepdims=True)
+    H = np.swapaxes(A - centroid_A, -1, -2) @ (B - centroid_B)
+    U, S, Vt = np.linalg.svd(H)
+    V, Ut = np.swapaxes(Vt, -1, -2), np.swapaxes(U, -1, -2)
+    flip = np.ones(H.shape[:-1])
+    flip[..., -1] = np.linalg.det(V @ Ut)
+    R = (V * flip[..., None, :]) @ Ut
+    t = centroid_B[..., 0, :] - np.einsum("...ij,...j->...i", R, centroid_A[..., 0, :])
+    return R, t
+
+
 def rigid_transform_3d(A, B):
     """
     finds best (in terms of rmse) rigid transformation between pc a and pc b
@@ -312,21 +354,68 @@ def get_rmse(A, B):
     return rmse
 
 
-def batch_get_rmse(A, B):
+def batch_get_rmse(A, B, dtype=np.float64):
     """
     gets rmse between a point cloud nx3 to a batch of point clouds b x n x 3
     :param A:
     :param B:
+    :param dtype: dtype of the computation (np.float32 halves memory bandwidth for large batches)
     :return: b x 1 numpy array of rmse's
     """
     assert (len(A.shape) == 2 and len(B.shape) == 3) or (len(A.shape) == 3 and len(B.shape) == 2)
-    A = A.astype(np.float)
-    B = B.astype(np.float)
+    A = A.astype(dtype, copy=False)
+    B = B.astype(dtype, copy=False)
     rmse = np.mean(np.linalg.norm(A - B, axis=-1), axis=-1)
     return rmse
 
 
 
+def batch_to_standard_coordinate_system(names, data_in):
+    """
+    batched version of to_standard_coordinate_system, every cloud is converted independently
+    :param names: names of measurements (same for all clouds)
+    :param data_in: bxnx3 data
+    :return: returns the bxnx3 data in the standard coordinate system
+    """
+    data = np.array(data_in, dtype=np.float64)
+    batch = np.arange(len(data))
+    left_eye_index = names.index('lefteye')
+    right_eye_index = names.index('righteye')
+    cz_index = names.index('cz')
+    try:
+        left_triangle = names.index('left_triangle')
+        right_triangle = names.index('right_triangle')
+    except ValueError:
+        left_triangle = names.index('fp1')
+        right_triangle = names.index('fp2')
+    # axes swaps are gathered into a permutation of the axes per cloud
+    permutation = np.tile(np.arange(3), (len(data), 1))
+    x_axis = np.argmax(np.abs(data[:, right_eye_index] - data[:, left_eye_index]), axis=-1)
+    permutation[batch, 0], permutation[batch, x_axis] = permutation[batch, x_axis], permutation[batch, 0]
+    data = np.take_along_axis(data, permutation[:, None, :], axis=-1)
+    eyes_midpoint = ((data[:, left_eye_index] + data[:, right_eye_index]) / 2)
+    fp1fp2_midpoint = ((data[:, left_triangle] + data[:, right_triangle]) / 2)
+    z_axis = np.argmax(np.abs(eyes_midpoint - fp1fp2_midpoint), axis=-1)
+    permutation = np.tile(np.arange(3), (len(data), 1))
+    swap = z_axis != 0
+    permutation[batch[swap], 2], permutation[batch[swap], z_axis[swap]] = z_axis[swap], 2
+    data = np.take_along_axis(data, permutation[:, None, :], axis=-1)
+    # find reflections
+    xdir = data[:, right_eye_index, 0] - data[:, left_eye_index, 0]
+    ydir = data[:, left_eye_index, 1] - data[:, cz_index, 1]
+    zdir = data[:, cz_index, 2] - data[:, left_eye_index, 2]
+    reflections = np.stack(((xdir > 0) * 2 - 1, (ydir > 0) * 2 - 1, (zdir > 0) * 2 - 1), axis=-1)
+    data = data * reflections[:, None, :]
+    # translate to standard origin
+    eyes_midpoint = (data[:, right_eye_index] + data[:, left_eye_index]) / 2
+    origin = np.stack((eyes_midpoint[:, 0], data[:, cz_index, 1], eyes_midpoint[:, 2]), axis=-1)
+    data = data - origin[:, None, :]
+    # possibly convert from inch to cm
+    inch = data[:, cz_index, 2] < 7  # distance from "middle" of brain to top is ~9-10 cm on average
+    data[inch] *= 2.54
+    return data
+
+
 def fix_yaw(names, data):
     """
     given sticker names and data (nx3),
@@ -362,6 +451,32 @@ def fix_yaw(names, data):
     return new_data.T
 
 
+def batch_fix_yaw(names, data):
+    """
+    batched version of fix_yaw, every cloud is rotated independently
+    :param names: names of measurements (same for all clouds)
+    :param data: bxnx3 data
+    :return: the bxnx3 rotated data
+    """
+    def normalize(v):
+        return v / np.linalg.norm(v, axis=-1, keepdims=True)
+    leftEye = names.index('lefteye')
+    rightEye = names.index('righteye')
+    leftEar = names.index('lpa')
+    rightEar = names.index('rpa')
+    right_triangle = names.index('right_triangle')
+    left_triangle = names.index('left_triangle')
+    cz = names.index('cz')
+    xvec1 = normalize(data[:, rightEye] - data[:, leftEye])
+    xvec2 = normalize(data[:, rightEar] - data[:, leftEar])
+    xvec3 = normalize(data[:, right_triangle] - data[:, left_triangle])
+    x = normalize(np.mean([xvec1, xvec2, xvec3], axis=0))
+    z = normalize(data[:, cz] - (data[:, rightEar] + data[:, leftEar]) / 2)
+    y = normalize(np.cross(z, x))
+    transform = np.stack((x, y, z), axis=1)
+    return np.einsum("bij,bnj->bni", transform, data)
+
+
 def from_standard_to_sim_space(names, data):
     """
     transforms data to simulation space (inverts x axis)
@@ -383,8 +498,27 @@ def from_sim_to_standard_space(names, data):
     return from_standard_to_sim_space(names, data)
 
 
-def apply_rigid_transform(r_matrix, s_matrix, template_names, template_data, video_names, args):
-    vid_est = []
+def batch_rigid_transform(r_matrix, s_matrix, data):
+    """
+    applies every rotation and scale pair independently to the same point cloud
+    :param r_matrix: bx3x3 rotation matrices (or a list of them)
+    :param s_matrix: bx3x3 scale matrices (or a list of them)
+    :param data: nx3 point cloud
+    :return: bxnx3 transformed point clouds (rotation @ scale @ point)
+    """
+    return np.einsum("bij,bjk,nk->bni", np.asarray(r_matrix), np.asarray(s_matrix), data)
+
+
+def batch_apply_rigid_transform(r_matrix, s_matrix, template_names, template_data, args):
+    """
+    applies rigid transforms to the optodes of a template (anchors are not transformed)
+    :param r_matrix: bx3x3 rotation matrices (or a list of them)
+    :param s_matrix: bx3x3 scale matrices (or a list of them)
+    :param template_names: template names, if None the template is read from args.template
+    :param template_data: template data
+    :param args: command line arguments
+    :return: names (anchors first, then optodes) and bxnx3 transformed templates in standard coordinate system
+    """
     if template_names:
         names, data = template_names, template_data
     else:
@@ -392,17 +526,20 @@ def apply_rigid_transform(r_matrix, s_matrix, template_names, template_data, vid
         names = names[0]
         data = data[0]
     data = to_standard_coordinate_system(names, data)
-    anchor_mask = np.isin(np.array(names), np.array(config.all_possible_anchor_names))
-    data_origin = data[anchor_mask]
-    names_origin = np.array(names)[anchor_mask]
-    data_optodes = data[~anchor_mask]
-    names_optodes = np.array(names)[~anchor_mask]
+    names_origin, data_origin, names_optodes, data_optodes = split_template(names, data)
     names = np.concatenate((names_origin, names_optodes)).tolist()
-    for rot_mat, scale_mat in zip(r_matrix, s_matrix):
-        transformed_data_sim = rot_mat @ (scale_mat @ data_optodes.T)
-        data_optodes = transformed_data_sim.T
-        vid_est.append([names, np.vstack((data_origin, data_optodes))])
-    return vid_est
+    data_optodes = batch_rigid_transform(r_matrix, s_matrix, data_optodes)
+    data_origin = np.broadcast_to(data_origin, (len(data_optodes),) + data_origin.shape)
+    return names, np.concatenate((data_origin, data_optodes), axis=1)
+
+
+def apply_rigid_transform(r_matrix, s_matrix, template_names, template_data, video_names, args):
+    """
+    applies every rigid transform (independently) to the optodes of a template (see batch_apply_rigid_transform)
+    :return: list of [names, data (nx3)] per transform
+    """
+    names, data = batch_apply_rigid_transform(r_matrix, s_matrix, template_names, template_data, args)
+    return [[names, x] for x in data]
 
 
 def compare_data_from_files(file_path1, file_path2, use_second_sensor):
@@ -477,35 +614,59 @@ def normalize_coordinates(names, data):
     # zscale = new_data[names.index('cz'), 1] - np.min(data[:, 2])
 
 
-def project_sensors_to_MNI(list_of_sensor_locations, origin_optodes_names=None, resource_folder="resource", transform_anchors=False):
+def project_sensors_to_MNI(list_of_sensor_locations, origin_optodes_names=None, resource_folder="resource", transform_anchors=False,
+                           surface="head", approximate=False):
     """
     project new sensor locations to (statistical) MNI
     :param list_of_sensor_locations: a list of lists of [names ,data (nx3)] of all sensor locations
     :param origin_optodes_names:
+    :param surface: the surface sensors are projected onto, "head" or "cortex" (only the requested one is computed)
+    :param approximate: if true, head projection uses a precomputed voxel lookup table (fast, up to ~2mm deviation)
     :return:
     """
     projected_locations = copy.deepcopy(list_of_sensor_locations)
-    for i, sensor_locations in enumerate(projected_locations):
-        logging.info("Projecting: {} / {} point clouds to MNI".format(i+1, len(projected_locations)))
+    anchor_masks, origins_xyz, others_xyz, selected_indices = [], [], [], []
+    for sensor_locations in projected_locations:
         names = sensor_locations[0]
         data = sensor_locations[1]
         if origin_optodes_names:
             anchor_mask = np.isin(names, origin_optodes_names)
             unsorted_anchors_xyz = data[anchor_mask, :]  # treated as anchors for projection (they are not changed)
             unsorted_anchors_names = np.array(origin_optodes_names)
-            others_xyz = data[~anchor_mask, :]  # will be transformed to MNI
+            others_xyz.append(data[~anchor_mask, :])  # will be transformed to MNI
         else:  # last fallback, transform only non-anchors using default configuration.
             anchor_mask = np.isin(np.array(names), np.array(config.all_possible_anchor_names))
             unsorted_anchors_xyz = data[anchor_mask]
             unsorted_anchors_names = np.array(names)[anchor_mask]
-            others_xyz = data[~anchor_mask]
-        origin_xyz, selected_indices = sort_anchors(unsorted_anchors_names, unsorted_anchors_xyz)
-        otherH, _, _, _, transforms = MNI.project(origin_xyz, others_xyz, selected_indices, resource_folder=resource_folder)
-        sensor_locations[1][~anchor_mask, :] = otherH
+            others_xyz.append(data[~anchor_mask])
+        origin_xyz, indices = sort_anchors(unsorted_anchors_names, unsorted_anchors_xyz)
+        anchor_masks.append(anchor_mask)
+        origins_xyz.append(origin_xyz)
+        selected_indices.append(indices)
+    if all(np.array_equal(x, selected_indices[0]) for x in selected_indices) and \
+            len(set(x.shape for x in others_xyz)) == 1:
+        # all clouds share the same anchors and number of sensors, so they are projected as a single batch
+        logging.info("Projecting: {} point clouds to MNI".format(len(projected_locations)))
+        otherH, otherC, _, _, transforms = MNI.project_batch(np.stack(origins_xyz), np.stack(others_xyz), selected_indices[0],
+                                                             resource_folder=resource_folder, surfaces=(surface,),
+                                                             approximate_head=approximate)
+        projected = otherH if surface == "head" else otherC
+    else:
+        projected, transforms = [], []
+        for i in range(len(projected_locations)):
+            logging.info("Projecting: {} / {} point clouds to MNI".format(i+1, len(projected_locations)))
+            otherH, otherC, _, _, transform = MNI.project(origins_xyz[i], others_xyz[i], selected_indices[i],
+                                                          resource_folder=resource_folder, surfaces=(surface,),
+                                                          approximate_head=approximate)
+            projected.append(otherH if surface == "head" else otherC)
+            transforms.append(transform)
+    for i, sensor_locations in enumerate(projected_locations):
+        anchor_mask = anchor_masks[i]
+        sensor_locations[1][~anchor_mask, :] = projected[i]
         if transform_anchors:
             anchors = sensor_locations[1][anchor_mask, :]
             anchors_hom = np.c_[anchors, np.ones(anchors.shape[0])]
-            anchors_transformed = np.matmul(anchors_hom, transforms)
+            anchors_transformed = np.matmul(anchors_hom, transforms[i])
             anchors_transformed = anchors_transformed.mean(axis=0)[:, :3]
             sensor_locations[1][anchor_mask, :] = anchors_transformed  # return transformed anchors aswell (do not neccesarily reside on head surface, just naively transfromed using the affine transform)
     return projected_locations
@@ -536,23 +697,481 @@ def sort_anchors(unsorted_anchors_names: np.ndarray, unsorted_anchors_xyz: np.nd
         raise NotImplementedError
     return origin_xyz, selected_indices
 
+
+def split_template(names, data):
+    """
+    splits a template (in standard coordinate system) into anchors and optodes (see apply_rigid_transform)
+    :param names: template names
+    :param data: nx3 template data
+    :return: anchors names, anchors data, optodes names, optodes data
+    """
+    anchor_mask = np.isin(np.array(names), np.array(config.all_possible_anchor_names))
+    return np.array(names)[anchor_mask], data[anchor_mask], np.array(names)[~anchor_mask], data[~anchor_mask]
+
+
+class ProjectionTable:
+    """
+    precomputed MNI projection of a template's optodes over a regular grid of STORM-Net rotation (euler angles, degrees)
+    and scale parameters. projections of new rigid transforms are interpolated (multilinear) from the grid.
+    use build_projection_table to create one, and ProjectionTable.load to load it.
+    """
+    def __init__(self, axes, projected, fingerprint, surface):
+        """
+        :param axes: list of 6 increasing 1d arrays, grid values of rx, ry, rz (degrees) and sx, sy, sz
+        :param projected: (len(axes[0]) x ... x len(axes[5])) x m x 3 projected optodes per grid point
+        :param fingerprint: fingerprint of the template and surface the table was built for (see projection_table_fingerprint)
+        :param surface: "head" or "cortex"
+        """
+        self.axes = [np.asarray(axis, dtype=np.float64) for axis in axes]
+        self.projected = projected
+        self.fingerprint = fingerprint
+        self.surface = surface
+
+    @staticmethod
+    def load(path):
+        """
+        :param path: path to a table saved by build_projection_table (.npz)
+        :return: a ProjectionTable
+        """
+        with np.load(path) as table:
+            axes = [table["axis{}".format(i)] for i in range(6)]
+            return ProjectionTable(axes, table["projected"].astype(np.float32), str(table["fingerprint"]), str(table["surface"]))
+
+    def save(self, path, dtype=np.float16):
+        """
+        :param path: path of the .npz file
+        :param dtype: storage dtype of the projections (float16 is accurate to ~0.06mm on MNI coordinates)
+        """
+        np.savez(path, projected=self.projected.astype(dtype), fingerprint=self.fingerprint, surface=self.surface,
+                 **{"axis{}".format(i): axis for i, axis in enumerate(self.axes)})
+
+    def lookup(self, parameters):
+        """
+        interpolates the projected optodes of rigid transforms
+        :param parameters: b x 6 array of rx, ry, rz (degrees), sx, sy, sz
+        :return: b x m x 3 interpolated projections, and a b boolean array of which parameters are inside the grid
+                 (projections of parameters outside of the grid are not valid)
+        """
+        parameters = np.atleast_2d(parameters)
+        inside = np.ones(len(parameters), dtype=bool)
+        lower, weights = [], []
+        for axis, x in zip(self.axes, parameters.T):
+            inside &= (x >= axis[0] - 1e-9) & (x <= axis[-1] + 1e-9)
+            if len(axis) == 1:
+                lower.append(np.zeros(len(x), dtype=np.int64))
+                weights.append(np.zeros(len(x)))
+                continue
+            i = np.clip(np.searchsorted(axis, x, side="right") - 1, 0, len(axis) - 2)
+            lower.append(i)
+            weights.append(np.clip((x - axis[i]) / (axis[i + 1] - axis[i]), 0, 1))
+        interpolated = np.zeros((len(parameters),) + self.projected.shape[-2:])
+        # sum over the 2^6 corners of the grid cell of every parameter set
+        for corner in np.ndindex(*(2,) * len(self.axes)):
+            weight = np.ones(len(parameters))
+            index = []
+            for axis, i, w, c in zip(self.axes, lower, weights, corner):
+                weight = weight * (w if c else 1 - w)
+                index.append(np.minimum(i + c, len(axis) - 1))
+            if np.any(weight):
+                interpolated += weight[:, None, None] * self.projected[tuple(index)]
+        return interpolated, inside
+
+
+def projection_table_fingerprint(names, data, surface, resource_folder="resource"):
+    """
+    :param names: template names
+    :param data: nx3 template data (in standard coordinate system)
+    :param surface: "head" or "cortex"
+    :param resource_folder: relative path to the folder with the raw template data
+    :return: a string identifying the template, surface, MNI template data (content and version) and projection
+             algorithm version a projection table was built for
+    """
+    h = hashlib.sha1(np.ascontiguousarray(data, dtype=np.float64).tobytes())
+    h.update("{}{}{}{}{}".format(list(names), surface, MNI.get_template_store(resource_folder).fingerprint,
+                                 MNI.TEMPLATE_BUNDLE_VERSION, MNI.PROJECTION_VERSION).encode())
+    return h.hexdigest()
+
+
+def rigid_transform_parameters(r_matrix, s_matrix):
+    """
+    :param r_matrix: list of 3x3 rotation matrices (see predict.predict_rigid_transform)
+    :param s_matrix: list of 3x3 (diagonal) scale matrices
+    :return: b x 6 array of rx, ry, rz (degrees), sx, sy, sz
+    """
+    eulers = R.from_matrix(np.array(r_matrix)).as_euler('xyz', degrees=True)
+    scales = np.diagonal(np.array(s_matrix), axis1=1, axis2=2)
+    return np.concatenate((eulers, scales), axis=1)
+
+
+def build_projection_table(names, data, path=None, rotation_range=7, rotation_steps=8, scale_range=(0.7, 1.3),
+                           scale_steps=5, surface="head", resource_folder="resource", dtype=np.float16, batch_size=4096):
+    """
+    projects the optodes of a template to MNI over a grid of rotation and scale parameters, done once per template.
+    :param names: template names
+    :param data: nx3 template data (in standard coordinate system)
+    :param path: if given, the table is saved to this path (.npz)
+    :param rotation_range: every euler angle is sampled in [-rotation_range, rotation_range] (degrees)
+    :param rotation_steps: number of samples per euler angle
+    :param scale_range: every scale is sampled in this range
+    :param scale_steps: number of samples per scale (1 means scale is fixed to 1)
+    :param surface: the surface the optodes are projected onto, "head" or "cortex"
+    :param resource_folder: relative path to the folder with the raw template data
+    :param dtype: storage dtype of the table
+    :param batch_size: number of grid points projected at once
+    :return: a ProjectionTable
+    """
+    names_origin, data_origin, _, data_optodes = split_template(names, data)
+    origin_xyz, selected_indices = sort_anchors(names_origin, data_origin)
+    rotations = np.linspace(-rotation_range, rotation_range, rotation_steps)
+    scales = np.linspace(scale_range[0], scale_range[1], scale_steps) if scale_steps > 1 else np.ones(1)
+    axes = [rotations] * 3 + [scales] * 3
+    parameters = np.stack(np.meshgrid(*axes, indexing="ij"), axis=-1).reshape(-1, 6)
+    projected = np.empty((len(parameters),) + data_optodes.shape, dtype=dtype)
+    for start in range(0, len(parameters), batch_size):
+        logging.info("Projection table: {} / {} grid points".format(start, len(parameters)))
+        batch = parameters[start:start + batch_size]
+        rot_mats = R.from_euler('xyz', batch[:, :3], degrees=True).as_matrix()
+        transformed = (rot_mats @ (batch[:, 3:, None] * data_optodes.T)).transpose(0, 2, 1)
+        otherH, otherC, _, _, _ = MNI.project_batch(np.repeat(origin_xyz[None], len(batch), axis=0), transformed,
+                                                    selected_indices, output_errors=False, resource_folder=resource_folder,
+                                                    surfaces=(surface,), memoize=False)
+        projected[start:start + batch_size] = otherH if surface == "head" else otherC
+    projected = projected.reshape(tuple(len(axis) for axis in axes) + data_optodes.shape)
+    table = ProjectionTable(axes, projected, projection_table_fingerprint(names, data, surface, resource_folder), surface)
+    if path is not None:
+        table.save(path, dtype)
+    table.projected = table.projected.astype(np.float32)
+    return table
+
+
+def get_projection_table(path, template_path, surface="head", resource_folder="resource"):
+    """
+    loads the projection table of a template, building (and saving) it first if it does not exist or is stale
+    :param path: path of the table (.npz)
+    :param template_path: path to the template file
+    :param surface: the surface sensors are projected onto, "head" or "cortex"
+    :param resource_folder: relative path to the folder with the raw template data
+    :return: a ProjectionTable
+    """
+    names, data, format, _ = read_template_file(template_path)
+    names = names[0]
+    data = to_standard_coordinate_system(names, data[0])
+    if Path(path).is_file():
+        table = ProjectionTable.load(path)
+        if table.fingerprint == projection_table_fingerprint(names, data, surface, resource_folder):
+            return table
+    logging.info("building MNI projection table (this might take a while, done only once per template)")
+    return build_projection_table(names, data, path, surface=surface, resource_folder=resource_folder)
+
+
+def project_rigid_transforms_to_MNI(r_matrix, s_matrix, template_names, template_data, args, table=None,
+                                    surface="head", resource_folder="resource"):
+    """
+    same as apply_rigid_transform followed by project_sensors_to_MNI, but projections of rigid transforms inside
+    the grid of a projection table are interpolated from it (exact projection is used outside of the grid)
+    :param r_matrix: list of rotation matrices (see apply_rigid_transform)
+    :param s_matrix: list of scale matrices (see apply_rigid_transform)
+    :param template_names: template names, if None the template is read from args.template
+    :param template_data: template data
+    :param args: command line arguments
+    :param table: a ProjectionTable built for this template and surface (or None for exact projection only)
+    :param surface: the surface sensors are projected onto, "head" or "cortex"
+    :param resource_folder: relative path to the folder with the raw template data
+    :return: list of [names, data] of projected sensors, anchors are not changed (see project_sensors_to_MNI)
+    """
+    if template_names:
+        names, data = template_names, template_data
+    else:
+        names, data, format, _ = read_template_file(args.template)
+        names = names[0]
+        data = data[0]
+    data = to_standard_coordinate_system(names, data)
+    fingerprint = projection_table_fingerprint(names, data, surface, resource_folder)
+    names_origin, data_origin, names_optodes, data_optodes = split_template(names, data)
+    names = np.concatenate((names_origin, names_optodes)).tolist()
+    parameters = rigid_transform_parameters(r_matrix, s_matrix)
+    inside = np.zeros(len(parameters), dtype=bool)
+    if table is not None:
+        assert table.fingerprint == fingerprint, \
+            "projection table was built for a different template or surface"
+        projected, inside = table.lookup(parameters)
+    exact = []
+    if not np.all(inside):
+        transformed = batch_rigid_transform(np.asarray(r_matrix)[~inside], np.asarray(s_matrix)[~inside], data_optodes)
+        exact = [[names, np.vstack((data_origin, x))] for x in transformed]
+    if exact:
+        logging.info("{} rigid transforms are outside of the projection table, projecting exactly".format(len(exact)))
+        exact = project_sensors_to_MNI(exact, resource_folder=resource_folder, surface=surface)
+    results = []
+    for i in range(len(parameters)):
+        if inside[i]:
+            results.append([names, np.vstack((data_origin, projected[i]))])
+        else:
+            results.append(exact.pop(0))
+    return results
+
+
+def sample_rigid_transform_parameters(rng, n, low, high):
+    """
+    samples rotation and scale parameters uniformly in a box
+    :param rng: a np.random.Generator
+    :param n: number of samples
+    :param low: 6 (or nx6) lower bounds of rx, ry, rz (degrees), sx, sy, sz
+    :param high: 6 (or nx6) upper bounds
+    :return: nx6 parameters
+    """
+    return low + rng.random((n, 6)) * (np.asarray(high) - np.asarray(low))
+
+
+def merge_top_k(best, candidates, k):
+    """
+    keeps the k lowest error entries per target out of the current best entries and a chunk of new candidates
+    :param best: (errors sxk, parameters sxkx6, projected sxkxmx3) of the current best entries
+    :param candidates: (errors sxc, parameters cx6, projected cxmx3) of the new candidates (shared by all targets)
+    :param k: number of entries to keep
+    :return: (errors, parameters, projected) of the new best entries, sorted by error per target
+    """
+    best_errors, best_parameters, best_projected = best
+    errors, parameters, projected = candidates
+    all_errors = np.concatenate((best_errors, errors), axis=1)
+    if all_errors.shape[1] > k:
+        selected = np.argpartition(all_errors, k - 1, axis=1)[:, :k]
+    else:
+        selected = np.broadcast_to(np.arange(all_errors.shape[1]), all_errors.shape)
+    selected = np.take_along_axis(selected, np.argsort(np.take_along_axis(all_errors, selected, axis=1), axis=1), axis=1)
+    best_count = best_errors.shape[1]
+    merged_errors = np.take_along_axis(all_errors, selected, axis=1)
+    new_index = np.maximum(selected - best_count, 0)
+    merged_parameters, merged_projected = parameters[new_index], projected[new_index]
+    if best_count:
+        from_best = selected < best_count
+        best_index = (np.arange(len(selected))[:, None], np.minimum(selected, best_count - 1))
+        merged_parameters = np.where(from_best[..., None], best_parameters[best_index], merged_parameters)
+        merged_projected = np.where(from_best[..., None, None], best_projected[best_index], merged_projected)
+    return merged_errors, merged_parameters, merged_projected
+
+
+def grid_search_rigid_transforms(project, targets, candidates=500000, top_k=10, chunk_size=4096, rotation_range=7,
+                                 scale_range=(0.7, 1.3), refine_levels=0, refine_candidates=256, refine_shrink=0.7,
+                                 seed=42):
+    """
+    streaming random search of the rotation and scale of a template (applied before MNI projection) against many
+    targets at once. candidates are generated, projected and compared to all targets chunk by chunk, and only a running
+    top k per target is kept, so memory does not grow with the number of candidates.
+    in coarse to fine mode (refine_levels > 0), every level samples refine_candidates per target around its current
+    top k, in a box that shrinks by refine_shrink per level, so a small coarse search suffices.
+    :param project: function that maps cx6 parameters (rx, ry, rz in degrees, sx, sy, sz) to cxmx3 projected points
+    :param targets: sxmx3 target points (e.g. digitizer sessions of all subjects)
+    :param candidates: number of (coarse) random candidates
+    :param top_k: number of best candidates kept per target
+    :param chunk_size: number of candidates projected at once
+    :param rotation_range: every euler angle is sampled in [-rotation_range, rotation_range] (degrees)
+    :param scale_range: every scale is sampled in this range
+    :param refine_levels: number of refinement levels (0 means plain random search)
+    :param refine_candidates: number of candidates sampled per target in every refinement level
+    :param refine_shrink: factor the refinement box shrinks by every level
+    :param seed: random seed
+    :return: parameters sxkx6, errors sxk (rmse) and projected points sxkxmx3 of the best candidates, sorted by error
+    """
+    targets = np.asarray(targets)
+    rng = np.random.default_rng(seed)
+    low = np.array([-rotation_range] * 3 + [scale_range[0]] * 3)
+    high = np.array([rotation_range] * 3 + [scale_range[1]] * 3)
+    best = (np.full((len(targets), 0), np.inf), np.empty((len(targets), 0, 6)),
+            np.empty((len(targets), 0) + targets.shape[1:]))
+    projections = 0
+
+    def reduce(parameters):
+        nonlocal best, projections
+        for start in range(0, len(parameters), chunk_size):
+            chunk = parameters[start:start + chunk_size]
+            projected = project(chunk)
+            errors = np.mean(np.linalg.norm(targets[:, None] - projected[None], axis=-1), axis=-1)
+            best = merge_top_k(best, (errors, chunk, projected), top_k)
+            projections += len(chunk)
+
+    # coarse (or plain) search, parameters are generated per chunk
+    for start in range(0, candidates, chunk_size):
+        reduce(sample_rigid_transform_parameters(rng, min(chunk_size, candidates - start), low, high))
+    # refinement around the current best candidates of every target, starting at the coarse sample spacing
+    half_width = (high - low) / candidates ** (1 / 6)
+    for level in range(refine_levels):
+        centers = best[1].reshape(-1, 6)
+        centers = np.repeat(centers, max(1, refine_candidates // best[1].shape[1]), axis=0)
+        parameters = sample_rigid_transform_parameters(rng, len(centers), centers - half_width, centers + half_width)
+        reduce(np.clip(parameters, low, high))
+        half_width = half_width * refine_shrink
+    logging.info("grid search: projected {} candidates for {} targets, mean best error: {:.3f}".format(
+        projections, len(targets), np.mean(best[0][:, 0])))
+    return best[1], best[0], best[2]
+
+
+def mean_point_distance(queries, clouds):
+    """
+    mean distance between corresponding points of every query and every cloud (see batch_get_rmse)
+    :param queries: sxmx3 point clouds
+    :param clouds: nxmx3 point clouds
+    :return: sxn distances (float64)
+    """
+    queries = np.asarray(queries, dtype=np.float64)
+    clouds = np.asarray(clouds, dtype=np.float64)
+    return np.mean(np.linalg.norm(queries[:, None] - clouds[None], axis=-1), axis=-1)
+
+
+class ProjectionBankIndex:
+    """
+    exact nearest neighbour index over a bank of projected point clouds (e.g. the grid search of
+    do_parameter_grid_search_experiment), under the mean point distance. the bank is partitioned into clusters (IVF),
+    and since the mean point distance is a metric, a cluster cannot hold a cloud closer to a query than
+    distance(query, centroid) - radius. queries re-rank clusters exactly in the order of this lower bound,
+    and stop once no cluster can improve on the best cloud found.
+    use build_projection_bank_index to create one, and ProjectionBankIndex.load to load it.
+    """
+    def __init__(self, centroids, radii, order, offsets, fingerprint):
+        """
+        :param centroids: cxmx3 cluster centroids
+        :param radii: c largest mean point distance of a cluster member to its centroid
+        :param order: n bank indices sorted by cluster
+        :param offsets: c+1 offsets of every cluster in order
+        :param fingerprint: fingerprint of the bank the index was built for (see projection_bank_fingerprint)
+        """
+        self.centroids = centroids
+        self.radii = radii
+        self.order = order
+        self.offsets = offsets
+        self.fingerprint = fingerprint
+
+    @staticmethod
+    def load(path):
+        """
+        :param path: path to an index saved by build_projection_bank_index (.npz)
+        :return: a ProjectionBankIndex
+        """
+        with np.load(path) as index:
+            return ProjectionBankIndex(index["centroids"], index["radii"], index["order"], index["offsets"],
+                                       str(index["fingerprint"]))
+
+    def save(self, path):
+        """
+        :param path: path of the .npz file
+        """
+        np.savez(path, centroids=self.centroids, radii=self.radii, order=self.order, offsets=self.offsets,
+                 fingerprint=self.fingerprint)
+
+    def query(self, bank, queries):
+        """
+        finds the closest (minimum mean point distance) cloud of the bank for every query
+        :param bank: the nxmx3 bank the index was built for (can be memory mapped)
+        :param queries: sxmx3 query point clouds
+        :return: s indices into the bank, and s mean point distances of the closest clouds
+        """
+        queries = np.asarray(queries, dtype=np.float64)
+        lower_bounds = mean_point_distance(queries, self.centroids) - self.radii
+        lower_bounds[:, self.offsets[1:] == self.offsets[:-1]] = np.inf  # empty clusters
+        best_errors = np.full(len(queries), np.inf)
+        best_indices = np.zeros(len(queries), dtype=np.int64)
+
+        def rerank(cluster, active):
+            members = self.order[self.offsets[cluster]:self.offsets[cluster + 1]]  # increasing (stable sort)
+            errors = mean_point_distance(queries[active], bank[members])
+            closest = np.argmin(errors, axis=1)
+            improved = errors[np.arange(len(closest)), closest] < best_errors[active]
+            active = np.flatnonzero(active)[improved]
+            best_errors[active] = errors[improved, closest[improved]]
+            best_indices[active] = members[closest[improved]]
+        # seed every query with its most promising cluster, then visit clusters by their smallest lower bound
+        first_clusters = np.argmin(lower_bounds, axis=1)
+        for cluster in np.unique(first_clusters):
+            rerank(cluster, first_clusters == cluster)
+        cluster_bounds = np.min(lower_bounds, axis=0)
+        for cluster in np.argsort(cluster_bounds):
+            if cluster_bounds[cluster] >= np.max(best_errors):
+                break
+            active = lower_bounds[:, cluster] < best_errors
+            if np.any(active):
+                rerank(cluster, active)
+        return best_indices, best_errors
+
+
+def projection_bank_fingerprint(bank, chunk_size=65536):
+    """
+    :param bank: nxmx3 bank of point clouds (can be memory mapped)
+    :param chunk_size: number of clouds hashed at once
+    :return: a string identifying the content of the bank
+    """
+    h = hashlib.sha1(str(bank.shape).encode())
+    for start in range(0, len(bank), chunk_size):
+        h.update(np.ascontiguousarray(bank[start:start + chunk_size], dtype=np.float32).tobytes())
+    return h.hexdigest()
+
+
+def build_projection_bank_index(bank, path=None, clusters=None, sample_size=65536, chunk_size=65536, seed=0):
+    """
+    partitions a bank of point clouds into clusters (k-means on a sample, every cloud is assigned to its closest centroid)
+    :param bank: nxmx3 bank of point clouds (can be memory mapped)
+    :param path: if given, the index is saved to this path (.npz)
+    :param clusters: number of clusters (defaults to sqrt(n))
+    :param sample_size: number of clouds k-means is run on
+    :param chunk_size: number of clouds assigned at once
+    :param seed: random seed
+    :return: a ProjectionBankIndex
+    """
+    from scipy.cluster.vq import kmeans2, vq
+    n = len(bank)
+    clusters = min(n, clusters or int(np.sqrt(n)))
+    rng = np.random.default_rng(seed)
+    sample = np.sort(rng.choice(n, min(n, sample_size), replace=False))
+    sample = np.asarray(bank[sample], dtype=np.float64).reshape(len(sample), -1)
+    centroids, _ = kmeans2(sample, clusters, minit="points", seed=seed)
+    flat_centroids, centroids = centroids, centroids.reshape((clusters,) + bank.shape[1:])
+    labels = np.empty(n, dtype=np.int64)
+    radii = np.zeros(clusters)
+    for start in range(0, n, chunk_size):
+        chunk = np.asarray(bank[start:start + chunk_size], dtype=np.float64)
+        labels[start:start + len(chunk)] = vq(chunk.reshape(len(chunk), -1), flat_centroids, check_finite=False)[0]
+        distances = np.mean(np.linalg.norm(chunk - centroids[labels[start:start + len(chunk)]], axis=-1), axis=-1)
+        np.maximum.at(radii, labels[start:start + len(chunk)], distances)
+    order = np.argsort(labels, kind="stable")
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(labels, minlength=clusters))))
+    index = ProjectionBankIndex(centroids, radii, order, offsets, projection_bank_fingerprint(bank))
+    if path is not None:
+        index.save(path)
+    return index
+
+
+def get_projection_bank_index(bank, path):
+    """
+    loads the index of a bank of point clouds, building (and saving) it first if it does not exist or is stale
+    :param bank: nxmx3 bank of point clouds (can be memory mapped)
+    :param path: path of the index (.npz)
+    :return: a ProjectionBankIndex
+    """
+    fingerprint = projection_bank_fingerprint(bank)
+    if Path(path).is_file():
+        index = ProjectionBankIndex.load(path)
+        if index.fingerprint == fingerprint:
+            return index
+    logging.info("building projection bank index (done only once per bank)")
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    return build_projection_bank_index(bank, path)
+
+
 def clean_model(names, data, threshold=0.3):
     """
     cleans a point cloud from points too close to each other ("almost" duplicates)
+    a point is removed if any point before it (removed or not) is within threshold, so the first of every cluster is kept
     :param names: names of the points
     :param data: the points themselves nx3
+    :param threshold: points closer than this are considered duplicates
     :return: the cleaned point cloud and its names
     Note: assumes almsot duplictes only exist in unnamed points (numbers and not strings in the input names)
     """
-    indices = []
     anchors = data[:names.index(0)]
     unfiltered_pc = data[names.index(0):]
-    for i in range(len(unfiltered_pc)):
-        for j in range(i+1, len(unfiltered_pc)):
-            dist = np.linalg.norm(unfiltered_pc[i] - unfiltered_pc[j])
-            if dist <= threshold:
-                indices.append(j)
-    selected_indices = [x for x in range(len(unfiltered_pc)) if x not in indices]
-    data = np.vstack((anchors, data[tuple(selected_indices), :]))
-    names = names[:names.index(0)] + [x for x in range(len(selected_indices))]
+    # query_pairs returns every close pair once with i < j, the later point of each pair is a duplicate
+    pairs = cKDTree(unfiltered_pc).query_pairs(threshold, output_type="ndarray")
+    keep = np.ones(len(unfiltered_pc), dtype=bool)
+    keep[pairs[:, 1]] = False
+    data = np.vstack((anchors, unfiltered_pc[keep]))
+    names = names[:names.index(0)] + [x for x in range(np.count_nonzero(keep))]
     return names, data
@@ -8,6 +8,7 @@ import logging
 from file_io import save_results
 import experimental
 import sys
+import multiprocessing
 __version__ = "0.0.1"
 
 
@@ -20,6 +21,13 @@ def parse_arguments():
     parser.add_argument("--template", help="The template file path (given in space delimited csv format of size nx3). Required if mode is auto")
     parser.add_argument("--mni", action="store_true",
                         help="If specified, output will be projected to (adult) MNI coordinates")
+    parser.add_argument("--mni_surface", type=str, choices=["head", "cortex"], default="head",
+                        help="The MNI surface sensors are projected onto (only used if --mni is specified)")
+    parser.add_argument("--mni_approximate", action="store_true",
+                        help="If specified, head MNI projection uses a precomputed lookup table (faster, up to ~2mm deviation)")
+    parser.add_argument("--mni_table",
+                        help="A path to a projection table (.npz) of the template over STORM-Net rotations and scales. "
+                             "If specified, MNI projection interpolates it (built once per template if it does not exist)")
     parser.add_argument("--storm_net", default="models/torch_heatmap_manuscript.h5", help="A path to a trained storm net model")
     parser.add_argument("--unet", help="A path to a trained segmentation network model")
     parser.add_argument("--session_file",
@@ -28,6 +36,9 @@ def parse_arguments():
     parser.add_argument("--verbosity", type=str, choices=["debug", "info", "warning"], default="info", help="Selects verbosity level")
     parser.add_argument("--log", help="If specified, log will be output to this file")
     parser.add_argument("--ground_truth", help="Use this in experimental mode only")
+    parser.add_argument("--workers", type=int,
+                        help="Number of processes running independent experiments concurrently "
+                             "(experimental mode only, default: number of cores)")
     parser.add_argument("--gpu_id", type=int, default=-1, help="Which GPU to use (or -1 for cpu)")
     parser.add_argument("--headless", action="store_true",
                         help="Force no gui")
@@ -79,6 +90,8 @@ def parse_arguments():
 
 
 if __name__ == "__main__":
+    # spawned experiment workers of a frozen executable must not re-run the command line interface
+    multiprocessing.freeze_support()
     # parse command line
     args = parse_arguments()
     # set up logging
@@ -91,8 +104,13 @@ if __name__ == "__main__":
     if args.mode == "auto":
         r_matrix, s_matrix = predict.predict_rigid_transform(sticker_locations, None, args)
         sensor_locations = geometry.apply_rigid_transform(r_matrix, s_matrix, None, None, video_names, args)
-        if args.mni:
-            projected_data = geometry.project_sensors_to_MNI(sensor_locations)
+        if args.mni and args.mni_table:
+            table = geometry.get_projection_table(args.mni_table, args.template, surface=args.mni_surface)
+            projected_data = geometry.project_rigid_transforms_to_MNI(r_matrix, s_matrix, None, None, args, table,
+                                                                      surface=args.mni_surface)
+        elif args.mni:
+            projected_data = geometry.project_sensors_to_MNI(sensor_locations, surface=args.mni_surface,
+                                                             approximate=args.mni_approximate)
         else:
             projected_data = sensor_locations
         save_results(projected_data[0], args.output_file)
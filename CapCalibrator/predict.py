@@ -7,6 +7,8 @@ import pickle
 from scipy.spatial.transform import Rotation as R
 import numpy as np
 import logging
+import contextlib
+import functools
 import data_augmentations
 import torch
 import torch_src.torch_model as torch_model
@@ -30,75 +32,124 @@ def is_using_gpu():
     return torch.cuda.is_available()
 
 
-def predict_rigid_transform(sticker_locations, preloaded_model, args):
+def load_storm_net(model_path, device):
     """
-    predicts rigid transformation of cap object using 2d sticker locations
-    :param sticker_locations: a batch of 2d array of sticker locations
-    :param preloaded_model: a pre loaded keras model
-    :param args: command line arguments
-    :return: rotation and scale matrices list
+    loads a STORM-Net model (full size or distilled student)
+    :param model_path: path to the model state dict
+    :param device: the device to load the model onto
+    :return: the network
+    """
+    opt = Options(device=device)
+    state_dict = torch.load(Path(model_path), map_location=device)
+    if hasattr(state_dict, '_metadata'):
+        del state_dict._metadata
+    opt.network_base_channels = torch_model.get_base_channels(state_dict)  # distilled students are narrower
+    network = torch_model.MyNetwork(opt)
+    network.load_state_dict(state_dict)
+    network.to(opt.device)
+    return network
+
+
+def preprocess_sticker_locations(sticker_locations):
+    """
+    prepares 2d sticker locations for the network in place (scale to 0-1, mask and center)
+    :param sticker_locations: ... x 10 x 14 np array of sticker locations (any number of leading dimensions)
+    :return: None
     """
     # scale to 0-1 for network
-    sticker_locations[:, :, 0::2] /= 960
-    sticker_locations[:, :, 1::2] /= 540
+    sticker_locations[..., 0::2] /= 960
+    sticker_locations[..., 1::2] /= 540
     # mask facial landmarks for frames that have less than 3 of them
     data_augmentations.mask_facial_landmarks(sticker_locations)
     # center the data
     data_augmentations.center_data(sticker_locations)
-    if preloaded_model:
-        network = preloaded_model
-    else:
-        model_full_path = Path(args.storm_net)
-        opt = Options(device=args.device)
-        network = torch_model.MyNetwork(opt)
-        state_dict = torch.load(model_full_path, map_location=args.device)
-        if hasattr(state_dict, '_metadata'):
-            del state_dict._metadata
-        network.load_state_dict(state_dict)
-        network.to(opt.device)
-    heat_mapper = torch_data.HeatMap((256, 256), 16, False, args.device)
-    x = torch.from_numpy(sticker_locations).to(args.device).float()
+
+
+def _per_sample_norm(batch_norm, x):
+    return torch.nn.functional.instance_norm(x, weight=batch_norm.weight, bias=batch_norm.bias, use_input_stats=True,
+                                             eps=batch_norm.eps)
+
+
+@contextlib.contextmanager
+def per_sample_batch_norm(network):
+    """
+    the network predicts in training mode, where a batch norm layer normalizes a single sample over its own statistics.
+    inside this context, batch norm layers in training mode normalize every sample of a batch over its own statistics,
+    so a batched forward predicts exactly like forwarding one sample at a time (running statistics are not updated).
+    :param network: the network
+    """
+    patched = [x for x in network.modules() if isinstance(x, torch.nn.BatchNorm2d) and x.training]
+    for batch_norm in patched:
+        batch_norm.forward = functools.partial(_per_sample_norm, batch_norm)
+    try:
+        yield network
+    finally:
+        for batch_norm in patched:
+            del batch_norm.forward
+
+
+def predict_parameters(sticker_locations, network, device, batch_size=32):
+    """
+    runs the network on preprocessed sticker locations (see preprocess_sticker_locations), in batches
+    :param sticker_locations: ... x 10 x 14 np array of preprocessed sticker locations (any number of leading dimensions)
+    :param network: the network
+    :param device: the device to run on
+    :param batch_size: number of samples whose heatmaps are drawn and forwarded at once
+    :return: ... x network_output_size np array of raw network predictions (euler angles in degrees, then scales)
+    """
+    heat_mapper = torch_data.HeatMap((256, 256), 16, False, device)
+    x = torch.from_numpy(sticker_locations.reshape(-1, 10, sticker_locations.shape[-1])).to(device).float()
     x[:, :, 0::2] *= 256
     x[:, :, 1::2] *= 256
-    y_predict = torch.empty((len(x), network.opt.network_output_size), dtype=torch.float, device=args.device)
-    for i in range(len(x)):
-        heatmap = heat_mapper(x[i].reshape(10, x[i].shape[-1] // 2, 2))
-        with torch.no_grad():
-            _, pred = network(heatmap.unsqueeze(0))
-            y_predict[i] = pred
+    y_predict = torch.empty((len(x), network.opt.network_output_size), dtype=torch.float, device=device)
+    for start in range(0, len(x), batch_size):
+        batch = x[start:start + batch_size]
+        heatmaps = heat_mapper(batch.reshape(-1, batch.shape[-1] // 2, 2)).reshape(len(batch), 10, *heat_mapper.img_shape)
+        with torch.no_grad(), per_sample_batch_norm(network):
+            _, y_predict[start:start + batch_size] = network(heatmaps)
     y_predict = y_predict.cpu().numpy()
-    assert y_predict.shape[-1] == network.opt.network_output_size
+    return y_predict.reshape(sticker_locations.shape[:-2] + (network.opt.network_output_size,))
+
+
+def parameters_to_rigid_transform(y_predict, scale_faces):
+    """
+    converts raw network predictions to rotation and scale matrices
+    :param y_predict: b x network_output_size raw network predictions
+    :param scale_faces: which axes the network predicts scales for (e.g. "xyz"), or None
+    :return: b x 3 x 3 rotation matrices and b x 3 x 3 scale matrices
+    """
     # simulation uses left hand rule (as opposed to scipy rotation that uses right hand rule)
     # notice x is not negated - the positive direction in simulation is flipped.
-    rs = []
-    sc = []
+    rotation_mat = R.from_euler('xyz', y_predict[:, :3], degrees=True).as_matrix()
+    scale_mat = np.repeat(np.identity(3)[None], len(y_predict), axis=0)
+    if y_predict.shape[-1] > 3:
+        counter = 0
+        for axis, name in enumerate("xyz"):
+            if name in scale_faces:
+                scale_mat[:, axis, axis] = y_predict[:, 3 + counter]
+                counter += 1
+    return rotation_mat, scale_mat
+
+
+def predict_rigid_transform(sticker_locations, preloaded_model, args):
+    """
+    predicts rigid transformation of cap object using 2d sticker locations
+    :param sticker_locations: a batch of 2d array of sticker locations
+    :param preloaded_model: a pre loaded keras model
+    :param args: command line arguments
+    :return: rotation and scale matrices list
+    """
+    preprocess_sticker_locations(sticker_locations)
+    if preloaded_model:
+        network = preloaded_model
+    else:
+        network = load_storm_net(args.storm_net, args.device)
+    y_predict = predict_parameters(sticker_locations, network, args.device)
+    assert y_predict.shape[-1] == network.opt.network_output_size
     for i in range(len(y_predict)):
         logging.info("Storm-Net Parameters Prediction:" + str(y_predict[i].tolist()))
-        rot = R.from_euler('xyz', [y_predict[i][0], y_predict[i][1], y_predict[i][2]], degrees=True)
-        scale_mat = np.identity(3)
-        if y_predict.shape[-1] > 3:
-            counter = 0
-            if "x" in network.opt.scale_faces:
-                xterm = y_predict[i][3 + counter]
-                counter += 1
-            else:
-                xterm = 1.0
-            if "y" in network.opt.scale_faces:
-                yterm = y_predict[i][3 + counter]
-                counter += 1
-            else:
-                yterm = 1.0
-            if "z" in network.opt.scale_faces:
-                zterm = y_predict[i][3 + counter]
-            else:
-                zterm = 1.0
-            scale_mat[0, 0] = xterm  # xscale
-            scale_mat[1, 1] = yterm  # yscale
-            scale_mat[2, 2] = zterm  # zscale
-        rotation_mat = rot.as_matrix()
-        rs.append(rotation_mat)
-        sc.append(scale_mat)
-    return rs, sc
+    rs, sc = parameters_to_rigid_transform(y_predict, network.opt.scale_faces)
+    return list(rs), list(sc)
 
 
 def get_facial_landmarks(frames):
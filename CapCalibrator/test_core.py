@@ -1,4 +1,6 @@
 import pytest
+import json
+import os
 import numpy as np
 from scipy.spatial.transform import Rotation as R
 import geometry
@@ -7,8 +9,32 @@ from pathlib import Path
 import file_io
 import MNI
 import torch_src.MNI_torch as MNI_torch
+import torch_src.torch_geometry as torch_geometry
 import render
 import torch
+import config
+
+@pytest.fixture(autouse=True)
+def projection_cache(tmp_path, monkeypatch):
+    """
+    every test starts with an empty projection cache, whose on disk tier is private to the test
+    """
+    monkeypatch.setattr(config, "mni_projection_cache_folder", str(Path(tmp_path, "mni_projections").resolve()))
+    MNI.clear_projection_cache()
+    yield Path(config.mni_projection_cache_folder)
+    MNI.clear_projection_cache()
+
+
+@pytest.fixture(autouse=True)
+def template_file_cache(tmp_path, monkeypatch):
+    """
+    every test starts with an empty parsed file cache, whose on disk tier is private to the test
+    """
+    monkeypatch.setattr(config, "template_file_cache_folder", str(Path(tmp_path, "templates").resolve()))
+    file_io.clear_template_file_cache()
+    yield Path(config.template_file_cache_folder)
+    file_io.clear_template_file_cache()
+
 
 @pytest.fixture
 def anchors_and_sensors():
@@ -124,6 +150,21 @@ def test_differentiable_find_affine(anchors_and_sensors):
     assert np.all(np.isclose(test1, test2, atol=1e-5))
 
 
+def test_affine_transforms_cache(anchors_and_sensors):
+    """
+    tests that affine transforms are reused for the same anchors and recomputed for different ones
+    :return:
+    """
+    origin_xyz, others_xyz, selected_indices = anchors_and_sensors
+    refN, pointN = 17, others_xyz.shape[0]
+    transforms1, others1, _ = MNI.find_affine_transforms(origin_xyz, others_xyz, selected_indices, refN, pointN)
+    transforms2, others2, _ = MNI.find_affine_transforms(origin_xyz.copy(), others_xyz + 1, selected_indices, refN, pointN)
+    assert transforms1 is transforms2
+    assert np.all(np.isclose(others1 + np.sum(transforms1[:, :3, :3], axis=1)[:, None, :], others2))
+    transforms3, _, _ = MNI.find_affine_transforms(origin_xyz + 1, others_xyz, selected_indices, refN, pointN)
+    assert transforms3 is not transforms1 and not np.all(np.isclose(transforms1[:, 3], transforms3[:, 3]))
+
+
 def test_mni_torch_vs_mni_numpy(anchors_and_sensors):
     """
     tests if mni projection using torch is the same as numpy
@@ -225,6 +266,26 @@ def test_differentiable_MNI_projection(anchors_and_sensors):
     assert torch.mean(torch.linalg.norm(torch.from_numpy(test1) - test2.squeeze(0), dim=1)) < 1.5
 
 
+def test_differentiable_MNI_projection_batch(anchors_and_sensors):
+    """
+    tests the batched differentiable mni projection matches projecting every cloud on its own,
+    works for any number of sensors, and finds the same candidates with a kd-tree and with torch.cdist
+    :param anchors_and_sensors:
+    :return:
+    """
+    origin_xyz, others_xyz, selected_indices = anchors_and_sensors
+    origin_xyz_torch = torch.from_numpy(origin_xyz).float()
+    others_xyz_torch = torch.from_numpy(others_xyz[:7]).float()
+    batch = torch.stack([others_xyz_torch, others_xyz_torch + 0.5])
+    projected = MNI_torch.torch_project(origin_xyz_torch, batch, selected_indices)
+    assert projected.shape == batch.shape
+    for i in range(len(batch)):
+        single = MNI_torch.torch_project(origin_xyz_torch, batch[i:i+1], selected_indices)
+        assert torch.allclose(single[0], projected[i], atol=1e-4)
+    cdist_projected = MNI_torch.torch_project(origin_xyz_torch, batch, selected_indices, use_kdtree=False)
+    assert torch.allclose(cdist_projected, projected, atol=1e-4)
+
+
 def test_3d_rigid_transform():
     """
     tests rigid transform based on svd
@@ -247,6 +308,178 @@ def test_3d_rigid_transform():
     assert (pytest.approx(rmse) == 0)
 
 
+def test_batched_geometry():
+    """
+    tests batched coordinate normalization matches the per cloud version, and rigid transforms are applied independently
+    :return:
+    """
+    names, data, _, _ = file_io.read_template_file(Path("../example_models/example_model.txt"))
+    names, data = names[0], data[0]
+    clouds = np.einsum("bij,nj->bni", R.random(8, random_state=0).as_matrix(), data)
+    clouds[1:4] = clouds[1:4][:, :, [2, 0, 1]] * np.array([-1, 1, -1])  # axes swaps and reflections
+    clouds[::2] /= 2.54  # inch
+    single = np.stack([geometry.to_standard_coordinate_system(names, cloud) for cloud in clouds])
+    assert np.allclose(geometry.batch_to_standard_coordinate_system(names, clouds), single)
+    single = np.stack([geometry.fix_yaw(names, cloud.copy()) for cloud in clouds])
+    assert np.allclose(geometry.batch_fix_yaw(names, clouds), single)
+    r_matrix = R.from_euler('xyz', [[5, 0, 0], [0, -3, 2]], degrees=True).as_matrix()
+    s_matrix = [np.diag([1.1, 1, 0.9]), np.identity(3)]
+    transformed = geometry.apply_rigid_transform(r_matrix, s_matrix, names, data, None, None)
+    std_names, std_data = transformed[0][0], geometry.to_standard_coordinate_system(names, data)
+    optodes = std_data[~np.isin(np.array(names), np.array(config.all_possible_anchor_names))]
+    for i in range(2):
+        assert transformed[i][0] == std_names
+        assert np.allclose(transformed[i][1][-len(optodes):], (r_matrix[i] @ s_matrix[i] @ optodes.T).T)
+
+
+def test_batched_solvers():
+    """
+    tests batched kabsch and affine solvers (numpy and torch) match the single pair versions
+    :return:
+    """
+    rng = np.random.default_rng(0)
+    a = rng.normal(size=(16, 9, 3))
+    b = np.einsum("bij,bnj->bni", R.random(16, random_state=0).as_matrix(), a) + rng.normal(size=(16, 1, 3))
+    b += rng.normal(size=b.shape) * 0.1
+    b[3] = a[3] * np.array([-1, 1, 1])  # reflection
+    r_batch, t_batch = geometry.batch_rigid_transform_3d(a, b)
+    w_batch = geometry.batch_find_affine_transformation(a, b, to_44=True)
+    for i in range(len(a)):
+        r, t = geometry.rigid_transform_3d_nparray(a[i], b[i])
+        assert np.allclose(r, r_batch[i]) and np.allclose(t, t_batch[i])
+        assert np.allclose(geometry.find_affine_transformation(a[i], b[i], to_44=True), w_batch[i])
+    assert np.allclose(np.linalg.det(r_batch), 1)
+    r_shared, _ = geometry.batch_rigid_transform_3d(a[0], b)
+    assert np.allclose(r_shared[0], r_batch[0])
+    r_torch, t_torch = torch_geometry.torch_batch_rigid_transform_3d(torch.from_numpy(a), torch.from_numpy(b))
+    assert np.allclose(r_torch.numpy(), r_batch) and np.allclose(t_torch.numpy(), t_batch)
+    w_torch = torch_geometry.torch_batch_find_affine_transformation(torch.from_numpy(a), torch.from_numpy(b), to_44=True)
+    assert np.allclose(w_torch.numpy(), w_batch)
+
+
+def test_clean_model():
+    """
+    tests near duplicate points are removed, keeping the first of every cluster
+    :return:
+    """
+    rng = np.random.default_rng(0)
+    points = rng.uniform(-10, 10, size=(50, 3))
+    points[10] = points[3] + 0.1  # duplicate of an earlier point
+    points[20] = points[30] + [0.2, 0, 0]  # duplicate of a later point (the later one is removed)
+    points[40] = points[20] + [0.2, 0, 0]  # chained to 20, 0.4 away from 30
+    names = ["nz", "cz"] + list(range(len(points)))
+    data = np.vstack((np.array([[0, 10, 0], [0, 0, 10.]]), points))
+    clean_names, clean_data = geometry.clean_model(names, data, threshold=0.3)
+    keep = np.setdiff1d(np.arange(len(points)), [10, 30, 40])
+    assert clean_names == ["nz", "cz"] + list(range(len(keep)))
+    assert np.array_equal(clean_data, np.vstack((data[:2], points[keep])))
+
+
+def test_template_file_parser(tmp_path, template_file_cache, monkeypatch):
+    """
+    tests the bulk template file parser on multi session telaviv files, and that parsed files are memoized by content
+    :return:
+    """
+    lines = ["skull size 55.5", "56.5", "*"]
+    for session in range(2):
+        for i in range(17):
+            x = "? ? ?" if i == 2 else "{} {} {}".format(i, session, -i)
+            lines += ["1, {}, 0, 0, 0".format(x), "2, {} {} {}, 0, 0, 0".format(i, 2 * i, 3 * i)]
+        lines.append("*")
+    template_path = Path(tmp_path, "telaviv.txt")
+    template_path.write_text("\n".join(lines[:-1]))
+    names, data, file_format, skull = file_io.read_template_file(template_path)
+    assert file_format == "telaviv" and skull == 56
+    expected_names = ['lpa', 'nz', 'lefteye', 'righteye', 'rpa', 'f8', 'fp2', 'fpz', 'fp1', 'f7', 'cz', 'o1', 'oz', 'o2', 0, 1]
+    assert names == [expected_names, expected_names]
+    i = np.array([0, 1] + list(range(3, 17)))
+    for session in range(2):
+        assert data[session].shape == (16, 2, 3)
+        assert np.array_equal(data[session][:, 0], np.stack((i, np.full(16, session), -i), axis=1))
+        assert np.array_equal(data[session][:, 1], np.stack((i, 2 * i, 3 * i), axis=1))
+    assert len(list(template_file_cache.glob("*.pickle"))) == 1
+    data[0][:] = 0  # callers get their own copy
+    file_io.clear_template_file_cache()  # served from disk
+    cached_names, cached_data, _, _ = file_io.read_template_file(template_path)
+    assert cached_names == names and np.array_equal(cached_data[1], data[1]) and np.any(cached_data[0])
+    template_path.write_text("\n".join(lines[:-1]).replace("skull size 55.5", "skull size 57.5"))
+    assert file_io.read_template_file(template_path)[3] == 57
+    assert len(list(template_file_cache.glob("*.pickle"))) == 2
+    # a new parser version does not load results of the previous one
+    monkeypatch.setattr(file_io, "TEMPLATE_PARSER_VERSION", file_io.TEMPLATE_PARSER_VERSION + 1)
+    file_io.clear_template_file_cache()
+    assert file_io.read_template_file(template_path)[3] == 57
+    assert len(list(template_file_cache.glob("*.pickle"))) == 3
+    # the disk tier is bounded in bytes, the least recently used files go first
+    paths = sorted(template_file_cache.glob("*.pickle"), key=lambda x: x.stat().st_mtime)
+    for i, path in enumerate(paths):
+        os.utime(path, (i, i))
+    limit = sum(path.stat().st_size for path in paths[1:])
+    assert file_io.prune_cache_folder(template_file_cache, "*.pickle", limit) == 1
+    assert sorted(template_file_cache.glob("*.pickle")) == sorted(paths[1:])
+    monkeypatch.setattr(config, "template_file_cache_folder_bytes", 1)
+    file_io.clear_template_file_cache()
+    file_io.read_template_file(Path("../example_models/example_model.txt"))
+    assert len(list(template_file_cache.glob("*.pickle"))) == 1
+
+
+def test_streaming_grid_search():
+    """
+    tests the streaming grid search keeps the same top k per target as a full search over the same candidates,
+    and that coarse to fine refinement beats a much larger random search
+    :return:
+    """
+    rng = np.random.default_rng(0)
+    cloud = rng.normal(size=(8, 3)) * 5 + np.array([0, 0, 8])
+
+    def project(parameters):
+        r_matrix = R.from_euler('xyz', parameters[:, :3], degrees=True).as_matrix()
+        return np.einsum("bij,bj,nj->bni", r_matrix, parameters[:, 3:], cloud)
+    low, high = np.array([-7] * 3 + [0.7] * 3), np.array([7] * 3 + [1.3] * 3)
+    center, half_width = (low + high) / 2, (high - low) / 2 * 0.8
+    true_parameters = geometry.sample_rigid_transform_parameters(rng, 6, center - half_width, center + half_width)
+    targets = project(true_parameters) + rng.normal(scale=0.05, size=(6, 8, 3))
+    parameters, errors, projected = geometry.grid_search_rigid_transforms(project, targets, candidates=5000, top_k=4,
+                                                                          chunk_size=333)
+    seeded = np.random.default_rng(42)
+    candidates = np.concatenate([geometry.sample_rigid_transform_parameters(seeded, min(333, 5000 - start), low, high)
+                                 for start in range(0, 5000, 333)])
+    all_errors = np.mean(np.linalg.norm(targets[:, None] - project(candidates)[None], axis=-1), axis=-1)
+    order = np.argsort(all_errors, axis=1)[:, :4]
+    assert np.allclose(errors, np.take_along_axis(all_errors, order, axis=1))
+    assert np.allclose(parameters, candidates[order]) and np.allclose(projected, project(candidates[order].reshape(-1, 6)).reshape(6, 4, 8, 3))
+    _, random_errors, _ = geometry.grid_search_rigid_transforms(project, targets, candidates=50000, top_k=4)
+    _, refined_errors, _ = geometry.grid_search_rigid_transforms(project, targets, candidates=1000, top_k=4,
+                                                                 refine_levels=10, refine_candidates=100)
+    assert np.all(refined_errors[:, 0] <= random_errors[:, 0])
+    true_errors = np.mean(np.linalg.norm(targets - project(true_parameters), axis=-1), axis=-1)
+    assert np.all(refined_errors[:, 0] <= true_errors * 1.1)
+
+
+def test_projection_bank_index(tmp_path):
+    """
+    tests the nearest neighbour index over a bank of point clouds finds the same clouds as a full search,
+    and is rebuilt when the bank changes
+    :return:
+    """
+    rng = np.random.default_rng(0)
+    cloud = rng.normal(size=(8, 3)) * 5
+    parameters = geometry.sample_rigid_transform_parameters(rng, 20000, np.array([-7] * 3 + [0.7] * 3),
+                                                            np.array([7] * 3 + [1.3] * 3))
+    bank = geometry.batch_rigid_transform(R.from_euler('xyz', parameters[:, :3], degrees=True).as_matrix(),
+                                          parameters[:, 3:, None] * np.identity(3), cloud).astype(np.float32)
+    queries = bank[rng.integers(len(bank), size=30)] + rng.normal(scale=0.2, size=(30, 8, 3))
+    index_path = Path(tmp_path, "bank.index.npz")
+    index = geometry.get_projection_bank_index(bank, index_path)
+    indices, errors = index.query(bank, queries)
+    full_errors = np.stack([geometry.batch_get_rmse(x, bank) for x in queries])
+    assert np.array_equal(indices, np.argmin(full_errors, axis=1))
+    assert np.allclose(errors, np.min(full_errors, axis=1))
+    assert np.array_equal(geometry.get_projection_bank_index(bank, index_path).order, index.order)
+    bank[0] += 1
+    assert geometry.get_projection_bank_index(bank, index_path).fingerprint != index.fingerprint
+
+
 def test_frame_selection():
     frames, indices = video.video_to_frames(Path("../example_videos/example_video.mp4"),
                                             force_reselect=True,
@@ -297,6 +530,347 @@ def test_MNI_projection():
     assert np.all(np.isclose(otherCSD_loaded, otherCSD))
 
 
+def test_float32_projection_drift(anchors_and_sensors, monkeypatch):
+    """
+    tests the float32 projection mode stays within 0.01mm of the float64 one (and of the matlab reference data)
+    :return:
+    """
+    tolerance = 0.01  # mm
+    origin_xyz, others_xyz, selected_indices = anchors_and_sensors
+    monkeypatch.setattr(config, "mni_dtype", "float32")
+    otherH, otherC, otherHSD, otherCSD, _ = MNI.project(origin_xyz, others_xyz, selected_indices, output_errors=True)
+    assert otherH.dtype == np.float32 and otherC.dtype == np.float32
+    data = np.load('resource/mni_projection_test.npz')
+    assert np.max(np.linalg.norm(otherH - data["name1"], axis=1)) < tolerance
+    assert np.max(np.linalg.norm(otherC - data["name2"], axis=1)) < tolerance
+    assert np.max(np.abs(otherHSD - data["name3"])) < tolerance
+    assert np.max(np.abs(otherCSD - data["name4"])) < tolerance
+    rmse32 = geometry.batch_get_rmse(data["name1"], otherH[None], dtype=np.float32)
+    assert rmse32.dtype == np.float32 and rmse32[0] < tolerance
+
+
+def test_projection_cache(anchors_and_sensors, projection_cache, monkeypatch):
+    """
+    tests projections are memoized in memory and on disk, keyed on inputs quantized to 0.01mm
+    :return:
+    """
+    origin_xyz, others_xyz, selected_indices = anchors_and_sensors
+    others_xyz = np.round(others_xyz, 3)  # on the quantization grid, so a small offset does not cross a rounding boundary
+    first = MNI.project(origin_xyz, others_xyz, selected_indices, surfaces=("head",))
+    assert len(list(projection_cache.glob("*.npz"))) == 1
+    first[0][:] = 0  # callers get their own copy of the cached outputs
+    MNI.clear_projection_cache()  # next call is served from the disk tier
+    second = MNI.project(origin_xyz, others_xyz + 1e-4, selected_indices, surfaces=("head",))
+    assert second[1] is None and second[3] is None
+    third = MNI.project(origin_xyz, others_xyz, selected_indices, surfaces=("head",))
+    assert np.array_equal(second[0], third[0]) and not np.array_equal(first[0], third[0])
+    MNI.project(origin_xyz, others_xyz + 1e-2, selected_indices, surfaces=("head",))
+    MNI.project(origin_xyz, others_xyz, selected_indices, surfaces=("head",), output_errors=True)
+    assert len(list(projection_cache.glob("*.npz"))) == 3
+    # persisted projections of other template data or an older projection algorithm are not reused
+    key = MNI.projection_cache_key(origin_xyz, others_xyz, selected_indices, surfaces=("head",))
+    store = MNI.get_template_store("resource")
+    assert len(store.fingerprint) == 40
+    with monkeypatch.context() as patch:
+        patch.setattr(MNI, "PROJECTION_VERSION", MNI.PROJECTION_VERSION + 1)
+        assert MNI.projection_cache_key(origin_xyz, others_xyz, selected_indices, surfaces=("head",)) != key
+    with monkeypatch.context() as patch:
+        patch.setattr(store, "_fingerprint", "other template data")
+        assert MNI.projection_cache_key(origin_xyz, others_xyz, selected_indices, surfaces=("head",)) != key
+    assert MNI.projection_cache_key(origin_xyz, others_xyz, selected_indices, surfaces=("head",)) == key
+    # disk hits mark files as recently used, the disk tier is bounded in bytes
+    for path in projection_cache.glob("*.npz"):
+        os.utime(path, (0, 0))
+    MNI.clear_projection_cache()
+    MNI.project(origin_xyz, others_xyz, selected_indices, surfaces=("head",))
+    assert sum(path.stat().st_mtime > 0 for path in projection_cache.glob("*.npz")) == 1
+    monkeypatch.setattr(config, "mni_projection_cache_folder_bytes", 1)
+    MNI.project(origin_xyz, others_xyz + 2e-2, selected_indices, surfaces=("head",))
+    assert len(list(projection_cache.glob("*.npz"))) == 1
+
+
+def test_projection_table(tmp_path, monkeypatch):
+    """
+    tests the rotation space projection table matches exact projection on grid points, is close to it between grid
+    points, and falls back to exact projection outside of the grid
+    :return:
+    """
+    names, data, _, _ = file_io.read_template_file(Path("../example_models/example_model.txt"))
+    names, data = names[0], data[0]
+    path = Path(tmp_path, "table.npz")
+    geometry.build_projection_table(names, geometry.to_standard_coordinate_system(names, data), path,
+                                    rotation_range=2, rotation_steps=3, scale_steps=1)
+    table = geometry.ProjectionTable.load(path)
+    eulers = np.array([[2, 0, -2], [10, 0, 0]])
+    r_matrix = list(R.from_euler('xyz', eulers, degrees=True).as_matrix())
+    s_matrix = [np.identity(3)] * 2
+    interpolated = geometry.project_rigid_transforms_to_MNI(r_matrix, s_matrix, names, data, None, table)
+    exact = geometry.project_rigid_transforms_to_MNI(r_matrix, s_matrix, names, data, None)
+    assert interpolated[0][0] == exact[0][0]
+    assert np.allclose(interpolated[0][1], exact[0][1], atol=0.1)  # grid point, float16 storage
+    assert np.array_equal(interpolated[1][1], exact[1][1])  # outside of the grid
+    # between grid nodes (nodes are 2 degrees apart), interpolation error is bounded in mm
+    eulers = np.array([[1, -1, 0.5], [-1.5, 0.7, 1.2]])
+    r_matrix = list(R.from_euler('xyz', eulers, degrees=True).as_matrix())
+    interpolated = geometry.project_rigid_transforms_to_MNI(r_matrix, s_matrix, names, data, None, table)
+    exact = geometry.project_rigid_transforms_to_MNI(r_matrix, s_matrix, names, data, None)
+    for x, y in zip(interpolated, exact):
+        error = np.linalg.norm(np.asarray(x[1], dtype=float) - np.asarray(y[1], dtype=float), axis=1)
+        assert np.mean(error) < 1.0 and np.max(error) < 3.0
+    # a table built against other MNI template data or an older projection algorithm is stale
+    standard_data = geometry.to_standard_coordinate_system(names, data)
+    fingerprint = geometry.projection_table_fingerprint(names, standard_data, "head")
+    assert table.fingerprint == fingerprint
+    with monkeypatch.context() as patch:
+        patch.setattr(MNI, "PROJECTION_VERSION", MNI.PROJECTION_VERSION + 1)
+        assert geometry.projection_table_fingerprint(names, standard_data, "head") != fingerprint
+    with monkeypatch.context() as patch:
+        patch.setattr(MNI.get_template_store("resource"), "_fingerprint", "other template data")
+        assert geometry.projection_table_fingerprint(names, standard_data, "head") != fingerprint
+
+
+def test_template_store():
+    """
+    tests that template data is loaded once per process and shared between numpy and torch code paths
+    :return:
+    """
+    store = MNI.get_template_store("resource")
+    assert store is MNI.get_template_store(Path(Path(__file__).parent, "resource"))
+    assert store.surface("head") is store.surface("head")
+    assert not store.surface("head").flags.writeable
+    assert store.anchors.shape == (17, 23, 3)
+    torch_store = MNI_torch.get_torch_template_store("resource", "cpu")
+    assert torch_store is MNI_torch.get_torch_template_store("resource", torch.device("cpu"))
+    assert torch.allclose(torch_store.surface("brain"), torch.tensor(store.surface("brain"), dtype=torch.float))
+
+
+def test_kdtree_surface_lookup(anchors_and_sensors):
+    """
+    tests that the kd-tree nearest surface lookup yields exactly the brute force result
+    :return:
+    """
+    origin_xyz, others_xyz, selected_indices = anchors_and_sensors
+    store = MNI.get_template_store("resource")
+    pointN = len(others_xyz)
+    _, others_transformed_to_ref, _ = MNI.find_affine_transforms(origin_xyz, others_xyz, selected_indices, store.refN, pointN)
+    for surface in ["head", "brain"]:
+        XYZ = store.surface(surface)
+        naive = MNI.find_closest_on_surface_naive(others_transformed_to_ref, XYZ, pointN, True)
+        kd = MNI.find_closest_on_surface_naive(others_transformed_to_ref, XYZ, pointN, True, tree=store.tree(surface))
+        for x, y in zip(naive, kd):
+            assert np.array_equal(x, y)
+
+
+def test_indexed_balloon_inflation(anchors_and_sensors):
+    """
+    tests that the vectorized kd-tree balloon inflation projects exactly like the per sensor loop
+    :return:
+    """
+    origin_xyz, others_xyz, selected_indices = anchors_and_sensors
+    refN, pointN = 17, len(others_xyz)
+    _, others_transformed_to_ref, _ = MNI.find_affine_transforms(origin_xyz, others_xyz, selected_indices, refN, pointN)
+    loop = MNI.find_closest_on_surface_full(others_transformed_to_ref, refN, pointN, "resource", use_kdtree=False)
+    indexed = MNI.find_closest_on_surface_full(others_transformed_to_ref, refN, pointN, "resource", use_kdtree=True)
+    assert np.all(np.isclose(loop, indexed))
+    parallel = MNI.find_closest_on_surface_full(others_transformed_to_ref, refN, pointN, "resource", workers=4)
+    assert np.array_equal(indexed, parallel)
+
+
+def test_MNI_projection_head_only(anchors_and_sensors):
+    """
+    tests that projecting only onto the head surface skips the cortex but yields the same head projection
+    :return:
+    """
+    origin_xyz, others_xyz, selected_indices = anchors_and_sensors
+    otherH, _, otherHSD, _, _ = MNI.project(origin_xyz, others_xyz, selected_indices, output_errors=True)
+    head_only = MNI.project(origin_xyz, others_xyz, selected_indices, output_errors=True, surfaces=("head",))
+    assert np.array_equal(otherH, head_only[0])
+    assert np.array_equal(otherHSD, head_only[2])
+    assert head_only[1] is None and head_only[3] is None
+
+
+def test_MNI_projection_batch(anchors_and_sensors):
+    """
+    tests that projecting a batch of clouds at once is the same as projecting them one by one
+    :return:
+    """
+    origin_xyz, others_xyz, selected_indices = anchors_and_sensors
+    origins_xyz = np.stack([origin_xyz, origin_xyz + np.random.normal(scale=1, size=origin_xyz.shape)])
+    batch_others_xyz = np.stack([others_xyz, others_xyz + np.random.normal(scale=1, size=others_xyz.shape)])
+    batched = MNI.project_batch(origins_xyz, batch_others_xyz, selected_indices, output_errors=True)
+    for i in range(len(origins_xyz)):
+        single = MNI.project(origins_xyz[i], batch_others_xyz[i], selected_indices, output_errors=True)
+        for x, y in zip(single, batched):
+            assert np.all(np.isclose(x, y[i]))
+    # both apis default to not computing errors
+    batched = MNI.project_batch(origins_xyz, batch_others_xyz, selected_indices, surfaces=("head",))
+    single = MNI.project(origins_xyz[0], batch_others_xyz[0], selected_indices, surfaces=("head",))
+    assert np.all(np.isclose(single[0], batched[0][0])) and np.array_equal(single[2], batched[2][0])
+
+
+def test_projection_variance():
+    """
+    tests the vectorized variance of the transformed sensors around their projection (numpy and torch)
+    :return:
+    """
+    othersRefList = np.random.normal(scale=5, size=(17, 10, 3))
+    other = np.random.normal(size=(10, 3))
+    variance = MNI.projection_variance(othersRefList, other)
+    for i in range(10):
+        XYZSS = np.sum((othersRefList[:, i] - other[i]) ** 2, axis=0)
+        assert np.allclose(variance[i], np.append(XYZSS, np.sum(XYZSS)) / 16)
+    torch_variance = MNI_torch.torch_projection_variance(torch.from_numpy(othersRefList), torch.from_numpy(other))
+    assert np.allclose(torch_variance.numpy(), variance)
+
+
+def project_in_worker(origin_xyz, others_xyz, selected_indices):
+    store = MNI.get_template_store("resource")
+    return store.shared, MNI.project(origin_xyz, others_xyz, selected_indices, memoize=False)[:2]
+
+
+def test_compiled_template_bundle(tmp_path, monkeypatch, caplog):
+    """
+    tests compiled template bundles match the .npy template data, and that stale or corrupt bundles are rejected
+    (projections then fall back to the .npy data)
+    :return:
+    """
+    import shutil
+    source, folder = Path("resource", "MNI_templates"), Path(tmp_path, "MNI_templates")
+    folder.mkdir()
+    files = ["DMNI{:0>4d}.{}".format(i, ext) for i in range(1, 18) for ext in ("csv", "npy")] + ["xyzallHEM.npy"]
+    files += ["{}all{}.csv".format(axis, surface) for axis in "xyz" for surface in ("HEM", "BEM", "M01", "M02")]
+    for name in files:
+        shutil.copy(Path(source, name), folder)
+    anchors = np.stack([np.load(Path(source, "DMNI{:0>4d}.npy".format(i))) for i in (1, 2)])
+    expected = {"anchors": anchors, "head": np.load(Path(source, "xyzallHEM.npy")),
+                "brain": np.load(Path(source, "xyzallBEM.npy")),
+                0: np.load(Path(source, "xyzall1.npy")), 1: np.load(Path(source, "xyzall2.npy"))}
+    for dtype in (np.float64, np.float32):
+        path = MNI.compile_template_bundle(tmp_path, dtype, refN=2)
+        assert path == MNI.template_bundle_path(tmp_path, dtype)
+        bundle = MNI.load_template_bundle(path)
+        assert set(bundle) == set(expected)
+        for key, array in expected.items():
+            assert bundle[key].dtype == dtype and np.array_equal(bundle[key], array.astype(dtype))
+    path = MNI.template_bundle_path(tmp_path)
+    with monkeypatch.context() as patch:
+        patch.setattr(MNI, "TEMPLATE_BUNDLE_VERSION", MNI.TEMPLATE_BUNDLE_VERSION + 1)
+        with pytest.raises(ValueError, match="incompatible"):
+            MNI.load_template_bundle(path)
+    contents = bytearray(path.read_bytes())
+    path.write_bytes(b"X" + bytes(contents[1:]))
+    with pytest.raises(ValueError, match="incompatible"):
+        MNI.load_template_bundle(path)
+    contents[-1] ^= 0xFF
+    path.write_bytes(bytes(contents))
+    with pytest.raises(ValueError, match="corrupted"):
+        MNI.load_template_bundle(path)
+    store = MNI.get_template_store(tmp_path, np.float64)
+    assert store.bundle is None and "ignoring template bundle" in caplog.text
+    assert np.array_equal(store.surface("head"), expected["head"])
+    assert np.array_equal(store.anchors[:2], anchors)
+
+
+def test_shared_template_bundle(anchors_and_sensors):
+    """
+    tests that worker processes attached to a shared template bundle project exactly like the parent
+    :return:
+    """
+    origin_xyz, others_xyz, selected_indices = anchors_and_sensors
+    # not memoized, so the worker projects from the bundle instead of an inherited cache entry
+    otherH, otherC, _, _, _ = MNI.project(origin_xyz, others_xyz, selected_indices, memoize=False)
+    with MNI.SharedTemplateBundle("resource") as bundle:
+        with bundle.process_pool(2) as pool:
+            shared, (workerH, workerC) = pool.submit(project_in_worker, origin_xyz, others_xyz, selected_indices).result()
+    assert shared
+    assert np.array_equal(otherH, workerH) and np.array_equal(otherC, workerC)
+    assert not Path(bundle.path).exists()
+
+
+def test_voxel_grid_head_lookup(anchors_and_sensors):
+    """
+    tests that the approximate voxel grid head lookup is close to the exact one
+    :return:
+    """
+    origin_xyz, others_xyz, selected_indices = anchors_and_sensors
+    store = MNI.get_template_store("resource")
+    voxel_grid = store.voxel_grid("head", voxel_size=4.0)
+    pointN = len(others_xyz)
+    _, others_transformed_to_ref, _ = MNI.find_affine_transforms(origin_xyz, others_xyz, selected_indices, store.refN, pointN)
+    XYZ = store.surface("head")
+    exact, _, _ = MNI.find_closest_on_surface_naive(others_transformed_to_ref, XYZ, pointN, tree=store.tree("head"))
+    approximate, _, _ = MNI.find_closest_on_surface_naive(others_transformed_to_ref, XYZ, pointN, voxel_grid=voxel_grid)
+    assert np.all(voxel_grid.lookup(np.mean(others_transformed_to_ref, axis=0))[1])
+    assert np.max(np.linalg.norm(exact - approximate, axis=1)) < 4.0
+    _, found = voxel_grid.lookup(np.array([[1000., 1000., 1000.]]))
+    assert not found[0]
+
+
+def test_voxel_grid_rebuilt_for_other_surface(tmp_path, caplog):
+    """
+    tests that a persisted voxel grid is only reused for the surface (and dtype) it was built from
+    :return:
+    """
+    import logging
+    caplog.set_level(logging.INFO)
+    folder = Path(tmp_path, "MNI_templates")
+    folder.mkdir()
+    rng = np.random.default_rng(0)
+    sphere = rng.normal(size=(500, 3))
+    sphere = 50 * sphere / np.linalg.norm(sphere, axis=1, keepdims=True)
+
+    def voxel_grid(surface, dtype=np.float64):
+        np.save(Path(folder, "xyzallHEM.npy"), surface)
+        caplog.clear()
+        grid = MNI.TemplateStore(str(tmp_path), dtype=dtype).voxel_grid("head", voxel_size=8.0, band=10.0)
+        return grid, "building head voxel grid" in caplog.text
+
+    _, built = voxel_grid(sphere)
+    assert built
+    _, built = voxel_grid(sphere)
+    assert not built
+    grid, built = voxel_grid(sphere + 100)
+    assert built and np.all(grid.lookup(sphere + 100)[1]) and not np.any(grid.lookup(sphere)[1])
+    _, built = voxel_grid(sphere + 100, np.float32)
+    assert built
+
+
+def test_chunked_projection_resumes(anchors_and_sensors, tmp_path):
+    """
+    tests that the chunked (memory bounded) projection matches the batched one and resumes after an interruption
+    :return:
+    """
+    origin_xyz, others_xyz, selected_indices = anchors_and_sensors
+    clouds = others_xyz[None, :4] + np.random.normal(scale=1, size=(6, 4, 3))
+    origin_xyz_torch = torch.from_numpy(origin_xyz).float()
+    selected_indices_torch = torch.from_numpy(selected_indices)
+    expected, _, _ = MNI_torch.torch_project_non_differentiable(origin_xyz_torch,
+                                                                torch.from_numpy(clouds).float().reshape(1, -1, 3),
+                                                                selected_indices_torch)
+    expected = expected.reshape(6, 4, 3).numpy()
+    output_path = Path(tmp_path, "projected.npy")
+    budget = 2 * MNI_torch.estimate_projection_memory(4)  # two clouds per chunk
+    result = MNI_torch.torch_project_non_differentiable_chunked(origin_xyz_torch, clouds, selected_indices_torch,
+                                                                output_path, memory_budget=budget)
+    assert np.allclose(result, expected)
+    # simulate an interruption after the first chunk
+    progress_path = Path(str(output_path) + ".progress.json")
+    progress = json.loads(progress_path.read_text())
+    progress["done"] = 2
+    progress_path.write_text(json.dumps(progress))
+    np.load(output_path, mmap_mode="r+")[2:] = 0
+    result = MNI_torch.torch_project_non_differentiable_chunked(origin_xyz_torch, clouds, selected_indices_torch,
+                                                                output_path, memory_budget=budget)
+    assert np.allclose(result, expected)
+    # different clouds of the same shape are not resumed from the previous output
+    result = MNI_torch.torch_project_non_differentiable_chunked(origin_xyz_torch, clouds[::-1].copy(),
+                                                                selected_indices_torch, output_path, memory_budget=budget)
+    assert np.allclose(result, expected[::-1])
+    assert json.loads(progress_path.read_text())["fingerprint"] != progress["fingerprint"]
+    # reference brains inflated in parallel multiply the peak memory
+    assert MNI_torch.estimate_projection_memory(4, workers=3) == 3 * MNI_torch.estimate_projection_memory(4, workers=1)
+
+
 def test_render():
     names, data, file_format, _ = file_io.read_template_file(Path("../example_models/example_model.txt"))
     data = data[0]  # select first (and only) session
@@ -319,3 +893,152 @@ def test_render():
     X, Y = file_io.load_raw_json_db(render_dir)
     assert X.shape == (1, 10, 14)
     assert Y.shape == (1, 3)
+
+
+def test_batched_gmm_heatmaps():
+    """
+    tests the batched gmm heatmaps match drawing them one landmark set at a time
+    :return:
+    """
+    import torch_src.torch_data as torch_data
+    heat_mapper = torch_data.HeatMap((256, 256), 16, False, "cpu")
+    torch.manual_seed(0)
+    landmarks = torch.rand(5, 7, 2) * 255 + 0.5
+    landmarks[1] = 0  # nothing annotated
+    landmarks[2, [0, 3, 4]] = 0  # partially masked
+    landmarks[3, 1:] = 0  # a single landmark
+    landmarks[4, 2, 0] = 0  # a landmark with one zero coordinate is masked too
+    batched = heat_mapper.draw_gmm_batch(landmarks)
+    assert batched.shape == (5, 1, 256, 256)
+    for i in range(len(landmarks)):
+        assert torch.allclose(batched[i], heat_mapper.draw_gmm(landmarks[i]), atol=1e-5)
+    assert not torch.any(batched[1])
+    assert torch.equal(heat_mapper(landmarks), batched.squeeze(1))
+
+
+def test_batched_prediction():
+    """
+    tests batched prediction matches predicting one sample at a time, and the batched robustness experiment
+    :return:
+    """
+    import torch_src.torch_model as torch_model
+    import predict
+    import experimental
+
+    opt = predict.Options(device="cpu")
+    opt.network_base_channels = 8
+    network = torch_model.MyNetwork(opt)
+    rng = np.random.default_rng(0)
+    sticker_locations = rng.random((5, 10, 14)) * np.array([960, 540] * 7)
+    sticker_locations[rng.random(sticker_locations.shape) < 0.15] = 0
+    x = sticker_locations.copy()
+    predict.preprocess_sticker_locations(x)
+    batched = predict.predict_parameters(x, network, "cpu", batch_size=4)
+    single = predict.predict_parameters(x, network, "cpu", batch_size=1)
+    assert batched.shape == (5, 3) and np.allclose(batched, single, atol=1e-5)
+    robustness = experimental.get_network_robustness(sticker_locations, network, "cpu", [0, 50], trials=2)
+    assert robustness.shape == (2, 3) and np.allclose(robustness[0], 0, atol=1e-3) and np.all(robustness[1] > 0)
+
+
+def test_experiment_graph():
+    """
+    tests independent experiments run concurrently and dependent ones wait for their inputs
+    :return:
+    """
+    import time
+    import experimental
+    nodes = [experimental.ExperimentNode("sleep1", time.sleep, ["delay"]),
+             experimental.ExperimentNode("sleep2", time.sleep, ["delay"]),
+             experimental.ExperimentNode("sum", np.add, ["x", "y"], ["s"]),
+             experimental.ExperimentNode("divmod", divmod, ["s", "y"], ["q", "r"]),
+             experimental.ExperimentNode("product", np.multiply, ["q", "r"], ["p"], main_process=True)]
+    artifacts, timings = experimental.run_experiment_graph(nodes, {"x": 7, "y": 2, "delay": 2}, workers=3)
+    assert artifacts["s"] == 9 and artifacts["q"] == 4 and artifacts["r"] == 1 and artifacts["p"] == 4
+    assert set(timings) == {node.name for node in nodes}
+    assert timings["sleep1"][0] < timings["sleep2"][1] and timings["sleep2"][0] < timings["sleep1"][1]
+    assert timings["sum"][1] <= timings["divmod"][0] and timings["divmod"][1] <= timings["product"][0]
+    path, length = experimental.get_critical_path(nodes, timings)
+    assert path in (["sleep1"], ["sleep2"]) and length >= 2
+    with pytest.raises(AssertionError):
+        experimental.run_experiment_graph([experimental.ExperimentNode("a", np.add, ["b", "x"], ["a"]),
+                                           experimental.ExperimentNode("b", np.add, ["a", "x"], ["b"])], {"x": 1})
+
+
+def test_experiment_graph_logging(caplog):
+    """
+    tests records logged inside worker processes reach the loggers of the parent
+    :return:
+    """
+    import logging
+    import experimental
+    caplog.set_level(logging.INFO)
+    nodes = [experimental.ExperimentNode("log", logging.info, ["message"]),
+             experimental.ExperimentNode("debug", logging.debug, ["debug_message"])]
+    experimental.run_experiment_graph(nodes, {"message": "logged by worker", "debug_message": "dropped by worker"},
+                                      workers=2)
+    messages = [record.getMessage() for record in caplog.records]
+    assert "logged by worker" in messages and "dropped by worker" not in messages
+
+
+def test_distillation_train_loop(tmp_path, caplog):
+    """
+    tests a short distillation run, the teacher predicts the way STORM-Net predicts (see predict.per_sample_batch_norm)
+    :param tmp_path:
+    :return:
+    """
+    import argparse
+    import logging
+    import torch_src.torch_model as torch_model
+    import predict
+    import torch_train
+
+    opt = argparse.Namespace(**vars(predict.Options(device="cpu")))
+    opt.network_base_channels = 8
+    teacher_path = tmp_path / "teacher.pth"
+    torch.save(torch_model.MyNetwork(opt).state_dict(), teacher_path)
+    rng = np.random.default_rng(0)
+    x = rng.random((8, 10, 14))
+    y = rng.uniform(-10, 10, (8, 3))
+    file_io.serialize_data(tmp_path / "data_split.pickle", x[:6], x[6:], y[:6], y[6:])
+    opt.__dict__.update(data_path=tmp_path, root=tmp_path, experiment_name="student", teacher=teacher_path,
+                        student_base_channels=4, distill_alpha=0.5, loss_alpha=0.1, dont_use_gmm=False,
+                        force_load_raw_data=False, continue_train=False, batch_size=3, batch_accumulation=1,
+                        number_of_epochs=1, lr=1e-4, beta1=0.9, num_threads=0, tensorboard=None,
+                        create_new_checkpoints_per_epoch=False)
+    teacher = torch_train.load_teacher(opt)
+    assert teacher.training
+    running_mean = [x.running_mean.clone() for x in teacher.modules() if isinstance(x, torch.nn.BatchNorm2d)]
+    torch_train.measure_latency(teacher, torch.rand(1, 10, 256, 256), repeats=2)
+    with torch.no_grad(), predict.per_sample_batch_norm(teacher):
+        teacher(torch.rand(2, 10, 256, 256))
+    after = [x.running_mean for x in teacher.modules() if isinstance(x, torch.nn.BatchNorm2d)]
+    assert all(torch.equal(a, b) for a, b in zip(running_mean, after))
+    caplog.set_level(logging.INFO)
+    torch_train.train_loop(opt)
+    assert (tmp_path / "latest.pth").is_file()
+    assert torch_model.get_base_channels(torch.load(tmp_path / "latest.pth")) == 4
+    assert any("teacher-student euler error" in record.getMessage() for record in caplog.records)
+
+
+def test_distilled_student_prediction(tmp_path):
+    """
+    tests that a narrow (distilled) student checkpoint loads through the regular prediction path
+    :param tmp_path:
+    :return:
+    """
+    import torch_src.torch_model as torch_model
+    import predict
+
+    opt = predict.Options(device="cpu")
+    opt.network_base_channels = 8
+    student = torch_model.MyNetwork(opt)
+    student_path = tmp_path / "student.pth"
+    torch.save(student.state_dict(), student_path)
+
+    class Args:
+        def __init__(self):
+            self.storm_net = student_path
+            self.device = "cpu"
+    sticker_locations = np.random.rand(2, 10, 14) * 500
+    rs, sc = predict.predict_rigid_transform(sticker_locations, None, Args())
+    assert len(rs) == 2 and rs[0].shape == (3, 3)
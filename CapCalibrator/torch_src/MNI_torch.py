@@ -2,6 +2,64 @@ import numpy as np
 from pathlib import Path
 import torch
 import logging
+import threading
+import json
+import os
+import hashlib
+import MNI
+
+
+class TorchTemplateStore:
+    """
+    torch view (on a specific device) of the process-wide MNI template store.
+    tensors are float32 whatever the dtype of the store (the torch path computes in float32).
+    use get_torch_template_store to obtain an instance.
+    """
+    def __init__(self, store, device):
+        self.store = store
+        self.device = device
+        self._lock = threading.Lock()
+        self._anchors = None
+        self._surfaces = {}
+
+    @property
+    def anchors(self):
+        """
+        :return: refN x 23 x 3 float tensor of the 10-20 anchors of every reference brain
+        """
+        if self._anchors is None:
+            anchors = self.store.anchors
+            with self._lock:
+                if self._anchors is None:
+                    self._anchors = torch.tensor(anchors, dtype=torch.float, device=self.device)
+        return self._anchors
+
+    def surface(self, type):
+        """
+        :param type: see MNI.TemplateStore.surface
+        :return: nx3 float tensor of surface points
+        """
+        if type not in self._surfaces:
+            XYZ = self.store.surface(type)
+            with self._lock:
+                if type not in self._surfaces:
+                    self._surfaces[type] = torch.tensor(XYZ, dtype=torch.float, device=self.device)
+        return self._surfaces[type]
+
+
+def get_torch_template_store(resource_folder="resource", device="cpu"):
+    """
+    returns the torch view of the (process-wide) template store on a device, creating it if needed
+    :param resource_folder: relative path to the folder with the raw template data
+    :param device: the device the tensors reside on
+    :return: a TorchTemplateStore
+    """
+    store = MNI.get_template_store(resource_folder)
+    key = ("torch", str(torch.device(device)))
+    with store._lock:
+        if key not in store.views:
+            store.views[key] = TorchTemplateStore(store, device)
+        return store.views[key]
 
 
 def torch_find_affine_transforms(our_anchors_xyz, our_sensors_xyz, selected_indices, refN, pointN, resource_folder="resource"):
@@ -11,7 +69,8 @@ def torch_find_affine_transforms(our_anchors_xyz, our_sensors_xyz, selected_indi
     :param our_sensors_xyz: our sensors (on head surface)
     :param selected_indices: our selected anchors out of the 23 10-20 points
     :param refN: number of reference brains in template data
-    :return: numpy array of size refN x number_of_sensors x 3
+    :return: tensor of size refN x number_of_sensors x 3 (batch_size x refN x number_of_sensors x 3 if our sensors
+    are batched, i.e. batch_size x number_of_sensors x 3)
     represents for each refernce brain all our sensors locations in its frame of reference
     """
     # path_wo_ext = "resource/MNI_templates/DMNIHAve"
@@ -28,18 +87,7 @@ def torch_find_affine_transforms(our_anchors_xyz, our_sensors_xyz, selected_indi
     device = our_anchors_xyz.device
     A = torch.cat((our_anchors_xyz, torch.ones((size, 1), device=device)), dim=-1)
     A = A.repeat(refN, 1).reshape((refN, size, 4))
-    # load 17 brain templates from disk
-    DMS = []
-    for i in range(1, refN+1):
-        path_wo_ext = resource_folder+"/MNI_templates/DMNI{:0>4d}".format(i)
-        if Path(path_wo_ext+".npy").is_file():
-            DMS.append(np.load(path_wo_ext+".npy", allow_pickle=True))
-        else:
-            csv_path = Path(path_wo_ext+".csv")
-            DM = np.genfromtxt(csv_path, delimiter=',')
-            np.save(path_wo_ext, DM)
-            DMS.append(DM)
-    B = torch.FloatTensor(DMS).to(device)
+    B = get_torch_template_store(resource_folder, device).anchors
     B = B[:, selected_indices, :]
     B = torch.cat((B, torch.ones((refN, size, 1), device=device)), dim=-1)
     # W = A.pinverse() @ B
@@ -47,91 +95,104 @@ def torch_find_affine_transforms(our_anchors_xyz, our_sensors_xyz, selected_indi
     # test = np.all(np.isclose(W, W_test, atol=1e-4))
     # W = torch.linalg.lstsq(A, B).solution
     # find affine transformation between our anchors and all brains
-    DDDD = torch.cat((our_sensors_xyz, torch.ones((pointN, 1), device=device)), dim=-1)
-    DDDD = DDDD.repeat(refN, 1).reshape((refN, pointN, 4))
-    return torch.bmm(DDDD, W)[:, :, :3]
+    DDDD = torch.cat((our_sensors_xyz, torch.ones(our_sensors_xyz.shape[:-1] + (1,), device=device)), dim=-1)
+    return torch.matmul(DDDD.unsqueeze(-3), W)[..., :3]
 
 
 def k_softmin(k, x):
-    nominator = torch.exp(-k * x)
-    demonimator = torch.sum(torch.exp(-k * x), dim=-1, keepdim=True)
-    return nominator / demonimator
+    # softmax subtracts the minimum distance first, so far away points do not underflow to 0 / 0
+    return torch.softmax(-k * x, dim=-1)
+
+
+def torch_surface_candidates(points, XYZ, top_k, tree=None, chunk_size=256):
+    """
+    finds the indices of the top_k surface points closest to every point (not differentiable)
+    :param points: nx3 tensor of points
+    :param XYZ: mx3 tensor of surface points
+    :param top_k: number of candidates per point
+    :param tree: kd-tree over XYZ (see MNI.TemplateStore.tree), if None candidates are found with torch.cdist
+    :param chunk_size: number of points per torch.cdist call (bounds memory to chunk_size x m distances)
+    :return: n x top_k long tensor of indices into XYZ
+    """
+    top_k = min(top_k, len(XYZ))
+    if tree is not None:
+        _, indices = tree.query(points.detach().cpu().numpy(), k=top_k)
+        return torch.from_numpy(indices.reshape(len(points), top_k)).to(points.device)
+    candidates = []
+    with torch.no_grad():
+        for chunk in torch.split(points, chunk_size):
+            candidates.append(torch.topk(torch.cdist(chunk, XYZ), top_k, dim=-1, largest=False).indices)
+    return torch.cat(candidates)
 
 
-def torch_find_closest_on_surface(others, refN, pointN, soft_dist_func="softkmin", resource_folder="resource"):
+def torch_find_closest_on_surface(others, refN, pointN, soft_dist_func="softkmin", resource_folder="resource",
+                                  top_k=32, use_kdtree=True):
+    """
+    differentiable projection of sensors onto the surface of every reference brain.
+    every sensor is replaced by a soft-min weighted average of its top_k closest surface points,
+    gradients flow through the distances to these candidates.
+    :param others: (batch_size x) refN x pointN x 3 tensor of sensors in every reference brain frame of reference
+    :param refN: number of reference brains in template data
+    :param pointN: number of sensors
+    :param soft_dist_func: soft minimum function to use
+    :param resource_folder: relative path to the folder with the raw template data
+    :param top_k: number of surface candidates per sensor, far away points have negligible weights anyway
+    :param use_kdtree: if true candidates are found with a kd-tree (on cpu), else with chunked torch.cdist
+    :return: (batch_size x) pointN x 3 tensor, the projected sensors averaged over reference brains
+    """
     k = 10
-    new_others = torch.empty(others.shape, device=others.device)
+    templates = get_torch_template_store(resource_folder, others.device)
+    new_others = []
     for i in range(refN):
-        my_str = resource_folder+"/MNI_templates/xyzall{}.npy".format(str(i + 1))
-        xyz = load_raw_MNI_data(my_str, i, resource_folder)
-        xyz = torch.FloatTensor(xyz).to(others.device)
-        single_instance = others[i].unsqueeze(1)
-        distances = torch.linalg.norm(single_instance - xyz.repeat(85, 1, 1), dim=-1).double()
-        # hard_min = torch.min(distances, dim=-1).values
-        # other_soft_min = torch.topk(distances, 1000, dim=-1, largest=False)
+        xyz = templates.surface(i)
+        points = others[..., i, :, :].reshape(-1, 3)
+        tree = templates.store.tree(i) if use_kdtree else None
+        candidates = xyz[torch_surface_candidates(points, xyz, top_k, tree)]
+        distances = torch.linalg.norm(points.unsqueeze(1) - candidates, dim=-1)
         if soft_dist_func == "softkmin":
             x = k_softmin(k, distances)
-            p = (x.float() @ xyz)
+            p = torch.einsum("nk,nkd->nd", x, candidates)
         else:
             raise NotImplementedError
-        # p_real = xyz[torch.argmin(distances, dim=-1)]
-        # print("error: ", torch.mean(torch.norm(p - p_real, dim=1)))
-        new_others[i] = p
-    return torch.mean(new_others, axis=0)
+        new_others.append(p.reshape(others[..., i, :, :].shape))
+    return torch.mean(torch.stack(new_others), dim=0)
 
 
 def load_raw_MNI_data(location, type, resource_folder):
     """
-    loads raw MNi data from disk
-    :param location: where is the data located
-    :param type: what does the data represent
-     "brain" = average brain surface,
-     "head" = average head surface,
-      or number indicating reference brain index (brain surface data))
-    :return:
+    loads raw MNi data from disk (see MNI.load_raw_MNI_data)
+    note: prefer MNI.get_template_store which loads the data only once per process
+    """
+    return MNI.load_raw_MNI_data(location, type, resource_folder)
+
+
+def torch_project(origin_xyz, others_xyz, selected_indices, resource_folder="resource", top_k=32, use_kdtree=True):
+    """
+    differentiable MNI projection (head surface of reference brains, see torch_find_closest_on_surface)
+    :param origin_xyz: our anchors
+    :param others_xyz: batch_size x number_of_sensors x 3 tensor of our sensors
+    :param selected_indices: our selected anchors out of the 23 10-20 points
+    :param resource_folder: relative path to the folder with the raw template data
+    :param top_k: see torch_find_closest_on_surface
+    :param use_kdtree: see torch_find_closest_on_surface
+    :return: batch_size x number_of_sensors x 3 tensor of projected sensors
     """
-    if type == "brain":
-        shortcut = "BEM"
-    elif type == "head":
-        shortcut = "HEM"
-    else:
-        shortcut = "M0" + str(type + 1)
-    my_str = location
-    if Path(my_str).is_file():
-        XYZ = np.load(my_str, allow_pickle=True)
-    else:
-        xallbemPath = Path(resource_folder+"/MNI_templates/xall"+shortcut+".csv")
-        yallbemPath = Path(resource_folder+"/MNI_templates/yall"+shortcut+".csv")
-        zallbemPath = Path(resource_folder+"/MNI_templates/zall"+shortcut+".csv")
-        xallBEM = np.genfromtxt(xallbemPath, delimiter=',')
-        yallBEM = np.genfromtxt(yallbemPath, delimiter=',')
-        zallBEM = np.genfromtxt(zallbemPath, delimiter=',')
-        XYZ = np.column_stack((xallBEM, yallBEM, zallBEM))
-        np.save(location, XYZ)
-    return XYZ
-
-
-def torch_project(origin_xyz, others_xyz, selected_indices, resource_folder="resource"):
     refN = 17  # number of reference brains
-    batch_size = others_xyz.shape[0]
     pointN = others_xyz.shape[1]  # number of sensors to project
-    # get sensors transformed into reference brains coordinate systems
-    for i in range(batch_size):
-        others_transformed_to_ref = torch_find_affine_transforms(origin_xyz,
-                                                                 others_xyz[i],
-                                                                 selected_indices,
-                                                                 refN,
-                                                                 pointN,
-                                                                 resource_folder)
-        if torch.any(torch.isnan(others_transformed_to_ref)):
-            logging.info("nans in torch affine !!")
-        # XYZ = load_raw_MNI_data("resource/MNI_templates/xyzallBEM.npy", "brain")
-        # XYZ = torch.FloatTensor(XYZ, device=others_xyz.device)
-        projected_sensors = torch_find_closest_on_surface(others_transformed_to_ref, refN, pointN, soft_dist_func="softkmin", resource_folder=resource_folder)
-        if torch.any(torch.isnan(projected_sensors)):
-            logging.info("nans in torch project !!")
-        others_xyz[i] = projected_sensors
-    return others_xyz
+    # get sensors transformed into reference brains coordinate systems (all batch at once)
+    others_transformed_to_ref = torch_find_affine_transforms(origin_xyz,
+                                                             others_xyz,
+                                                             selected_indices,
+                                                             refN,
+                                                             pointN,
+                                                             resource_folder)
+    if torch.any(torch.isnan(others_transformed_to_ref)):
+        logging.info("nans in torch affine !!")
+    projected_sensors = torch_find_closest_on_surface(others_transformed_to_ref, refN, pointN, soft_dist_func="softkmin",
+                                                      resource_folder=resource_folder, top_k=top_k, use_kdtree=use_kdtree)
+    if torch.any(torch.isnan(projected_sensors)):
+        logging.info("nans in torch project !!")
+    return projected_sensors
 
 
 def torch_find_affine_transforms_non_diff(our_anchors_xyz, our_sensors_xyz, selected_indices, refN, pointN, resource_folder="resource"):
@@ -141,7 +202,8 @@ def torch_find_affine_transforms_non_diff(our_anchors_xyz, our_sensors_xyz, sele
     :param our_sensors_xyz: our sensors (on head surface)
     :param selected_indices: our selected anchors out of the 23 10-20 points
     :param refN: number of reference brains in template data
-    :return: numpy array of size refN x number_of_sensors x 3
+    :return: tensor of size refN x number_of_sensors x 3 (batch_size x refN x number_of_sensors x 3 if our sensors
+    are batched, i.e. batch_size x number_of_sensors x 3)
     represents for each refernce brain all our sensors locations in its frame of reference
     """
     # path_wo_ext = "resource/MNI_templates/DMNIHAve"
@@ -156,38 +218,48 @@ def torch_find_affine_transforms_non_diff(our_anchors_xyz, our_sensors_xyz, sele
     size = len(selected_indices)
     assert size >= 4
     device = our_anchors_xyz.device
-    A = torch.cat((our_anchors_xyz, torch.ones((size, 1), device=device)), dim=-1)
-    A = A.repeat(refN, 1).reshape((refN, size, 4))
-    # load 17 brain templates from disk
-    DMS = []
-    for i in range(1, refN+1):
-        path_wo_ext = resource_folder+"/MNI_templates/DMNI{:0>4d}".format(i)
-        if Path(path_wo_ext+".npy").is_file():
-            DMS.append(np.load(path_wo_ext+".npy", allow_pickle=True))
-        else:
-            csv_path = Path(path_wo_ext+".csv")
-            DM = np.genfromtxt(csv_path, delimiter=',')
-            np.save(path_wo_ext, DM)
-            DMS.append(DM)
-    B = torch.FloatTensor(DMS).to(device)
-    B = B[:, selected_indices, :]
-    B = torch.cat((B, torch.ones((refN, size, 1), device=device)), dim=-1)
-    W = torch.linalg.lstsq(A, B).solution
+
+    def compute_transforms():
+        A = torch.cat((our_anchors_xyz, torch.ones((size, 1), device=device)), dim=-1)
+        A = A.repeat(refN, 1).reshape((refN, size, 4))
+        B = get_torch_template_store(resource_folder, device).anchors
+        B = B[:, selected_indices, :]
+        B = torch.cat((B, torch.ones((refN, size, 1), device=device)), dim=-1)
+        return torch.linalg.lstsq(A, B).solution.detach()
+    # transforms only depend on the anchors, so they are cached and reused by later projections with the same anchors
+    key = ("torch", str(device), refN, MNI.affine_cache_key(our_anchors_xyz.detach().cpu().numpy(),
+                                                           torch.as_tensor(selected_indices).cpu().numpy(),
+                                                           resource_folder))
+    W = MNI.get_cached_affine_transforms(key, compute_transforms)
     # W = A.pinverse() @ B
     # W = torch.linalg.lstsq(A, B).solution
     # find affine transformation between our anchors and all brains
     DDDD = torch.cat((our_sensors_xyz, torch.ones((pointN, 1), device=device)), dim=-1)
-    DDDD = DDDD.repeat(refN, 1).reshape((refN, pointN, 4))
-    return torch.bmm(DDDD, W)[:, :, :3]
+    return torch.matmul(DDDD, W)[:, :, :3]
 
 
-def torch_find_closest_on_surface_naive(othersRefList, XYZ, pointN, calc_sd_and_var=False):
+def torch_projection_variance(othersRefList, other):
+    """
+    torch version of MNI.projection_variance
+    :param othersRefList: the refN x pointN x 3 transformed sensor locations (into ref brains)
+    :param other: pointN x 3 projected sensor locations
+    :return: pointN x 4 variance per axis, last channel is the variance across all axes (sum of squares)
+    """
+    N = othersRefList.shape[0]
+    dispEach = othersRefList - other
+    XYZSS = torch.sum(dispEach * dispEach, dim=0)
+    RSS = torch.sum(XYZSS, dim=1, keepdim=True)
+    return torch.cat((XYZSS, RSS), dim=1) / (N - 1)
+
+
+def torch_find_closest_on_surface_naive(othersRefList, XYZ, pointN, calc_sd_and_var=False, tree=None):
     """
     finds closest point on cortical surface for every (transformed) sensor location
     by averaging over 3 closest points on cortical surface
     :param othersRefList: the refN x pointN x 3 transformed sensor locations (into ref brains)
     :param XYZ the raw measurements from template reference brains
     :param pointN: number of sensors
+    :param tree: optional kd-tree over XYZ (see MNI.TemplateStore.tree), if given all sensors are queried in one batch
     :return:
     other - location on cortical surface per sensor
     otherVar - variance of each otherH sensor
@@ -198,51 +270,68 @@ def torch_find_closest_on_surface_naive(othersRefList, XYZ, pointN, calc_sd_and_
     otherVar = torch.ones((pointN, 4)).to(device)
     otherSD = torch.ones((pointN, 4)).to(device)
     top = 3
-    for i in range(pointN):
-        AA = torch.mean(othersRefList[:, i], dim=0)
-        PP = torch.broadcast_to(AA, XYZ.shape)
-        D = torch.linalg.norm(XYZ - PP, dim=1)
-        XYZtop = XYZ[torch.topk(D, largest=False, k=top).indices, :]
-        closest = torch.mean(XYZtop, dim=0)
-        other[i, :] = closest
-        if calc_sd_and_var:
-            AAA = othersRefList[:, i]
-            AV = closest
-            N = AAA.shape[0]
-            subMat = torch.ones(AAA.shape).to(device)
-            for j in range(N):
-                subMat[j, :] = AV
-
-            dispEach = AAA - subMat
-            dispEachSq = dispEach * dispEach
-            XYZSS = torch.sum(dispEachSq, dim=0)
-            RSS = torch.sum(XYZSS)
-
-            XYZVar = XYZSS / (N - 1)
-            RSSVar = RSS / (N - 1)
-
-            VV = torch.cat((XYZVar, RSSVar.unsqueeze(0)))
-            otherVar[i, :] = VV
-            otherSD[i, :] = torch.sqrt(VV)
+    if tree is not None:
+        _, IDtop = tree.query(torch.mean(othersRefList, dim=0).cpu().numpy(), k=top)
+        other[:] = torch.mean(XYZ[torch.from_numpy(IDtop).to(XYZ.device)], dim=1)
+    if tree is None:
+        for i in range(pointN):
+            AA = torch.mean(othersRefList[:, i], dim=0)
+            PP = torch.broadcast_to(AA, XYZ.shape)
+            D = torch.linalg.norm(XYZ - PP, dim=1)
+            XYZtop = XYZ[torch.topk(D, largest=False, k=top).indices, :]
+            other[i, :] = torch.mean(XYZtop, dim=0)
+    if calc_sd_and_var:
+        otherVar = torch_projection_variance(othersRefList, other)
+        otherSD = torch.sqrt(otherVar)
     return other, otherVar, otherSD
 
 
-def torch_find_closest_on_surface_full(othersRefList, refN, pointN, resource_folder):
+def torch_balloon_inflation(P, XYZ, tree):
+    """
+    vectorized balloon inflation (see MNI.balloon_inflation) of all sensors onto a single reference brain
+    :param P: pointN x 3 transformed sensor locations (into the ref brain)
+    :param XYZ: the cortical surface of the ref brain
+    :param tree: kd-tree over XYZ (queried on cpu)
+    :return: pointN x 3 locations of the sensors projected onto the cortical surface
+    """
+    top = round(XYZ.shape[0] * 0.05)  # select 5% of data (original paper selects 1000 points)
+    Nclose = 200
+    _, IDtop = tree.query(P.detach().cpu().numpy(), k=top)  # sorted by distance from P
+    XYZtop = XYZ[torch.from_numpy(IDtop).to(XYZ.device)]
+    PNear = torch.mean(XYZtop[:, :Nclose], dim=1)  # select mean of closest 200 points
+    line = (PNear - P).unsqueeze(1)
+    distance_from_line = torch.linalg.norm(torch.cross(torch.broadcast_to(line, XYZtop.shape), XYZtop - P.unsqueeze(1), dim=-1) /
+                                           torch.linalg.norm(line, dim=-1, keepdim=True), dim=-1)
+    # inflate the rod 1mm at a time until it contains a point, i.e. smallest integer radius >= closest distance
+    rodR = torch.clamp(torch.ceil(torch.min(distance_from_line, dim=1).values), min=1)
+    in_rod = distance_from_line <= rodR.unsqueeze(1)
+    # Find brain surface points on the vicinity of P (l 862), XYZtop is already sorted by distance from P
+    NVic = 3
+    Vic = (in_rod & (torch.cumsum(in_rod, dim=1) <= NVic)).float()
+    return torch.sum(XYZtop * Vic.unsqueeze(-1), dim=1) / torch.sum(Vic, dim=1, keepdim=True)
+
+
+def torch_find_closest_on_surface_full(othersRefList, refN, pointN, resource_folder, use_kdtree=True, workers=None):
     """
     full implementation of cortical projection using the balloon inflation algorithm described in
     https://doi.org/10.1016/j.neuroimage.2005.01.018
     :param othersRefList: the refN x pointN x 3 transformed sensor locations (into ref brains)
     :param refN: number of reference brains
     :param pointN: number of sensors
+    :param use_kdtree: if true, uses the kd-tree of every ref brain and inflates rods of all sensors at once
+    :param workers: number of threads projecting onto the ref brains in parallel (see MNI.map_reference_brains)
     :return:
     """
     device = othersRefList.device
     otherRefCList = torch.empty((refN, pointN, 3), dtype=torch.float).to(device)
     # otherRefCList = np.empty((1, refN), dtype=object)
-    for i in range(refN):
-        my_str = resource_folder+"/MNI_templates/xyzall{}.npy".format(str(i + 1))
-        XYZ = load_raw_MNI_data(my_str, i, resource_folder=resource_folder)
-        XYZ = torch.FloatTensor(XYZ).to(othersRefList.device).to(device)
+    templates = get_torch_template_store(resource_folder, device)
+
+    def project_onto_ref(i):
+        XYZ = templates.surface(i)
+        if use_kdtree:
+            otherRefCList[i] = torch_balloon_inflation(othersRefList[i, :, :3], XYZ, templates.store.tree(i))
+            return
         projectionListC = torch.ones((pointN, 3)).to(device)
         for j in range(pointN):
             P = othersRefList[i, j, :3]
@@ -281,10 +370,12 @@ def torch_find_closest_on_surface_full(othersRefList, refN, pointN, resource_fol
 
             projectionListC[j, :] = CP
         otherRefCList[i] = projectionListC
+    MNI.map_reference_brains(project_onto_ref, refN, workers)
     return otherRefCList
 
 
-def torch_project_non_differentiable(origin_xyz, others_xyz, selected_indices, output_errors=False, resource_folder="resource"):
+def torch_project_non_differentiable(origin_xyz, others_xyz, selected_indices, output_errors=False, resource_folder="resource",
+                                     workers=None):
     """
     projects others_xyz to MNI coordiantes given anchors in origin_xyz
     :param origin_xyz: anchors given as nx3 np array (n >= 4)
@@ -299,6 +390,7 @@ def torch_project_non_differentiable(origin_xyz, others_xyz, selected_indices, o
                               "t6", "o1", "o2"]
     :param output_errors: whether to output error in estimation as well.
     :param resource_folder: relative path to the fodler with the raw template data
+    :param workers: number of threads used for the cortical projection (see MNI.map_reference_brains)
     :return: others_batched - others transformed to MNI of ideal head  (cortical surface)
              others_sd_batched - standard deviation error per axis, point manner (for others_batched).
                         Last channel is SD across all axes (root sum of squares).
@@ -317,11 +409,100 @@ def torch_project_non_differentiable(origin_xyz, others_xyz, selected_indices, o
                                                            refN,
                                                            pointN,
                                                            resource_folder)
-        others_projected_to_ref = torch_find_closest_on_surface_full(others_transformed_to_ref, refN, pointN, resource_folder=resource_folder)
-        XYZ = load_raw_MNI_data(resource_folder+"/MNI_templates/xyzallBEM.npy", "brain", resource_folder=resource_folder)
-        XYZ = torch.FloatTensor(XYZ).to(others_xyz.device)
+        others_projected_to_ref = torch_find_closest_on_surface_full(others_transformed_to_ref, refN, pointN, resource_folder=resource_folder,
+                                                                     workers=workers)
+        templates = get_torch_template_store(resource_folder, others_xyz.device)
+        XYZ = templates.surface("brain")
         # get closest points of projected sensors on average cortical surface
-        otherC, otherCV, otherCSD = torch_find_closest_on_surface_naive(others_projected_to_ref, XYZ, pointN, output_errors)
+        otherC, otherCV, otherCSD = torch_find_closest_on_surface_naive(others_projected_to_ref, XYZ, pointN, output_errors,
+                                                                        tree=templates.store.tree("brain"))
         others_batched[i] = otherC
         others_sd_batched[i] = otherCSD
     return others_batched.squeeze(), others_sd_batched.squeeze(), torch.mean(others_projected_to_ref, dim=0)
+
+
+def estimate_projection_memory(pointN, resource_folder="resource", workers=None):
+    """
+    estimates the peak memory (bytes) needed by torch_project_non_differentiable for a number of sensors
+    (dominated by the candidate points considered by the balloon inflation of every sensor)
+    :param pointN: number of sensors projected at once
+    :param resource_folder: relative path to the folder with the raw template data
+    :param workers: number of threads used for the cortical projection (reference brains inflated at once)
+    :return: estimated bytes
+    """
+    store = MNI.get_template_store(resource_folder)
+    top = round(max(store.surface(i).shape[0] for i in range(store.refN)) * 0.05)
+    # candidates (xyz, offsets from sensor, cross products: 3 x 12 bytes), distances, indices, masks per candidate
+    return pointN * top * 64 * MNI.get_reference_brain_workers(workers, store.refN)
+
+
+def projection_input_fingerprint(origin_xyz, others_xyz, selected_indices, resource_folder, chunk_size=65536):
+    """
+    :param origin_xyz: anchors (tensor or np array)
+    :param others_xyz: bxmx3 np array of optodes (can be memory mapped)
+    :param selected_indices: anchor indices (tensor or np array)
+    :param resource_folder: relative path to the folder with the raw template data
+    :param chunk_size: number of clouds hashed at once
+    :return: a string identifying the inputs of a chunked projection
+    """
+    h = hashlib.sha1(str(Path(resource_folder).resolve()).encode())
+    for x in (origin_xyz, selected_indices):
+        x = x.detach().cpu().numpy() if torch.is_tensor(x) else np.asarray(x)
+        h.update(str((x.shape, x.dtype.str)).encode())
+        h.update(np.ascontiguousarray(x).tobytes())
+    h.update(str(others_xyz.shape).encode())
+    for start in range(0, len(others_xyz), chunk_size):
+        h.update(np.ascontiguousarray(others_xyz[start:start + chunk_size], dtype=np.float32).tobytes())
+    return h.hexdigest()
+
+
+def torch_project_non_differentiable_chunked(origin_xyz, others_xyz, selected_indices, output_path, memory_budget=2 ** 30,
+                                             resource_folder="resource", workers=None):
+    """
+    projects a large batch of sensor clouds (same anchors) to MNI in chunks that fit in a memory budget, see
+    torch_project_non_differentiable. results are streamed into a preallocated memory mapped .npy file, and progress
+    is recorded next to it (".progress.json"), so an interrupted projection resumes where it stopped.
+    :param origin_xyz: anchors given as nx3 tensor (n >= 4)
+    :param others_xyz: optodes to project given as bxmx3 np array (can be memory mapped)
+    :param selected_indices: which indices to select from origin_xyz as anchors (see torch_project_non_differentiable)
+    :param output_path: path of the output .npy file (bxmx3 float32)
+    :param memory_budget: peak memory (bytes) allowed for projecting a chunk
+    :param resource_folder: relative path to the folder with the raw template data
+    :param workers: number of threads used for the cortical projection (see MNI.map_reference_brains)
+    :return: the output as a bxmx3 read-only memory mapped np array
+    """
+    output_path = Path(output_path)
+    progress_path = Path(str(output_path) + ".progress.json")
+    batch_size, pointN = others_xyz.shape[:2]
+    fingerprint = projection_input_fingerprint(origin_xyz, others_xyz, selected_indices, resource_folder)
+    done = 0
+    if output_path.is_file() and progress_path.is_file():
+        with open(progress_path, "r") as f:
+            progress = json.load(f)
+        # a different template / anchors / clouds with the same shape start from scratch
+        if progress["shape"] == [batch_size, pointN, 3] and progress.get("fingerprint") == fingerprint:
+            done = progress["done"]
+    if done == 0 or not output_path.is_file():
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        output = np.lib.format.open_memmap(output_path, mode="w+", dtype=np.float32, shape=(batch_size, pointN, 3))
+    else:
+        output = np.load(output_path, mmap_mode="r+")
+    chunk_size = max(1, memory_budget // estimate_projection_memory(pointN, resource_folder, workers))
+    if done < batch_size:
+        logging.info("projecting {} clouds in chunks of {} (resuming from {})".format(batch_size, chunk_size, done))
+    while done < batch_size:
+        end = min(done + chunk_size, batch_size)
+        # all clouds share the anchors, so a chunk is projected as one long list of sensors
+        chunk = torch.as_tensor(np.asarray(others_xyz[done:end]), dtype=torch.float, device=origin_xyz.device)
+        projected, _, _ = torch_project_non_differentiable(origin_xyz, chunk.reshape(1, -1, 3), selected_indices,
+                                                           resource_folder=resource_folder, workers=workers)
+        output[done:end] = projected.reshape(end - done, pointN, 3).cpu().numpy()
+        output.flush()
+        done = end
+        tmp_path = progress_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"done": done, "shape": [batch_size, pointN, 3], "fingerprint": fingerprint}, f)
+        os.replace(tmp_path, progress_path)
+        logging.info("projected {} / {} clouds".format(done, batch_size))
+    del output
+    return np.load(output_path, mmap_mode="r")
@@ -61,6 +61,26 @@ class HeatMap(torch.nn.Module):
             heatmap = torch.zeros((256, 256)).to(landmarks.device)
         return heatmap.unsqueeze(0)
 
+    def draw_gmm_batch(self, landmark_batch):
+        """
+        same as draw_gmm, for a batch of landmark sets at once
+        :param landmark_batch: N x Num_landmarks x 2 landmarks (zero landmarks are ignored)
+        :return: N x 1 x img_shape[0] x img_shape[1] heatmaps
+        """
+        sigma = 5
+        valid = torch.all(landmark_batch != 0, dim=-1)
+        grid = torch.meshgrid(torch.arange(self.img_shape[0]), torch.arange(self.img_shape[1]), indexing='ij')
+        grid = torch.stack(grid, dim=-1).reshape(-1, 2).to(landmark_batch.device, landmark_batch.dtype)
+        # mixture of equally weighted isotropic gaussians, one per valid landmark
+        pdf = torch.zeros((len(landmark_batch), len(grid)), dtype=landmark_batch.dtype, device=landmark_batch.device)
+        for i in range(landmark_batch.shape[1]):
+            squared_distance = torch.sum((grid[None] - landmark_batch[:, i, None]) ** 2, dim=-1)
+            pdf += valid[:, i, None] * torch.exp(-squared_distance / (2 * sigma ** 2))
+        pdf *= 1 / (2 * np.pi * sigma ** 2) / torch.clamp(valid.sum(dim=-1, keepdim=True), min=1)
+        low, high = torch.aminmax(pdf, dim=-1, keepdim=True)
+        heatmap = torch.where(valid.any(dim=-1, keepdim=True), (pdf - low) / (high - low), torch.zeros_like(pdf))
+        return heatmap.reshape(len(landmark_batch), 1, *self.img_shape)
+
     def draw_offsets(self, landmark):
         """
         Draws a single point only
@@ -141,6 +161,8 @@ class HeatMap(torch.nn.Module):
             (of shape ``N x 1 x self.img_shape[0] x self.img_shape[1]``)
 
         """
+        if not self.dont_use_gmm:
+            return self.draw_gmm_batch(landmark_batch).squeeze(1)
         x = torch.cat([self.draw_landmarks(landmarks, self.dont_use_gmm)
                    for landmarks in landmark_batch], dim=0)
         return x
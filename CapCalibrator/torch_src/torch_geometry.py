@@ -0,0 +1,39 @@
+import torch
+
+
+def torch_batch_find_affine_transformation(A, B, to_44=False):
+    """
+    torch version of geometry.batch_find_affine_transformation
+    :param A: bxnx3 source point clouds (n >= 4)
+    :param B: bxnx3 target point clouds
+    :param to_44: if true, returns bx4x4 matrices
+    :return: bx3x4 affine transformations (W @ [a, 1] ~= b)
+    """
+    assert A.shape[-2] >= 4
+    new_A = torch.cat((A, torch.ones(A.shape[:-1] + (1,), dtype=A.dtype, device=A.device)), dim=-1)
+    # every row of W is an independent least squares problem sharing the same nx4 matrix
+    W = torch.linalg.pinv(new_A) @ B
+    W = W.transpose(-1, -2)
+    if to_44:
+        bottom = torch.tensor([0, 0, 0, 1], dtype=W.dtype, device=W.device).expand(W.shape[:-2] + (1, 4))
+        W = torch.cat((W, bottom), dim=-2)
+    return W
+
+
+def torch_batch_rigid_transform_3d(A, B):
+    """
+    torch version of geometry.batch_rigid_transform_3d (reflections are corrected)
+    :param A: bxnx3 source point clouds (or nx3, shared by all pairs)
+    :param B: bxnx3 target point clouds
+    :return: bx3x3 rotation matrices and bx3 translations to apply to A such that it matches B
+    """
+    centroid_A = torch.mean(A, dim=-2, keepdim=True)
+    centroid_B = torch.mean(B, dim=-2, keepdim=True)
+    H = (A - centroid_A).transpose(-1, -2) @ (B - centroid_B)
+    U, S, Vt = torch.linalg.svd(H)
+    V, Ut = Vt.transpose(-1, -2), U.transpose(-1, -2)
+    flip = torch.ones(H.shape[:-1], dtype=H.dtype, device=H.device)
+    flip[..., -1] = torch.linalg.det(V @ Ut)
+    R = (V * flip.unsqueeze(-2)) @ Ut
+    t = centroid_B[..., 0, :] - (R @ centroid_A[..., 0, :].unsqueeze(-1)).squeeze(-1)
+    return R, t
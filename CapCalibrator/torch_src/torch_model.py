@@ -9,26 +9,26 @@ import copy
 
 
 class Convd2d():
-    def __init__(self, input_size, output_size):
+    def __init__(self, input_size, output_size, base_channels=64):
         self.network = torch.nn.ModuleList([
-            nn.Conv2d(in_channels=input_size, out_channels=64, kernel_size=(3, 3), padding=1),
-            nn.BatchNorm2d(64),
+            nn.Conv2d(in_channels=input_size, out_channels=base_channels, kernel_size=(3, 3), padding=1),
+            nn.BatchNorm2d(base_channels),
             nn.ReLU(),
             nn.MaxPool2d(kernel_size=2, stride=2),
-            nn.Conv2d(in_channels=64, out_channels=128, kernel_size=(3, 3), padding=1),
-            nn.BatchNorm2d(128),
+            nn.Conv2d(in_channels=base_channels, out_channels=base_channels*2, kernel_size=(3, 3), padding=1),
+            nn.BatchNorm2d(base_channels*2),
             nn.ReLU(),
             nn.MaxPool2d(kernel_size=2, stride=2),
-            nn.Conv2d(in_channels=128, out_channels=256, kernel_size=(3, 3), padding=1),
-            nn.BatchNorm2d(256),
+            nn.Conv2d(in_channels=base_channels*2, out_channels=base_channels*4, kernel_size=(3, 3), padding=1),
+            nn.BatchNorm2d(base_channels*4),
             nn.ReLU(),
             nn.MaxPool2d(kernel_size=2, stride=2),
-            nn.Conv2d(in_channels=256, out_channels=512, kernel_size=(3, 3), padding=1),
-            nn.BatchNorm2d(512),
+            nn.Conv2d(in_channels=base_channels*4, out_channels=base_channels*8, kernel_size=(3, 3), padding=1),
+            nn.BatchNorm2d(base_channels*8),
             nn.ReLU(),
             nn.MaxPool2d(kernel_size=2, stride=2),
             nn.Flatten(),
-            nn.Linear(131072, 16),
+            nn.Linear(base_channels*8*16*16, 16),
             nn.ReLU(),
             nn.Linear(16, output_size),
                 ])
@@ -78,7 +78,9 @@ class MyNetwork(torch.nn.Module):
             conv1d_network = Convd1d(opt.network_input_size, opt.network_output_size)
             self.net = conv1d_network.network
         elif opt.architecture == "2dconv":
-            conv2d_network = Convd2d(opt.network_input_size, opt.network_output_size)
+            # the manuscript network uses 64 base channels, smaller values are used for distilled students
+            base_channels = getattr(opt, "network_base_channels", 64)
+            conv2d_network = Convd2d(opt.network_input_size, opt.network_output_size, base_channels)
             self.net = conv2d_network.network
         else:
             raise NotImplementedError
@@ -143,6 +145,19 @@ class MyNetwork(torch.nn.Module):
         return torch.bmm(torch.bmm(Rz, Ry), Rx)
 
 
+def get_base_channels(state_dict, default=64):
+    """
+    infers the number of base channels of a 2dconv network from its saved weights
+    :param state_dict: the state dict of a MyNetwork
+    :param default: returned if state dict does not belong to a 2dconv network
+    :return: the number of output channels of the first convolution
+    """
+    first_layer = state_dict.get("net.0.weight", None)
+    if first_layer is None or first_layer.dim() != 4:
+        return default
+    return first_layer.shape[0]
+
+
 class MyModel:
     def __init__(self, opt):
         self.opt = copy.deepcopy(opt)
@@ -157,7 +172,7 @@ class MyModel:
                                           lr=opt.lr,
                                           betas=(opt.beta1, 0.999),
                                           weight_decay=1e-5)
-        self.scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(self.optimizer, 'min', factor=0.5, verbose=True, patience=5)
+        self.scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(self.optimizer, 'min', factor=0.5, patience=5)
         self.network.to(self.opt.device)
 
     def load_network(self, file_name):
@@ -7,6 +7,51 @@ import torch_src.torch_data as torch_data
 import torch_src.torch_model as torch_model
 import torch_src.torch_writer as torch_writer
 import numpy as np
+import copy
+import predict
+
+
+def load_teacher(opt):
+    """
+    loads a frozen teacher network used for knowledge distillation
+    :param opt: training options, opt.teacher is the path to the teacher checkpoint
+    :return: the teacher network (without gradients), forward it inside predict.per_sample_batch_norm
+    """
+    state_dict = torch.load(opt.teacher, map_location=opt.device)
+    if hasattr(state_dict, '_metadata'):
+        del state_dict._metadata
+    teacher_opt = copy.deepcopy(opt)
+    teacher_opt.loss = "l2"  # the teacher only supplies euler angles
+    teacher_opt.network_base_channels = torch_model.get_base_channels(state_dict)
+    teacher = torch_model.MyNetwork(teacher_opt)
+    teacher.load_state_dict(state_dict)
+    teacher.to(opt.device)
+    teacher.train()  # STORM-Net predicts in training mode, see predict.per_sample_batch_norm
+    for param in teacher.parameters():
+        param.requires_grad = False
+    return teacher
+
+
+def measure_latency(network, x, repeats=10):
+    """
+    measures cpu inference time of a network on a single sample (predicting the way predict.predict_parameters does)
+    :param network: the network to measure (it is copied, the original is not modified)
+    :param x: a batch of inputs, only the first one is used
+    :param repeats: number of timed forward passes
+    :return: median latency in milliseconds
+    """
+    cpu_network = copy.deepcopy(network).cpu().train()
+    cpu_network.opt.device = "cpu"
+    cpu_network.opt.loss = "l2"  # inference only requires the euler angles
+    sample = x[:1].cpu()
+    timings = []
+    with torch.no_grad(), predict.per_sample_batch_norm(cpu_network):
+        cpu_network(sample)  # warm up
+        for _ in range(repeats):
+            start = time.perf_counter()
+            cpu_network(sample)
+            timings.append(time.perf_counter() - start)
+    return 1000 * np.median(timings)
 
 
 def train_loop(opt, sync=None):
@@ -15,6 +60,7 @@ def train_loop(opt, sync=None):
     :param opt: training options (from command line usually)
     :param sync: list of synchronization objects: 0-event signaling to end training, 1-queue to report results
     :return:
+    note: if opt.teacher is set, a (smaller) student network is distilled from the teacher checkpoint
     """
     if sync:
         writer = torch_writer.Writer(opt, sync[1])
@@ -24,6 +70,11 @@ def train_loop(opt, sync=None):
     train_dataset = torch_data.MyDataLoader(opt)
     opt.is_train = False
     val_dataset = torch_data.MyDataLoader(opt)
+    teacher = None
+    if getattr(opt, "teacher", None):
+        logging.info("distilling student with {} base channels from: {}".format(opt.student_base_channels, opt.teacher))
+        teacher = load_teacher(opt)
+        opt.network_base_channels = opt.student_base_channels
     model = torch_model.MyModel(opt)
     # loss_fn = torch.nn.MSELoss()
     model.optimizer.zero_grad()
@@ -39,6 +90,12 @@ def train_loop(opt, sync=None):
                 train_loss = opt.loss_alpha*train_loss_sensors + (1 - opt.loss_alpha)*train_loss_euler
             else:
                 train_loss = train_loss_euler
+            if teacher is not None:
+                with torch.no_grad(), predict.per_sample_batch_norm(teacher):
+                    _, teacher_euler = teacher(input)
+                train_loss_distill = torch.mean((teacher_euler - output_euler) ** 2)
+                writer.write_scaler("batch", "train_loss_distill", train_loss_distill.cpu().detach().numpy(), epoch*(len(train_dataset) // opt.batch_size) + batch_index)
+                train_loss = opt.distill_alpha*train_loss_distill + (1 - opt.distill_alpha)*train_loss
             if opt.batch_size == 1:
                 #divide loss by accumulation steps to have equivilant performance of using batch size = "batch_accumulation"
                 train_loss /= opt.batch_accumulation
@@ -79,9 +136,17 @@ def train_loop(opt, sync=None):
             model.save_network(file_name="latest")
         with torch.no_grad():
             val_loss_total = []
+            teacher_student_error = []
             for input, target in val_dataset:
                 model.optimizer.zero_grad()
                 output_sensors, output_euler = model.network(input)
+                if teacher is not None:
+                    # compare both networks the way they predict after training
+                    with predict.per_sample_batch_norm(teacher):
+                        _, teacher_euler = teacher(input)
+                    with predict.per_sample_batch_norm(model.network):
+                        _, student_euler = model.network(input)
+                    teacher_student_error.append(torch.linalg.norm(teacher_euler[:, :3] - student_euler[:, :3], dim=-1).cpu().numpy())
                 val_loss_euler = torch.mean((target["rot_and_scale"] - output_euler) ** 2)
                 if opt.loss == "l2+projection":
                     val_loss_sensors = torch.mean(torch.linalg.norm(target["raw_projected_data"] - output_sensors, dim=2))
@@ -93,6 +158,18 @@ def train_loop(opt, sync=None):
             val_loss_total = np.mean(np.array(val_loss_total))
             writer.write_scaler("epoch", "val_loss_total", val_loss_total, epoch)
             logging.info("validation: epoch: {}, loss: {}".format(epoch, val_loss_total))
+            if teacher is not None:
+                teacher_student_error = np.mean(np.concatenate(teacher_student_error))
+                teacher_latency = measure_latency(teacher, input)
+                student_latency = measure_latency(model.network, input)
+                writer.write_scaler("epoch", "teacher_student_euler_error", teacher_student_error, epoch)
+                writer.write_scaler("epoch", "teacher_latency_ms", teacher_latency, epoch)
+                writer.write_scaler("epoch", "student_latency_ms", student_latency, epoch)
+                logging.info("distillation: epoch: {}, teacher-student euler error: {}, "
+                             "latency (teacher, student): {:.2f}ms, {:.2f}ms".format(epoch,
+                                                                                 teacher_student_error,
+                                                                                 teacher_latency,
+                                                                                 student_latency))
         writer.write_scaler("epoch", "learning rate", model.optimizer.param_groups[0]['lr'], epoch)
         logging.info("lr: {}".format(model.optimizer.param_groups[0]['lr']))
         model.scheduler.step(val_loss_total)
@@ -109,6 +186,9 @@ def parse_arguments():
     parser.add_argument("--scale_faces", type=str, choices=["x", "y", "z", "xy", "xz", "yz", "xyz"], help="Renderer will also apply different scales to the virtual head & mask")
     parser.add_argument("--dont_use_gmm", action="store_true", default=False, help="do not use gmm to create heatmaps")
     parser.add_argument('--loss_alpha', type=float, default=0.1, help='coefficient of projection loss if used')
+    parser.add_argument("--teacher", help="If present, distills a student network from this trained STORM-Net checkpoint")
+    parser.add_argument("--student_base_channels", type=int, default=16, help="Width of the first convolution of the distilled student (the manuscript network uses 64)")
+    parser.add_argument('--distill_alpha', type=float, default=0.5, help='coefficient of the teacher term in the distillation loss')
     parser.add_argument("--gpu_ids", type=int, default=-1, help="Which GPU to use (or -1 for cpu)")
     parser.add_argument("--continue_train", action="store_true", help="continue from latest epoch")
     parser.add_argument("--batch_size", type=int, default=16, help="Batch size for training")
@@ -144,6 +224,9 @@ def parse_arguments():
 
     args.data_path = Path(args.data_path)
 
+    if args.teacher:
+        args.teacher = Path(args.teacher)
+
     args.is_train = True
 
     args.network_output_size = 3
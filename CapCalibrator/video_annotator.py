@@ -1047,7 +1047,8 @@ class ThreadedTask(threading.Thread):
         r, s = predict.predict_rigid_transform(data, model, args)
         sensor_locations = geometry.apply_rigid_transform(r, s, template_names, template_data, None, args)
         if args.mni:
-            projected_data = geometry.project_sensors_to_MNI(sensor_locations, transform_anchors=True, resource_folder=Path(__file__, "../resource"))
+            projected_data = geometry.project_sensors_to_MNI(sensor_locations, transform_anchors=True, resource_folder=Path(__file__, "../resource"),
+                                                             surface=args.mni_surface)
         else:
             projected_data = sensor_locations
         self.queue.put(["coregister", projected_data[0]])
@@ -1074,10 +1075,11 @@ class ThreadedTask(threading.Thread):
                     self.scale_faces = None
                     self.network_output_size = 3
             opt = MyOptions(device=device)
-            network = torch_model.MyNetwork(opt)
             state_dict = torch.load(model_full_path, map_location=device)
             if hasattr(state_dict, '_metadata'):
                 del state_dict._metadata
+            opt.network_base_channels = torch_model.get_base_channels(state_dict)
+            network = torch_model.MyNetwork(opt)
             network.load_state_dict(state_dict)
             network.to(opt.device)
             self.queue.put(["load_stormnet", network, path])
@@ -1568,16 +1570,13 @@ def fill_structures(orig_names, orig_data, template_file_name, mode="MNI", force
     if mode == "MNI":
         scale = 200.
         resource_folder = Path(Path(__file__).parent, "resource")
-        XYZ_head = MNI.load_raw_MNI_data(str(Path(resource_folder, "MNI_templates", "xyzallHEM.npy")),
-                                         "head",
-                                         resource_folder=str(resource_folder))
+        templates = MNI.get_template_store(resource_folder)
+        XYZ_head = templates.surface("head")
         avg_head = ps.register_point_cloud("avg_head", XYZ_head, radius=0.0002, point_render_mode="quad")
         col = np.zeros_like(XYZ_head)
         col[:, 0] = 1
         avg_head.add_color_quantity("color", col, enabled=True)
-        XYZ_brain = MNI.load_raw_MNI_data(str(Path(resource_folder, "MNI_templates", "xyzallBEM.npy")),
-                                          "brain",
-                                          resource_folder=str(resource_folder))
+        XYZ_brain = templates.surface("brain")
         avg_brain = ps.register_point_cloud("avg_brain", XYZ_brain, radius=0.0002, point_render_mode="quad")
         col = np.zeros_like(XYZ_brain)
         col[:, 1] = 1